@@ -0,0 +1,230 @@
+import base64
+import datetime
+import decimal
+import json
+import math
+
+from dirty_buckets import DirtyBuckets
+
+EPOCH = datetime.datetime(1970, 1, 1)
+ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+# A day of the default hourly buckets
+DEFAULT_OPEN_BUCKETS = 24
+
+
+class ColumnAggregate:
+    # Mergeable summary of one column: count, sum, min, max and the first/last
+    # values together with the designated timestamps they were seen at
+    def __init__(self, count=0, total=None, minimum=None, maximum=None, first=None, first_ts=None, last=None, last_ts=None):
+        self.count = count
+        self.total = total
+        self.minimum = minimum
+        self.maximum = maximum
+        self.first = first
+        self.first_ts = first_ts
+        self.last = last
+        self.last_ts = last_ts
+
+    def merge(self, other):
+        if not other.count:
+            return self
+        self.count += other.count
+        if other.total is not None:
+            self.total = other.total if self.total is None else self.total + other.total
+        if other.minimum is not None and (self.minimum is None or other.minimum < self.minimum):
+            self.minimum = other.minimum
+        if other.maximum is not None and (self.maximum is None or other.maximum > self.maximum):
+            self.maximum = other.maximum
+        # Out-of-order commits can bring rows older than anything merged so far
+        if other.first_ts is not None and (self.first_ts is None or other.first_ts < self.first_ts):
+            self.first, self.first_ts = other.first, other.first_ts
+        if other.last_ts is not None and (self.last_ts is None or other.last_ts >= self.last_ts):
+            self.last, self.last_ts = other.last, other.last_ts
+        return self
+
+    def avg(self):
+        if not self.count or self.total is None:
+            return None
+        return self.total / self.count
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'first': self.first,
+            'last': self.last,
+            'min': self.minimum,
+            'max': self.maximum,
+            'avg': self.avg()
+        }
+
+    def to_dict(self):
+        return {key: _encode_value(value) for key, value in vars(self).items()}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{key: _decode_value(value) for key, value in data.items()})
+
+
+class AggregateState:
+    # Running aggregates for a set of columns. The open_buckets most recent time
+    # buckets of bucket_seconds (aligned to the epoch) are kept as partial
+    # states; older buckets are folded into a single base total, so the state
+    # and its checkpoint stay bounded. New transactions entirely past every row
+    # merged so far only add the rows of their [minTimestamp, maxTimestamp] to
+    # their buckets. Transactions overlapping merged rows (out-of-order commits)
+    # recompute the open buckets they touch and replace their partial states
+    # (see plan_cache.AggregationPlan), so no row is counted twice.
+    def __init__(self, columns, bucket_seconds, open_buckets=DEFAULT_OPEN_BUCKETS, buckets=None, base=None, horizon=None, merged_until=None):
+        self.columns = columns
+        self.bucket = datetime.timedelta(seconds=bucket_seconds)
+        self.bucket_seconds = bucket_seconds
+        self.open_buckets = open_buckets
+        # bucket index -> {column: ColumnAggregate}
+        self.buckets = buckets or {}
+        # Totals of the folded buckets, below bucket index horizon
+        self.base = base or {col: ColumnAggregate() for col in columns}
+        self.horizon = horizon
+        # Latest designated timestamp of the rows merged so far
+        self.merged_until = merged_until
+        self.aggregates = self._merge_buckets(self.buckets, self.base)
+
+    def index(self, timestamp):
+        return math.floor((timestamp - EPOCH) / self.bucket)
+
+    @property
+    def folded_until(self):
+        # Start of the first open bucket; rows before it are only in the base
+        return EPOCH + self.horizon * self.bucket if self.horizon is not None else None
+
+    def ranges(self, spans):
+        # Split the (minTimestamp, maxTimestamp) spans of new transactions into
+        # the bucket ranges to recompute and the (start, end) range of rows to
+        # append, or None. Folded buckets cannot be recomputed, so spans reaching
+        # into them are cut at the first open bucket; also returns how many were.
+        dirty = DirtyBuckets(self.bucket_seconds)
+        append_start = append_end = None
+        late = 0
+        for start, end in spans:
+            if self.merged_until is None or start > self.merged_until:
+                append_start = start if append_start is None else min(append_start, start)
+                append_end = end if append_end is None else max(append_end, end)
+                continue
+            if self.horizon is not None and self.index(start) < self.horizon:
+                late += 1
+                if self.index(end) < self.horizon:
+                    continue
+                start = self.folded_until
+            dirty.mark(start, end)
+        append = (append_start, append_end + ONE_MICROSECOND) if append_start is not None else None
+        return dirty.drain(), append, late
+
+    def apply(self, recomputed, bucket_aggregates):
+        # recomputed are the bucket ranges from ranges() and bucket_aggregates
+        # the partial states read by the query, by bucket index. Buckets in the
+        # recomputed ranges are replaced (and dropped without rows anymore), the
+        # others only got appended rows, which are merged. Returns the combined
+        # state of the rows read.
+        delta = self._merge_buckets(bucket_aggregates)
+        for start, end in recomputed:
+            low, high = self.index(start), self.index(end)
+            for bucket in [bucket for bucket in self.buckets if low <= bucket < high]:
+                del self.buckets[bucket]
+        for bucket, aggregates in bucket_aggregates.items():
+            if self.horizon is not None and bucket < self.horizon:
+                target = self.base
+            else:
+                target = self.buckets.setdefault(bucket, {})
+            for col, aggregate in aggregates.items():
+                target.setdefault(col, ColumnAggregate()).merge(aggregate)
+            for aggregate in aggregates.values():
+                if aggregate.last_ts is not None and (self.merged_until is None or aggregate.last_ts > self.merged_until):
+                    self.merged_until = aggregate.last_ts
+        self._fold()
+        self.aggregates = self._merge_buckets(self.buckets, self.base)
+        return delta
+
+    def _fold(self):
+        # Merge the buckets that fell out of the open_buckets most recent ones into the base
+        if not self.buckets:
+            return
+        horizon = max(self.buckets) - self.open_buckets + 1
+        if self.horizon is not None and horizon <= self.horizon:
+            return
+        for bucket in sorted(bucket for bucket in self.buckets if bucket < horizon):
+            for col, aggregate in self.buckets.pop(bucket).items():
+                self.base.setdefault(col, ColumnAggregate()).merge(aggregate)
+        self.horizon = horizon
+
+    def _merge_buckets(self, buckets, base=None):
+        aggregates = {col: ColumnAggregate() for col in self.columns}
+        for col, aggregate in (base or {}).items():
+            aggregates.setdefault(col, ColumnAggregate()).merge(aggregate)
+        for bucket in sorted(buckets):
+            for col, aggregate in buckets[bucket].items():
+                aggregates.setdefault(col, ColumnAggregate()).merge(aggregate)
+        return aggregates
+
+    def encode(self):
+        payload = json.dumps({
+            'bucket_seconds': self.bucket_seconds,
+            'horizon': self.horizon,
+            'merged_until': _encode_value(self.merged_until),
+            'base': {col: aggregate.to_dict() for col, aggregate in self.base.items()},
+            'buckets': {
+                str(bucket): {col: aggregate.to_dict() for col, aggregate in aggregates.items()}
+                for bucket, aggregates in self.buckets.items()
+            }
+        })
+        return base64.b64encode(payload.encode('utf-8')).decode('utf-8')
+
+    @classmethod
+    def decode(cls, columns, bucket_seconds, state64, open_buckets=DEFAULT_OPEN_BUCKETS):
+        # Returns None for a state kept in buckets of another size, which cannot be split or merged
+        data = json.loads(base64.b64decode(state64).decode('utf-8'))
+        if data.get('bucket_seconds') != bucket_seconds:
+            return None
+
+        def aggregates_from_dict(aggregates):
+            return {col: ColumnAggregate.from_dict(aggregates[col]) if col in aggregates else ColumnAggregate() for col in columns}
+
+        buckets = {int(bucket): aggregates_from_dict(aggregates) for bucket, aggregates in data['buckets'].items()}
+        state = cls(columns, bucket_seconds, open_buckets, buckets, aggregates_from_dict(data.get('base', {})),
+                    data.get('horizon'), _decode_value(data.get('merged_until')))
+        # A smaller --open_buckets than the checkpoint was written with folds the extra buckets right away
+        state._fold()
+        state.aggregates = state._merge_buckets(state.buckets, state.base)
+        return state
+
+
+def summary_headers(columns):
+    return [f"{col}_first" for col in columns] + \
+           [f"{col}_last" for col in columns] + \
+           [f"{col}_min" for col in columns] + \
+           [f"{col}_max" for col in columns] + \
+           [f"{col}_avg" for col in columns]
+
+
+def summary_values(aggregates, columns):
+    # Same layout as summary_headers
+    return [aggregates[col].first for col in columns] + \
+           [aggregates[col].last for col in columns] + \
+           [aggregates[col].minimum for col in columns] + \
+           [aggregates[col].maximum for col in columns] + \
+           [aggregates[col].avg() for col in columns]
+
+
+def _encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return {'$ts': value.isoformat()}
+    if isinstance(value, decimal.Decimal):
+        return {'$dec': str(value)}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict) and '$ts' in value:
+        return datetime.datetime.fromisoformat(value['$ts'])
+    if isinstance(value, dict) and '$dec' in value:
+        return decimal.Decimal(value['$dec'])
+    return value
@@ -0,0 +1,166 @@
+import collections
+import concurrent.futures
+import datetime
+import time
+
+from bootstrap import transaction_versions
+from metrics import gauge, TRANSACTIONS_PROCESSED, ROWS_PROCESSED, TXN_BACKLOG, LAST_PROCESSED_TXN
+from wal_poller import fetch_new_transactions
+
+# Transactions read from wal_transactions() per round trip while backfilling
+BACKFILL_PAGE_TXNS = 10000
+
+BACKFILL_ETA_SECONDS = gauge('questdb_tracker_backfill_eta_seconds', 'Estimated time until the backfill of the table reaches the head of the WAL.', ['table'])
+
+
+def chunk_transactions(transactions, max_txns, max_seconds=None):
+    # Group consecutive transactions, given as (sequencerTxn, minTimestamp,
+    # maxTimestamp, rowCount[, structureVersion]) rows, into chunks of at most
+    # max_txns transactions whose timestamps span at most max_seconds. A single
+    # transaction spanning more than max_seconds makes a chunk of its own, see
+    # time_slices. Transactions without timestamps (DDL) join the current chunk.
+    span = datetime.timedelta(seconds=max_seconds) if max_seconds else None
+    chunks = []
+    chunk = None
+    for txn in transactions:
+        low, high = txn[1], txn[2]
+        if chunk is not None:
+            full = chunk['txns'] >= max_txns
+            if not full and span and low is not None and chunk['min_timestamp'] is not None:
+                full = max(high, chunk['max_timestamp']) - min(low, chunk['min_timestamp']) > span
+            if full:
+                chunks.append(chunk)
+                chunk = None
+        if chunk is None:
+            chunk = {'first_txn': txn[0], 'last_txn': txn[0], 'txns': 0, 'rows': 0, 'min_timestamp': None, 'max_timestamp': None, 'structure_version': None}
+        chunk['last_txn'] = txn[0]
+        chunk['txns'] += 1
+        chunk['rows'] += txn[3] or 0
+        if low is not None and high is not None:
+            chunk['min_timestamp'] = low if chunk['min_timestamp'] is None else min(low, chunk['min_timestamp'])
+            chunk['max_timestamp'] = high if chunk['max_timestamp'] is None else max(high, chunk['max_timestamp'])
+        if len(txn) > 4 and txn[4] is not None:
+            chunk['structure_version'] = txn[4]
+    if chunk is not None:
+        chunks.append(chunk)
+    return chunks
+
+
+def time_slices(chunk, max_seconds=None):
+    # The (min_timestamp, max_timestamp) ranges materializing a chunk, each at
+    # most max_seconds wide. A chunk without timestamps needs no query.
+    if chunk['min_timestamp'] is None:
+        return []
+    if not max_seconds:
+        return [(chunk['min_timestamp'], chunk['max_timestamp'])]
+    span = datetime.timedelta(seconds=max_seconds)
+    slices = []
+    low = chunk['min_timestamp']
+    while True:
+        high = min(low + span, chunk['max_timestamp'])
+        slices.append((low, high))
+        if high >= chunk['max_timestamp']:
+            return slices
+        low = high
+
+
+class Backfill:
+    # Catches up a large backlog of a table in bounded chunks instead of one
+    # poll and one materialization over the whole missed range. The backlog is
+    # read from wal_transactions() a page at a time and split into chunks of at
+    # most chunk_txns transactions spanning at most chunk_seconds. Chunks run in
+    # parallel on the executor, if any, but are committed in order: commit() only
+    # gets a chunk once every earlier chunk succeeded, so a checkpoint never
+    # covers a gap. Materializations must therefore be idempotent, which they
+    # are for DEDUP UPSERT targets.
+    def __init__(self, conn, executor, materialize, query_name, chunk_txns, chunk_seconds=None, workers=1):
+        self.conn = conn
+        self.executor = executor
+        self.materialize = materialize
+        self.query_name = query_name
+        self.chunk_txns = chunk_txns
+        self.chunk_seconds = chunk_seconds
+        # Keep the workers busy while the oldest chunk is still running
+        self.window = 2 * workers
+
+    def head(self, cur, table):
+        versions = transaction_versions(cur, {table: None})
+        return versions[table][0] if table in versions else 0
+
+    def run(self, cur, table, start_txn, columns, build_query, commit):
+        # columns are the wal_transactions() columns to chunk by, see
+        # chunk_transactions. build_query(min_timestamp, max_timestamp) returns the
+        # (sql, params) of one time slice and commit(chunk) records the progress
+        # of a chunk. Returns the last committed sequencerTxn. A backlog of less
+        # than chunk_txns is left to incremental polling.
+        head = self.head(cur, table)
+        if head - start_txn < self.chunk_txns:
+            return start_txn
+        print(f"Backfilling {head - start_txn} transactions of table {table} in chunks of up to {self.chunk_txns} transactions")
+        progress = {'table': table, 'start_txn': start_txn, 'committed_txn': start_txn, 'head': head, 'started': time.monotonic()}
+        outstanding = collections.deque()
+        latest_txn_id = start_txn
+
+        while True:
+            page = fetch_new_transactions(cur, {table: latest_txn_id}, columns, max_txns=BACKFILL_PAGE_TXNS)[table]
+            for chunk in chunk_transactions(page, self.chunk_txns, self.chunk_seconds):
+                futures = []
+                for index, (low, high) in enumerate(time_slices(chunk, self.chunk_seconds)):
+                    sql_query, params = build_query(low, high)
+                    if self.executor:
+                        while sum(len(pending) for _, pending in outstanding) + len(futures) >= self.window:
+                            self.commit_ready(outstanding, progress, commit, block=True)
+                        futures.append(self.executor.submit(f"backfill:{table}:{chunk['first_txn']}:{index}", self.materialize, sql_query, params, self.query_name))
+                    else:
+                        self.materialize(self.conn, sql_query, params, self.query_name)
+                outstanding.append((chunk, futures))
+                self.commit_ready(outstanding, progress, commit)
+            if page:
+                latest_txn_id = page[-1][0]
+            # The WAL keeps growing while backfilling; stop once the rest is small enough to poll
+            if not page or latest_txn_id >= progress['head']:
+                progress['head'] = max(self.head(cur, table), latest_txn_id)
+                if progress['head'] - latest_txn_id < self.chunk_txns:
+                    break
+
+        while outstanding:
+            self.commit_ready(outstanding, progress, commit, block=True)
+        BACKFILL_ETA_SECONDS.remove(table=table)
+        print(f"Backfill of table {table} reached transaction {progress['committed_txn']} after {time.monotonic() - progress['started']:.1f}s, "
+              f"switching to incremental polling")
+        return progress['committed_txn']
+
+    def commit_ready(self, outstanding, progress, commit, block=False):
+        # Commit finished chunks from the oldest one on; with block, wait for the oldest first
+        if block and outstanding:
+            concurrent.futures.wait(outstanding[0][1])
+        while outstanding and all(future.done() for future in outstanding[0][1]):
+            chunk, futures = outstanding.popleft()
+            for future in futures:
+                if future.exception():
+                    # Let the chunks already running finish before giving up, none of them is committed
+                    concurrent.futures.wait([pending for _, running in outstanding for pending in running])
+                    raise RuntimeError(f"Backfill of table {progress['table']} failed on transactions {chunk['first_txn']} to {chunk['last_txn']}") from future.exception()
+            commit(chunk)
+            self.report(chunk, progress)
+        if self.executor:
+            # Backfill jobs are tracked here, not by the main loop
+            self.executor.completed()
+
+    def report(self, chunk, progress):
+        table = progress['table']
+        progress['committed_txn'] = chunk['last_txn']
+        TRANSACTIONS_PROCESSED.inc(chunk['txns'], table=table)
+        ROWS_PROCESSED.inc(chunk['rows'], table=table)
+        LAST_PROCESSED_TXN.set(chunk['last_txn'], table=table)
+        remaining = max(progress['head'] - chunk['last_txn'], 0)
+        TXN_BACKLOG.set(remaining, table=table)
+
+        done = chunk['last_txn'] - progress['start_txn']
+        total = max(progress['head'] - progress['start_txn'], 1)
+        rate = done / max(time.monotonic() - progress['started'], 1e-9)
+        eta = remaining / rate if rate else None
+        if eta is not None:
+            BACKFILL_ETA_SECONDS.set(eta, table=table)
+        print(f"Backfill of table {table}: transactions {chunk['first_txn']} to {chunk['last_txn']} done, {done}/{total} ({100 * done / total:.1f}%), "
+              f"{rate:.1f} txns/s, ETA {f'{eta:.0f}s' if eta is not None else 'unknown'}")
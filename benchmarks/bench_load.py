@@ -0,0 +1,165 @@
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from pgwire_standin import Simulator, serve
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Drives change_tracker.py, materialize_view.py and materialize_append_only.py
+# against the local PGWire stand-in while it commits transactions, and reports
+# per script and table count:
+# - detection latency percentiles, from commit to the first wal_transactions()
+#   query returning the transaction,
+# - queries per poll cycle (all queries over wal_transactions() polls),
+# - CPU and peak RSS of the script processes per monitored table.
+# change_tracker.py monitors a single table, so it runs one process per table.
+# Only transactions committed after the warmup are measured.
+
+SCRIPTS = ('change_tracker', 'materialize_view', 'materialize_append_only')
+
+# The template only exercises the query path; the stand-in drops SAMPLE BY
+TEMPLATE = """INSERT INTO bench_target (timestamp, rowCount)
+SELECT max(timestamp), count(*) FROM {table} WHERE {{timestamp_txn_filter}}
+SAMPLE BY 1m;
+"""
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def script_commands(script, tables, port, template_path, check_interval, extra_args):
+    common = ['--host', '127.0.0.1', '--port', str(port), '--check_interval', str(check_interval), '--tracking_table', 'bench_tracker']
+    if script == 'change_tracker':
+        return [
+            [sys.executable, os.path.join(REPO_DIR, 'change_tracker.py'), '--table_name', table, '--columns', 'value', '--row_threshold', '1',
+             '--tracking_id', f"bench_{table}"] + common + extra_args
+            for table in tables
+        ]
+    arguments = ['--table_names', ','.join(tables), '--sql_template_path', template_path,
+                 '--timestamp_columns', ','.join('timestamp' for _ in tables), '--tracking_id', f"bench_{script}"]
+    if script == 'materialize_view':
+        arguments += ['--thresholds', ','.join('1' for _ in tables)]
+    else:
+        arguments += ['--transaction_threshold', '1']
+    return [[sys.executable, os.path.join(REPO_DIR, f"{script}.py")] + arguments + common + extra_args]
+
+
+def stop(processes):
+    # SIGTERM lets the scripts flush their checkpoints; wait4 returns the resource usage of each process
+    for process in processes:
+        process.send_signal(signal.SIGTERM)
+    cpu_seconds = 0.0
+    rss_bytes = 0
+    for process in processes:
+        deadline = time.monotonic() + 10
+        while True:
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                break
+            if time.monotonic() > deadline:
+                process.kill()
+                pid, status, usage = os.wait4(process.pid, 0)
+                break
+            time.sleep(0.05)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        cpu_seconds += usage.ru_utime + usage.ru_stime
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        rss_bytes += usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    return cpu_seconds, rss_bytes
+
+
+def run(script, table_count, duration, warmup, txn_rate, rows_per_txn, ooo_ratio, structure_change_every, check_interval, extra_args, log_path=None):
+    tables = [f"bench_{i}" for i in range(table_count)]
+    simulator = Simulator(tables, txn_rate, rows_per_txn, ooo_ratio, structure_change_every)
+    simulator.db.execute('CREATE TABLE bench_target (timestamp TIMESTAMP, rowCount LONG)')
+    server = serve(simulator)
+    port = server.server_address[1]
+
+    with tempfile.NamedTemporaryFile('w', suffix='.sql', delete=False) as template:
+        template.write(TEMPLATE.format(table=tables[0]))
+    log = open(log_path, 'a') if log_path else subprocess.DEVNULL
+    try:
+        started = time.monotonic()
+        processes = [
+            subprocess.Popen(command, cwd=REPO_DIR, stdout=log, stderr=subprocess.STDOUT)
+            for command in script_commands(script, tables, port, template.name, check_interval, extra_args)
+        ]
+        time.sleep(warmup)
+        with simulator.lock:
+            since = time.monotonic()
+            queries, polls = simulator.query_count, simulator.wal_query_count
+        time.sleep(duration)
+        with simulator.lock:
+            queries, polls = simulator.query_count - queries, simulator.wal_query_count - polls
+        # Give the last transactions a couple more polls to be detected
+        time.sleep(2 * check_interval + 1)
+        latencies, undetected = simulator.latencies(since)
+        cpu_seconds, rss_bytes = stop(processes)
+        elapsed = time.monotonic() - started
+    finally:
+        simulator.stop()
+        server.shutdown()
+        if log_path:
+            log.close()
+        os.unlink(template.name)
+
+    failed = [process.args[1] for process in processes if process.returncode not in (0, -signal.SIGTERM)]
+    return {
+        'latencies': latencies,
+        'undetected': undetected,
+        'queries_per_cycle': queries / polls if polls else None,
+        'cpu_percent_per_table': 100 * cpu_seconds / elapsed / table_count,
+        'rss_mb_per_table': rss_bytes / 1024 / 1024 / table_count,
+        'failed': failed
+    }
+
+
+def format_ms(seconds):
+    return f"{seconds * 1000:.0f}" if seconds is not None else '-'
+
+
+def main(scripts, table_counts, duration, warmup, txn_rate, rows_per_txn, ooo_ratio, structure_change_every, check_interval, extra_args, log_path=None):
+    print("script, tables, detected, undetected, p50_ms, p95_ms, p99_ms, max_ms, queries_per_cycle, cpu_percent_per_table, rss_mb_per_table")
+    for script in scripts:
+        for table_count in table_counts:
+            result = run(script, table_count, duration, warmup, txn_rate, rows_per_txn, ooo_ratio, structure_change_every, check_interval, extra_args, log_path)
+            latencies = result['latencies']
+            queries_per_cycle = f"{result['queries_per_cycle']:.2f}" if result['queries_per_cycle'] is not None else '-'
+            print(f"{script}, {table_count}, {len(latencies)}, {result['undetected']}, "
+                  f"{format_ms(percentile(latencies, 0.5))}, {format_ms(percentile(latencies, 0.95))}, {format_ms(percentile(latencies, 0.99))}, "
+                  f"{format_ms(latencies[-1] if latencies else None)}, {queries_per_cycle}, "
+                  f"{result['cpu_percent_per_table']:.2f}, {result['rss_mb_per_table']:.1f}")
+            if result['failed']:
+                print(f"Warning: {', '.join(result['failed'])} exited with an error, see --log_path")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the scripts against a local PGWire stand-in that simulates WAL transactions.')
+    parser.add_argument('--scripts', default=','.join(SCRIPTS), help='Comma-separated list of scripts to benchmark.')
+    parser.add_argument('--table_counts', default='1,10', help='Comma-separated list of table counts to benchmark.')
+    parser.add_argument('--duration', type=float, default=30, help='Measurement time (in seconds) per run.')
+    parser.add_argument('--warmup', type=float, default=5, help='Time (in seconds) the scripts run before measuring starts.')
+    parser.add_argument('--txn_rate', type=float, default=2.0, help='Average number of transactions per second per table.')
+    parser.add_argument('--rows_per_txn', type=int, default=50, help='Number of rows per transaction.')
+    parser.add_argument('--ooo_ratio', type=float, default=0.0, help='Fraction of transactions with out-of-order timestamps.')
+    parser.add_argument('--structure_change_every', type=int, default=0, help='Add a column to a table every this many of its transactions.')
+    parser.add_argument('--check_interval', type=int, default=1, help='The --check_interval passed to the scripts.')
+    parser.add_argument('--script_args', default='', help='Extra arguments passed to every script, for example "--min_interval 0.1".')
+    parser.add_argument('--log_path', help='Append the output of the scripts to this file instead of discarding it.')
+
+    args = parser.parse_args()
+    scripts = args.scripts.split(',')
+    for script in scripts:
+        if script not in SCRIPTS:
+            parser.error(f"Unknown script {script}, expected one of {', '.join(SCRIPTS)}")
+    table_counts = list(map(int, args.table_counts.split(',')))
+
+    main(scripts, table_counts, args.duration, args.warmup, args.txn_rate, args.rows_per_txn, args.ooo_ratio, args.structure_change_every, args.check_interval, args.script_args.split(), args.log_path)
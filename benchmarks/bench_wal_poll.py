@@ -0,0 +1,135 @@
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wal_poller import fetch_transaction_windows
+
+# Compares the per-table polling used before (one wal_transactions() query plus
+# one MAX(sequencerTxn) query per table per cycle) with the batched UNION ALL
+# poll into columnar windows used by the scripts, reporting round trips and
+# wall-clock per cycle as the table count grows.
+# Without --host the server is simulated with a fixed round-trip latency.
+
+COLUMNS = ['sequencerTxn', 'minTimestamp', 'maxTimestamp', 'rowCount', 'structureVersion', 'timestamp']
+
+
+class SimulatedCursor:
+    def __init__(self, rtt, txns_per_table):
+        self.rtt = rtt
+        self.txns_per_table = txns_per_table
+        self.round_trips = 0
+        self.rows = []
+
+    def execute(self, sql):
+        self.round_trips += 1
+        time.sleep(self.rtt)
+        self.rows = []
+        branches = re.findall(r"(?:SELECT '(\w+)' AS tableName, .*? )?FROM wal_transactions\('(\w+)'\)(?: WHERE sequencerTxn > (\d+))?", sql)
+        for tag, table, latest_txn_id in branches:
+            if 'MAX(sequencerTxn)' in sql:
+                self.rows.append((1000 + self.txns_per_table,))
+                continue
+            start = int(latest_txn_id or 1000)
+            for txn in range(start + 1, start + 1 + self.txns_per_table):
+                row = (txn, None, None, 100, 0, None)
+                self.rows.append((tag,) + row if tag else row)
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+
+class CountingCursor:
+    def __init__(self, cur):
+        self.cur = cur
+        self.round_trips = 0
+
+    def execute(self, sql):
+        self.round_trips += 1
+        self.cur.execute(sql)
+
+    def fetchall(self):
+        return self.cur.fetchall()
+
+    def fetchmany(self, size):
+        return self.cur.fetchmany(size)
+
+    def fetchone(self):
+        return self.cur.fetchone()
+
+
+def per_table_cycle(cur, latest_txn_ids):
+    for table, latest_txn_id in latest_txn_ids.items():
+        cur.execute(f"SELECT {', '.join(COLUMNS)} FROM wal_transactions('{table}') WHERE sequencerTxn > {latest_txn_id}")
+        cur.fetchall()
+    for table in latest_txn_ids:
+        cur.execute(f"SELECT MAX(sequencerTxn) FROM wal_transactions('{table}')")
+        cur.fetchone()
+
+
+def batched_cycle(cur, latest_txn_ids):
+    windows = fetch_transaction_windows(cur, latest_txn_ids, COLUMNS)
+    for window in windows.values():
+        window.last_txn
+
+
+def measure(cycle, cur, latest_txn_ids, cycles):
+    start_round_trips = cur.round_trips
+    start = time.perf_counter()
+    for _ in range(cycles):
+        cycle(cur, latest_txn_ids)
+    elapsed = time.perf_counter() - start
+    return (cur.round_trips - start_round_trips) / cycles, elapsed / cycles * 1000
+
+
+def main(table_counts, cycles, rtt_ms, txns_per_table, table_names=None, dbname='qdb', user='admin', host=None, port=8812, password='quest'):
+    if host:
+        import psycopg2
+        conn = psycopg2.connect(dbname=dbname, user=user, host=host, port=port, password=password)
+        cur = CountingCursor(conn.cursor())
+        available_tables = table_names
+    else:
+        cur = SimulatedCursor(rtt_ms / 1000, txns_per_table)
+        available_tables = [f"table_{i}" for i in range(max(table_counts))]
+
+    print("tables, mode, round_trips_per_cycle, ms_per_cycle")
+    for count in table_counts:
+        tables = [available_tables[i % len(available_tables)] for i in range(count)]
+        latest_txn_ids = {table: 0 for table in dict.fromkeys(tables)}
+        for mode, cycle in (('per_table', per_table_cycle), ('batched', batched_cycle)):
+            round_trips, ms = measure(cycle, cur, latest_txn_ids, cycles)
+            print(f"{len(latest_txn_ids)}, {mode}, {round_trips:.1f}, {ms:.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark per-table vs batched wal_transactions polling.')
+    parser.add_argument('--table_counts', default='1,5,10,50,100,200', help='Comma-separated list of table counts to benchmark.')
+    parser.add_argument('--cycles', type=int, default=5, help='Number of poll cycles to average per measurement.')
+    parser.add_argument('--rtt_ms', type=float, default=1.0, help='Simulated round-trip latency in milliseconds (ignored with --host).')
+    parser.add_argument('--txns_per_table', type=int, default=10, help='Simulated new transactions per table per cycle (ignored with --host).')
+    parser.add_argument('--table_names', help='Comma-separated list of existing WAL tables to poll when benchmarking against a server.')
+    parser.add_argument('--dbname', default='qdb', help='The name of the database.')
+    parser.add_argument('--user', default='admin', help='The database user.')
+    parser.add_argument('--host', help='The database host. When omitted the server is simulated.')
+    parser.add_argument('--port', type=int, default=8812, help='The database port.')
+    parser.add_argument('--password', default='quest', help='The database password.')
+
+    args = parser.parse_args()
+
+    if args.host and not args.table_names:
+        parser.error('--table_names is required with --host')
+
+    table_counts = list(map(int, args.table_counts.split(',')))
+    table_names = args.table_names.split(',') if args.table_names else None
+
+    main(table_counts, args.cycles, args.rtt_ms, args.txns_per_table, table_names, args.dbname, args.user, args.host, args.port, args.password)
@@ -0,0 +1,478 @@
+import argparse
+import datetime
+import random
+import re
+import socketserver
+import sqlite3
+import struct
+import threading
+import time
+
+# A small stand-in for the QuestDB PGWire endpoint, to run the scripts of this
+# repository without a server. It speaks just enough of the PostgreSQL simple
+# query protocol for psycopg2, keeps its data in an in-memory SQLite database
+# and rewrites the QuestDB-specific SQL the scripts use (wal_transactions(),
+# wal_tables(), table_columns(), LATEST ON, SAMPLE BY, dateadd, LIMIT lo, hi,
+# ...) into something SQLite understands. A background thread commits
+# transactions to every table at a configurable rate, with optional
+# out-of-order timestamps and structure changes, and the time until a
+# wal_transactions() query first returns each transaction is recorded as its
+# detection latency. Tables a client creates with WAL get a WAL as well, with
+# one transaction per INSERT, so chained materializations can be followed.
+# With an apply time per transaction, writerTxn in wal_tables() lags behind.
+# Query semantics are only approximated: DEDUP is not applied and SAMPLE BY is
+# dropped, so it measures the polling loop, not QuestDB.
+
+TS_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+TS_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}(\.\d+)?$')
+
+OID_BOOL = 16
+OID_INT8 = 20
+OID_TEXT = 25
+OID_FLOAT8 = 701
+OID_TIMESTAMP = 1114
+
+
+def format_ts(value):
+    return value.strftime(TS_FORMAT)
+
+
+def now_ts():
+    return format_ts(datetime.datetime.utcnow())
+
+
+# SQLite aggregates for QuestDB's first() and last()
+class First:
+    def __init__(self):
+        self.value = None
+        self.seen = False
+
+    def step(self, value):
+        if not self.seen:
+            self.value = value
+            self.seen = True
+
+    def finalize(self):
+        return self.value
+
+
+class Last:
+    def __init__(self):
+        self.value = None
+
+    def step(self, value):
+        self.value = value
+
+    def finalize(self):
+        return self.value
+
+
+def dateadd(unit, amount, value):
+    if value is None:
+        return None
+    seconds = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[unit] * amount
+    parsed = datetime.datetime.strptime(normalize_ts(value), TS_FORMAT)
+    return format_ts(parsed + datetime.timedelta(seconds=seconds))
+
+
+def fold_dateadd(sql):
+    # dateadd() over literals is evaluated once instead of once per row
+    return re.sub(
+        r"dateadd\('(\w)',\s*(-?\d+),\s*'([^']+)'\)",
+        lambda match: f"'{dateadd(match.group(1), int(match.group(2)), match.group(3))}'",
+        sql
+    )
+
+
+def micros(value):
+    # cast(<timestamp> AS LONG): microseconds since the epoch
+    if value is None:
+        return None
+    delta = datetime.datetime.strptime(normalize_ts(value), TS_FORMAT) - datetime.datetime(1970, 1, 1)
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def normalize_ts(value):
+    value = value.replace('T', ' ').rstrip('Z')
+    if '.' not in value:
+        value += '.000000'
+    head, frac = value.split('.')
+    return f"{head}.{frac[:6].ljust(6, '0')}"
+
+
+class Simulator:
+    # The tables, their simulated WAL and the detection latency bookkeeping.
+    # txn_rate is the average number of transactions per second per table.
+    def __init__(self, tables, txn_rate, rows_per_txn, ooo_ratio, structure_change_every, seed=0, apply_seconds=0.0):
+        self.db = sqlite3.connect(':memory:', check_same_thread=False)
+        self.db.create_aggregate('first', 1, First)
+        self.db.create_aggregate('last', 1, Last)
+        self.db.create_function('dateadd', 3, dateadd)
+        self.db.create_function('now', 0, now_ts)
+        self.db.create_function('micros', 1, micros)
+        self.lock = threading.RLock()
+        self.tables = tables
+        self.txn_rate = txn_rate
+        self.rows_per_txn = rows_per_txn
+        self.ooo_ratio = ooo_ratio
+        self.structure_change_every = structure_change_every
+        self.random = random.Random(seed)
+        self.commit_times = {}
+        self.detected = {}
+        # All queries, and those polling wal_transactions()
+        self.query_count = 0
+        self.wal_query_count = 0
+        self.stop_event = threading.Event()
+        self.db.execute('CREATE TABLE wal_tables_ (name TEXT, writerTxn INTEGER, sequencerTxn INTEGER)')
+        # Designated timestamp column of every WAL table, simulated or created by a client
+        self.wal_timestamps = {}
+        # Monotonic commit time of every WAL transaction per table, and the (writerTxn, busy until) of its writer
+        self.apply_seconds = apply_seconds
+        self.wal_commits = {}
+        self.writers = {}
+        for table in tables:
+            self.db.execute(f'CREATE TABLE {table} (timestamp TIMESTAMP, device_id SYMBOL, value DOUBLE, label VARCHAR)')
+            self.create_wal(table, 'timestamp')
+            self.commit(table)
+
+    def create_wal(self, table, timestamp_column):
+        with self.lock:
+            if table in self.wal_timestamps:
+                return
+            self.db.execute(f'''
+                CREATE TABLE wal_{table} (
+                    sequencerTxn INTEGER, timestamp TIMESTAMP, minTimestamp TIMESTAMP, maxTimestamp TIMESTAMP,
+                    rowCount INTEGER, structureVersion INTEGER
+                )''')
+            self.db.execute('INSERT INTO wal_tables_ VALUES (?, 0, 0)', (table,))
+            self.wal_timestamps[table] = timestamp_column
+            self.wal_commits[table] = []
+            self.writers[table] = (0, 0.0)
+
+    def append_wal(self, table, min_timestamp, max_timestamp, row_count, structure_version=None):
+        # Record a transaction in the WAL of the table and return its sequencerTxn
+        last = self.db.execute(f'SELECT MAX(sequencerTxn), MAX(structureVersion) FROM wal_{table}').fetchone()
+        txn = (last[0] or 0) + 1
+        structure_version = (last[1] or 0) if structure_version is None else structure_version
+        self.db.execute(f'INSERT INTO wal_{table} VALUES (?, ?, ?, ?, ?, ?)', (
+            txn, format_ts(datetime.datetime.utcnow()), min_timestamp, max_timestamp, row_count, structure_version
+        ))
+        self.wal_commits[table].append(time.monotonic())
+        if self.apply_seconds:
+            self.db.execute('UPDATE wal_tables_ SET sequencerTxn = ? WHERE name = ?', (txn, table))
+        else:
+            self.db.execute('UPDATE wal_tables_ SET sequencerTxn = ?, writerTxn = ? WHERE name = ?', (txn, txn, table))
+        return txn
+
+    def apply_wal(self):
+        # The writer of every table applies its transactions one at a time, each
+        # taking apply_seconds, so frequent commits build up an apply lag
+        now = time.monotonic()
+        for table, commits in self.wal_commits.items():
+            writer_txn, busy_until = self.writers[table]
+            while writer_txn < len(commits):
+                done = max(commits[writer_txn], busy_until) + self.apply_seconds
+                if done > now:
+                    break
+                writer_txn, busy_until = writer_txn + 1, done
+            self.writers[table] = (writer_txn, busy_until)
+            self.db.execute('UPDATE wal_tables_ SET writerTxn = ? WHERE name = ?', (writer_txn, table))
+
+    def insert(self, table, sql):
+        # An INSERT into a client WAL table becomes one transaction of its WAL
+        with self.lock:
+            first_rowid = self.db.execute(f'SELECT COALESCE(MAX(rowid), 0) FROM {table}').fetchone()[0]
+            cursor = self.db.execute(sql)
+            timestamp_column = self.wal_timestamps[table]
+            count, low, high = self.db.execute(
+                f'SELECT COUNT(*), MIN({timestamp_column}), MAX({timestamp_column}) FROM {table} WHERE rowid > ?', (first_rowid,)
+            ).fetchone()
+            if count:
+                self.append_wal(table, low, high, count)
+            return cursor
+
+    def commit(self, table):
+        with self.lock:
+            last = self.db.execute(f'SELECT MAX(sequencerTxn), MAX(structureVersion) FROM wal_{table}').fetchone()
+            txn = (last[0] or 0) + 1
+            structure_version = last[1] or 0
+            if self.structure_change_every and txn % self.structure_change_every == 0:
+                structure_version += 1
+                self.db.execute(f'ALTER TABLE {table} ADD COLUMN extra_{structure_version} DOUBLE')
+            now = datetime.datetime.utcnow()
+            base = now
+            # Out-of-order transactions carry rows from up to an hour ago
+            if self.random.random() < self.ooo_ratio:
+                base = now - datetime.timedelta(seconds=self.random.uniform(60, 3600))
+            rows = []
+            for i in range(self.rows_per_txn):
+                ts = base + datetime.timedelta(microseconds=i)
+                rows.append((format_ts(ts), f'd{i % 10}', self.random.random() * 100, f'l{i % 3}'))
+            self.db.executemany(f'INSERT INTO {table} (timestamp, device_id, value, label) VALUES (?, ?, ?, ?)', rows)
+            self.append_wal(table, rows[0][0], rows[-1][0], len(rows), structure_version)
+            self.commit_times[(table, txn)] = time.monotonic()
+
+    def run(self):
+        # Poisson arrivals over all tables, a random table per transaction
+        if self.txn_rate <= 0:
+            return
+        total_rate = self.txn_rate * len(self.tables)
+        while not self.stop_event.wait(self.random.expovariate(total_rate)):
+            self.commit(self.random.choice(self.tables))
+
+    def stop(self):
+        self.stop_event.set()
+
+    def observe(self, table, txns):
+        now = time.monotonic()
+        for txn in txns:
+            key = (table, txn)
+            if key in self.commit_times and key not in self.detected:
+                self.detected[key] = now - self.commit_times[key]
+
+    def latencies(self, since=None):
+        # Detection latencies in seconds of the transactions committed since the
+        # given monotonic time, and the number of those not detected yet
+        with self.lock:
+            committed = [key for key, committed_at in self.commit_times.items() if since is None or committed_at >= since]
+            detected = sorted(self.detected[key] for key in committed if key in self.detected)
+        return detected, len(committed) - len(detected)
+
+
+def split_statements(sql):
+    statements, current, quoted = [], [], False
+    for char in sql:
+        if char == "'":
+            quoted = not quoted
+        if char == ';' and not quoted:
+            statements.append(''.join(current))
+            current = []
+        else:
+            current.append(char)
+    statements.append(''.join(current))
+    return [s.strip() for s in statements if s.strip()]
+
+
+def rewrite(sql, simulator):
+    # QuestDB DDL suffixes and clauses SQLite does not know about
+    sql = re.sub(r'\)\s*timestamp\s*\(\s*\w+\s*\)[^;]*$', ')', sql, flags=re.I | re.S)
+    sql = re.sub(r'SAMPLE\s+BY\s+\w+(\s+ALIGN\s+TO\s+CALENDAR)?', '', sql, flags=re.I)
+    sql = re.sub(r"'([0-9T:\-\. ]+)'::timestamp", lambda m: f"'{normalize_ts(m.group(1))}'", sql)
+    sql = fold_dateadd(sql)
+    sql = re.sub(r'cast\((\w+)\s+AS\s+LONG\)', r'micros(\1)', sql, flags=re.I)
+    # QuestDB's LIMIT lo, hi selects rows lo to hi, SQLite's LIMIT offset, count
+    sql = re.sub(r'LIMIT\s+(\d+)\s*,\s*(\d+)', lambda m: f'LIMIT {int(m.group(2)) - int(m.group(1))} OFFSET {m.group(1)}', sql, flags=re.I)
+    sql = re.sub(r"wal_transactions\('(\w+)'\)", r'wal_\1', sql)
+    sql = re.sub(r'wal_tables\(\)', 'wal_tables_', sql)
+    sql = re.sub(r"table_columns\('(\w+)'\)", lambda m: f"(SELECT name AS \"column\", type FROM pragma_table_info('{m.group(1)}'))", sql)
+    sql = re.sub(r'ASOF\s+JOIN', ', ', sql, flags=re.I)
+    latest = re.search(r'LATEST\s+ON\s+(\w+)\s+PARTITION\s+BY\s+(\w+)', sql, flags=re.I)
+    if latest:
+        ts_col, part_col = latest.groups()
+        sql = sql[:latest.start()] + sql[latest.end():]
+        select = re.match(r'\s*SELECT\s+(.*?)\s+FROM\s+(.*)$', sql, flags=re.I | re.S)
+        columns, rest = select.groups()
+        sql = (f'SELECT {columns} FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY {part_col} '
+               f'ORDER BY {ts_col} DESC) AS rn__ FROM {rest}) WHERE rn__ = 1')
+    return sql
+
+
+class Handler(socketserver.BaseRequestHandler):
+    # One client connection. Named cursors (DECLARE/FETCH/CLOSE) are
+    # materialized in full when declared.
+    def send(self, kind, payload=b''):
+        self.request.sendall(kind + struct.pack('!i', len(payload) + 4) + payload)
+
+    def read_exact(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError
+            data += chunk
+        return data
+
+    def handle(self):
+        self.simulator = self.server.simulator
+        self.cursors = {}
+        self.in_txn = False
+        try:
+            self.startup()
+            while True:
+                kind = self.read_exact(1)
+                length = struct.unpack('!i', self.read_exact(4))[0]
+                payload = self.read_exact(length - 4)
+                if kind == b'X':
+                    return
+                if kind == b'Q':
+                    self.query(payload[:-1].decode())
+        except ConnectionError:
+            return
+
+    def startup(self):
+        while True:
+            length = struct.unpack('!i', self.read_exact(4))[0]
+            payload = self.read_exact(length - 4)
+            code = struct.unpack('!i', payload[:4])[0]
+            if code == 80877103:
+                self.request.sendall(b'N')
+                continue
+            break
+        self.send(b'R', struct.pack('!i', 0))
+        for key, value in (('server_version', '12.3'), ('client_encoding', 'UTF8'), ('DateStyle', 'ISO, MDY'),
+                           ('integer_datetimes', 'on'), ('standard_conforming_strings', 'on')):
+            self.send(b'S', key.encode() + b'\0' + value.encode() + b'\0')
+        self.send(b'K', struct.pack('!ii', 1, 1))
+        self.ready()
+
+    def ready(self):
+        self.send(b'Z', b'T' if self.in_txn else b'I')
+
+    def error(self, message):
+        self.send(b'E', b'SERROR\0C42000\0M' + message.encode() + b'\0\0')
+
+    def query(self, sql):
+        try:
+            for statement in split_statements(sql):
+                self.statement(statement)
+        except Exception as exc:
+            self.error(str(exc))
+        self.ready()
+
+    def statement(self, sql):
+        upper = sql.upper()
+        simulator = self.simulator
+        if upper in ('BEGIN', 'COMMIT', 'ROLLBACK'):
+            self.in_txn = upper == 'BEGIN'
+            self.send(b'C', upper.encode() + b'\0')
+            return
+        if upper.startswith('SET '):
+            self.send(b'C', b'SET\0')
+            return
+        declare = re.match(r'DECLARE\s+"?(\w+)"?\s+CURSOR\s+.*?\s+FOR\s+(.*)$', sql, flags=re.I | re.S)
+        if declare:
+            name, inner = declare.groups()
+            self.cursors[name] = self.run(inner)
+            self.send(b'C', b'DECLARE CURSOR\0')
+            return
+        fetch = re.match(r'FETCH\s+FORWARD\s+(\d+)\s+FROM\s+"?(\w+)"?', sql, flags=re.I)
+        if fetch:
+            size, name = int(fetch.group(1)), fetch.group(2)
+            description, rows = self.cursors[name]
+            self.cursors[name] = (description, rows[size:])
+            self.result(description, rows[:size], 'FETCH')
+            return
+        close = re.match(r'CLOSE\s+"?(\w+)"?', sql, flags=re.I)
+        if close:
+            self.cursors.pop(close.group(1), None)
+            self.send(b'C', b'CLOSE CURSOR\0')
+            return
+        add_column = re.match(r'ALTER\s+TABLE\s+(\w+)\s+ADD\s+COLUMN\s+IF\s+NOT\s+EXISTS\s+(\w+)\s+(\w+)', sql, flags=re.I)
+        if add_column:
+            table, column, column_type = add_column.groups()
+            with simulator.lock:
+                existing = [r[1] for r in simulator.db.execute(f'PRAGMA table_info({table})')]
+                if column not in existing:
+                    simulator.db.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+            self.send(b'C', b'ALTER TABLE\0')
+            return
+        description, rows = self.run(sql)
+        if description is None:
+            self.send(b'C', b'OK\0')
+        else:
+            self.result(description, rows, 'SELECT')
+
+    def run(self, sql):
+        simulator = self.simulator
+        with simulator.lock:
+            simulator.query_count += 1
+            wal_tables = re.findall(r"wal_transactions\('(\w+)'\)", sql)
+            if wal_tables:
+                simulator.wal_query_count += 1
+            if simulator.apply_seconds and re.search(r'wal_tables\(\)', sql):
+                simulator.apply_wal()
+            create = re.match(r'CREATE\s+TABLE\s+(IF\s+NOT\s+EXISTS\s+)?(\w+)\s*\(.*\)\s*timestamp\s*\(\s*(\w+)\s*\).*\bWAL\b', sql, flags=re.I | re.S)
+            insert = re.match(r'INSERT\s+INTO\s+(\w+)', sql, flags=re.I)
+            if insert and insert.group(1) in simulator.wal_timestamps and insert.group(1) not in simulator.tables:
+                cursor = simulator.insert(insert.group(1), rewrite(sql, simulator))
+            else:
+                cursor = simulator.db.execute(rewrite(sql, simulator))
+            if create:
+                simulator.create_wal(create.group(2), create.group(3))
+            rows = cursor.fetchall()
+            description = [d[0] for d in cursor.description] if cursor.description else None
+            if description and 'sequencerTxn' in description and wal_tables:
+                index = description.index('sequencerTxn')
+                name_index = description.index('tableName') if 'tableName' in description else None
+                for row in rows:
+                    table = row[name_index] if name_index is not None else wal_tables[0]
+                    simulator.observe(table, [row[index]])
+            return description, rows
+
+    def result(self, description, rows, tag):
+        # Column types are inferred from the values, timestamps from their format
+        oids = []
+        for i, _ in enumerate(description):
+            values = [row[i] for row in rows if row[i] is not None]
+            if values and all(isinstance(v, bool) for v in values):
+                oids.append(OID_BOOL)
+            elif values and all(isinstance(v, int) for v in values):
+                oids.append(OID_INT8)
+            elif values and all(isinstance(v, (int, float)) for v in values):
+                oids.append(OID_FLOAT8)
+            elif values and all(isinstance(v, str) and TS_PATTERN.match(v) for v in values):
+                oids.append(OID_TIMESTAMP)
+            else:
+                oids.append(OID_TEXT)
+        payload = struct.pack('!h', len(description))
+        for name, oid in zip(description, oids):
+            payload += name.encode() + b'\0' + struct.pack('!ihihih', 0, 0, oid, -1, -1, 0)
+        self.send(b'T', payload)
+        for row in rows:
+            payload = struct.pack('!h', len(row))
+            for value in row:
+                if value is None:
+                    payload += struct.pack('!i', -1)
+                else:
+                    data = str(value).encode()
+                    payload += struct.pack('!i', len(data)) + data
+            self.send(b'D', payload)
+        self.send(b'C', f'{tag} {len(rows)}'.encode() + b'\0')
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def serve(simulator, host='127.0.0.1', port=0):
+    # Serve in the background and start committing transactions. Port 0 picks a
+    # free port, see server.server_address.
+    server = Server((host, port), Handler)
+    server.simulator = simulator
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    threading.Thread(target=simulator.run, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a simulated QuestDB PGWire endpoint with a stream of WAL transactions.')
+    parser.add_argument('--host', default='127.0.0.1', help='The host to listen on.')
+    parser.add_argument('--port', type=int, default=8812, help='The port to listen on.')
+    parser.add_argument('--tables', default='smart_meters,trades', help='Comma-separated list of tables to simulate.')
+    parser.add_argument('--txn_rate', type=float, default=2.0, help='Average number of transactions per second per table.')
+    parser.add_argument('--rows_per_txn', type=int, default=50, help='Number of rows per transaction.')
+    parser.add_argument('--ooo_ratio', type=float, default=0.0, help='Fraction of transactions with out-of-order timestamps up to an hour old.')
+    parser.add_argument('--structure_change_every', type=int, default=0, help='Add a column to a table every this many of its transactions.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed, for reproducible runs.')
+    parser.add_argument('--apply_seconds', type=float, default=0.0, help='Time (in seconds) the writer of a table takes to apply each WAL transaction; 0 applies them on commit.')
+    args = parser.parse_args()
+
+    simulator = Simulator(args.tables.split(','), args.txn_rate, args.rows_per_txn, args.ooo_ratio, args.structure_change_every, args.seed, args.apply_seconds)
+    server = serve(simulator, args.host, args.port)
+    print(f"Serving {', '.join(simulator.tables)} on {server.server_address[0]}:{server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,115 @@
+import json
+import os
+import time
+
+from metrics import gauge
+from wal_poller import TRANSACTION_BATCH_SIZE
+
+STARTUP_SECONDS = gauge('questdb_tracker_startup_seconds', 'Time spent resuming the progress of every table at startup.')
+
+
+class Snapshot:
+    # Local JSON copy of the last checkpoints written to the tracking table, so
+    # a warm restart can resume without querying the server. It is only saved
+    # after the tracking table write succeeded, so it is never ahead of it; a
+    # stale snapshot only makes a restart redo some work.
+    def __init__(self, path, tracking_id):
+        self.path = path
+        self.tracking_id = tracking_id
+        self.tables = {}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'r') as file:
+            data = json.load(file)
+        if data.get('trackingId') != self.tracking_id:
+            print(f"Ignoring snapshot {self.path} written for tracking ID {data.get('trackingId')}")
+            return {}
+        self.tables = data['tables']
+        return self.tables
+
+    def save(self, entries):
+        # Write to a temporary file and rename it, so a crash leaves either the
+        # old or the new snapshot but never a partial one
+        self.tables.update(entries)
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, 'w') as file:
+            json.dump({'trackingId': self.tracking_id, 'savedAt': time.time(), 'tables': self.tables}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self.path)
+
+
+def latest_progress(cur, tracking_table, tracking_id, tables, columns=()):
+    # The latest progress row of every table in a single query. Returns
+    # table -> {'sequencerTxn': ..., <column>: ...}.
+    selected = ['sequencerTxn'] + list(columns)
+    cur.execute(f"""
+        SELECT tableName, {', '.join(selected)}
+        FROM {tracking_table}
+        WHERE trackingId = %s
+        LATEST ON timestamp
+        PARTITION BY tableName;
+    """, (tracking_id,))
+    wanted = set(tables)
+    return {row[0]: dict(zip(selected, row[1:])) for row in cur.fetchall() if row[0] in wanted and row[1] is not None}
+
+
+def transaction_versions(cur, txn_ids, batch_size=TRANSACTION_BATCH_SIZE):
+    # Look up the structure version of a given sequencerTxn per table, or of the
+    # latest transaction where the txn is None, with one round trip per
+    # batch_size tables. Returns table -> (sequencerTxn, structureVersion);
+    # tables whose transaction was not found are left out.
+    versions = {}
+    tables = list(txn_ids)
+    for start in range(0, len(tables), batch_size):
+        branches = []
+        for table in tables[start:start + batch_size]:
+            if txn_ids[table] is None:
+                branches.append(f"SELECT * FROM (SELECT '{table}' AS tableName, sequencerTxn, structureVersion FROM wal_transactions('{table}') ORDER BY sequencerTxn DESC LIMIT 1)")
+            else:
+                branches.append(f"SELECT '{table}' AS tableName, sequencerTxn, structureVersion FROM wal_transactions('{table}') WHERE sequencerTxn = {txn_ids[table]}")
+        cur.execute(" UNION ALL ".join(branches))
+        for table, txn, version in cur.fetchall():
+            versions[table] = (txn, version)
+    return versions
+
+
+def resume_tables(cur, tables, tracking_table=None, tracking_id=None, snapshot=None, columns=(), with_structure=True, started=None):
+    # Resume every table in a couple of bulk queries: the snapshot first, then
+    # the latest progress row in the tracking table, otherwise the latest WAL
+    # transaction. Returns table -> {'sequencerTxn', 'structureVersion', <column>...}.
+    # Without with_structure, structure versions are only looked up for tables
+    # that start from their latest transaction. When started (the monotonic time
+    # the script started at) is given, the startup time is reported.
+    resumed = {}
+    if snapshot:
+        saved = snapshot.load()
+        resumed = {table: dict(saved[table]) for table in tables if table in saved}
+    from_snapshot = len(resumed)
+
+    remaining = [table for table in tables if table not in resumed]
+    progress = {}
+    if remaining and tracking_table and tracking_id:
+        progress = latest_progress(cur, tracking_table, tracking_id, remaining, columns)
+
+    lookups = {table: progress[table]['sequencerTxn'] if table in progress else None for table in remaining}
+    if not with_structure:
+        lookups = {table: txn for table, txn in lookups.items() if txn is None}
+    versions = transaction_versions(cur, lookups) if lookups else {}
+
+    for table in remaining:
+        entry = progress.get(table, {'sequencerTxn': None})
+        txn, version = versions.get(table, (entry['sequencerTxn'], None))
+        # A table without any transaction yet starts from the beginning
+        entry['sequencerTxn'] = txn if txn is not None else 0
+        entry['structureVersion'] = version
+        resumed[table] = entry
+
+    if started is not None:
+        elapsed = time.monotonic() - started
+        STARTUP_SECONDS.set(elapsed)
+        print(f"Startup took {elapsed:.3f}s, resumed {len(tables)} tables: {from_snapshot} from snapshot, "
+              f"{len(progress)} from the tracking table, {len(remaining) - len(progress)} from their latest transaction")
+    return resumed
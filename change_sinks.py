@@ -0,0 +1,188 @@
+import datetime
+import json
+import os
+import queue
+import socket
+import sys
+import threading
+import time
+
+SINK_KINDS = ('jsonl', 'arrow', 'unix', 'fifo')
+
+# Queued by flush() to make the writer write its batch right away
+FLUSH = object()
+
+
+def encode_json(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+
+class ChangeSink:
+    # Emits change records from a background writer thread. emit() puts the
+    # record on a bounded queue and blocks while the queue is full, so a slow
+    # consumer slows the tracker down instead of growing memory. The writer
+    # hands records to write_batch() in batches of up to batch_size, or whatever
+    # has arrived after flush_interval seconds.
+    def __init__(self, batch_size=1000, flush_interval=1.0, queue_size=10000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+        self.thread.start()
+
+    def emit(self, record):
+        if self.error:
+            raise self.error
+        self.queue.put(record)
+
+    def flush(self):
+        # Block until everything emitted so far has been written
+        if self.error:
+            raise self.error
+        self.queue.put(FLUSH)
+        self.queue.join()
+        if self.error:
+            raise self.error
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        self.close_output()
+        if self.error:
+            raise self.error
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    record = self.queue.get(timeout=max(deadline - time.monotonic(), 0.001))
+                except queue.Empty:
+                    break
+                if record is FLUSH:
+                    self.queue.task_done()
+                    break
+                if record is None:
+                    self.queue.task_done()
+                    stopping = True
+                    break
+                batch.append(record)
+            try:
+                if batch and not self.error:
+                    self.write_batch(batch)
+            except Exception as exc:
+                self.error = exc
+            for _ in batch:
+                self.queue.task_done()
+
+    def write_batch(self, records):
+        raise NotImplementedError
+
+    def close_output(self):
+        pass
+
+
+class JsonlSink(ChangeSink):
+    # One JSON object per line to a file, a Unix stream socket or a FIFO
+    def __init__(self, stream, **kwargs):
+        self.stream = stream
+        super().__init__(**kwargs)
+
+    def write_batch(self, records):
+        payload = ''.join(json.dumps(record, default=encode_json) + '\n' for record in records)
+        self.stream.write(payload.encode('utf-8'))
+        self.stream.flush()
+
+    def close_output(self):
+        if self.stream is not sys.stdout.buffer:
+            self.stream.close()
+
+
+class ArrowSink(ChangeSink):
+    # Arrow IPC stream. Nested aggregates are flattened to <column>_<statistic>
+    # columns and the schema is fixed by the first batch.
+    def __init__(self, stream, **kwargs):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError("The arrow sink requires pyarrow: pip install pyarrow")
+        self.pyarrow = pyarrow
+        self.stream = stream
+        self.writer = None
+        self.schema = None
+        super().__init__(**kwargs)
+
+    def write_batch(self, records):
+        pa = self.pyarrow
+        rows = [flatten_record(record) for record in records]
+        if self.writer is None:
+            # Columns that are all null in the first batch cannot be typed, assume numeric aggregates
+            inferred = pa.Table.from_pylist(rows).schema
+            self.schema = pa.schema([
+                field.with_type(pa.float64()) if pa.types.is_null(field.type) else field
+                for field in inferred
+            ])
+            self.writer = pa.ipc.new_stream(self.stream, self.schema)
+        self.writer.write_table(pa.Table.from_pylist(rows, schema=self.schema))
+        self.stream.flush()
+
+    def close_output(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.stream is not sys.stdout.buffer:
+            self.stream.close()
+
+
+def flatten_record(record):
+    # {'aggregates': {'price': {'min': 1}}} becomes {'price_min': 1} and the
+    # values of a streamed row become plain columns; other nested dicts keep
+    # their key as a prefix, e.g. running_price_min
+    flat = {}
+    for key, value in record.items():
+        if not isinstance(value, dict):
+            flat[key] = value
+            continue
+        prefix = '' if key in ('aggregates', 'row') else f"{key}_"
+        for name, inner in value.items():
+            if isinstance(inner, dict):
+                for stat, stat_value in inner.items():
+                    flat[f"{prefix}{name}_{stat}"] = stat_value
+            else:
+                flat[f"{prefix}{name}"] = inner
+    return flat
+
+
+def open_sink(spec, batch_size=1000, flush_interval=1.0, queue_size=10000):
+    # spec is '<kind>:<path>' where kind is jsonl, arrow, unix (a listening Unix
+    # stream socket) or fifo (a named pipe); a path of '-' means stdout
+    kind, _, path = spec.partition(':')
+    if kind not in SINK_KINDS or not path:
+        raise ValueError(f"Invalid sink '{spec}', expected one of {', '.join(k + ':<path>' for k in SINK_KINDS)}")
+    kwargs = {'batch_size': batch_size, 'flush_interval': flush_interval, 'queue_size': queue_size}
+
+    if path == '-':
+        stream = sys.stdout.buffer
+    elif kind == 'unix':
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(path)
+        stream = client.makefile('wb')
+    elif kind == 'fifo':
+        if not os.path.exists(path):
+            os.mkfifo(path)
+        # Opening a FIFO for writing blocks until a reader opens it
+        stream = open(path, 'wb')
+    else:
+        stream = open(path, 'ab')
+
+    if kind == 'arrow':
+        return ArrowSink(stream, **kwargs)
+    return JsonlSink(stream, **kwargs)
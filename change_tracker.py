@@ -2,8 +2,22 @@ import psycopg2
 import time
 import sys
 import argparse
+import atexit
+from poll_scheduler import scheduler_from_args
+from wal_poller import fetch_transaction_windows
+from aggregate_state import AggregateState, DEFAULT_OPEN_BUCKETS, summary_headers, summary_values
+from change_sinks import open_sink
+from row_stream import RowStream, RowDeduplicator
+from plan_cache import PlanCache
+from checkpoints import CheckpointManager
+from bootstrap import Snapshot, resume_tables
+from metrics import start_metrics_server, install_profile_signals, POLL_SECONDS, QUERY_SECONDS, QUERY_FAILURES, TRANSACTIONS_PROCESSED, ROWS_PROCESSED, TXN_BACKLOG, LAST_PROCESSED_TXN
 
-def main(table_name, columns, dbname='qdb', user='admin', host='127.0.0.1', port=8812, password='quest', row_threshold=1000, check_interval=30, timestamp_column='timestamp', tracking_table=None, tracking_id=None):
+# wal_transactions() columns of the transaction window
+TRANSACTION_COLUMNS = ['sequencerTxn', 'minTimestamp', 'maxTimestamp', 'rowCount', 'structureVersion', 'timestamp']
+
+def main(table_name, columns, dbname='qdb', user='admin', host='127.0.0.1', port=8812, password='quest', row_threshold=1000, check_interval=30, timestamp_column='timestamp', tracking_table=None, tracking_id=None, min_interval=None, max_interval=None, jitter=0.0, checkpoint_state=False, sink=None, sink_batch_size=1000, sink_flush_interval=1.0, sink_queue_size=10000, mode='aggregate', itersize=2000, dedup_window=3600, dedup_max_rows=1000000, on_row=None, metrics_port=None, profile_path=None, checkpoint_interval=0, checkpoint_txns=0, snapshot_path=None, bucket_seconds=3600, open_buckets=DEFAULT_OPEN_BUCKETS):
+    started = time.monotonic()
     conn = psycopg2.connect(
         dbname=dbname,
         user=user,
@@ -13,7 +27,34 @@ def main(table_name, columns, dbname='qdb', user='admin', host='127.0.0.1', port
     )
     cur = conn.cursor()
     
-    # Initial query to get the latest transaction ID and structure version
+    column_list = columns.split(',')
+    
+    # Expose metrics over HTTP and profiling hooks on signals if requested
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    if profile_path:
+        install_profile_signals(profile_path)
+    
+    # Structured change records go to the sink instead of stdout; flush whatever is buffered on exit
+    change_sink = None
+    if sink:
+        change_sink = open_sink(sink, sink_batch_size, sink_flush_interval, sink_queue_size)
+        atexit.register(change_sink.close)
+    aggregate_state = AggregateState(column_list, bucket_seconds, open_buckets)
+    
+    # Validated columns and the aggregation statement are cached per structure version
+    plan_cache = PlanCache(table_name, column_list, timestamp_column, bucket_seconds)
+    
+    # Rows mode streams the changed rows themselves instead of aggregating them
+    row_stream = None
+    if mode == 'rows':
+        row_stream = RowStream(conn, table_name, column_list, timestamp_column, itersize)
+        deduplicator = RowDeduplicator(dedup_window, dedup_max_rows)
+    
+    # Progress is written to the tracking table in batches by the checkpoint manager
+    checkpoints = None
+    snapshot = None
+    
     if tracking_table and tracking_id:
         # Create tracking table if it does not exist
         cur.execute(f"""
@@ -21,110 +62,175 @@ def main(table_name, columns, dbname='qdb', user='admin', host='127.0.0.1', port
                 timestamp TIMESTAMP,
                 trackingId SYMBOL,
                 tableName SYMBOL,
-                sequencerTxn LONG
+                sequencerTxn LONG,
+                aggState VARCHAR
             ) timestamp (timestamp) PARTITION BY DAY WAL DEDUP UPSERT KEYS(timestamp, trackingId, tableName);
         """)
+        # Tracking tables created by older versions have no aggregate state column
+        cur.execute(f"ALTER TABLE {tracking_table} ADD COLUMN IF NOT EXISTS aggState VARCHAR")
         conn.commit()
-        
-        # Get the latest transaction ID from tracking table
-        cur.execute(f"""
-            SELECT tableName, sequencerTxn
-            FROM {tracking_table}
-            WHERE trackingId = '{tracking_id}'
-            LATEST ON timestamp
-            PARTITION BY tableName;
-        """)
-        latest_txn_record = cur.fetchone()
-        
-        if latest_txn_record:
-            latest_txn_id = latest_txn_record[1]
-            cur.execute(f"SELECT structureVersion FROM wal_transactions('{table_name}') WHERE sequencerTxn = {latest_txn_id} LIMIT 1")
-            latest_structure_version = cur.fetchone()[0]
+        # A local snapshot of the checkpoints allows resuming without querying the server
+        snapshot = Snapshot(snapshot_path, tracking_id) if snapshot_path else None
+        # Change records are written out before the checkpoint that covers them
+        checkpoints = CheckpointManager(conn, tracking_table, tracking_id, checkpoint_interval, checkpoint_txns, snapshot, before_flush=change_sink.flush if change_sink else None)
+        checkpoints.flush_on_exit()
+    
+    # Resume from the snapshot or the tracking table (with the checkpointed aggregate state), otherwise from the latest transaction
+    progress = resume_tables(cur, [table_name], tracking_table, tracking_id, snapshot, columns=('aggState',) if checkpoint_state else (), started=started)[table_name]
+    latest_txn_id, latest_structure_version = progress['sequencerTxn'], progress['structureVersion']
+    if checkpoint_state and progress.get('aggState'):
+        restored = AggregateState.decode(column_list, bucket_seconds, progress['aggState'], open_buckets)
+        if restored:
+            aggregate_state = restored
+            print(f"Restored aggregate state as of transaction ID: {latest_txn_id}")
         else:
-            cur.execute(f"SELECT sequencerTxn, structureVersion FROM wal_transactions('{table_name}') ORDER BY sequencerTxn DESC LIMIT 1")
-            latest_txn_id, latest_structure_version = cur.fetchone()
-    else:
-        cur.execute(f"SELECT sequencerTxn, structureVersion FROM wal_transactions('{table_name}') ORDER BY sequencerTxn DESC LIMIT 1")
-        latest_txn_id, latest_structure_version = cur.fetchone()
+            print(f"Checkpointed aggregate state does not use buckets of {bucket_seconds} seconds, starting with an empty state")
     
     print(f"Starting from transaction ID: {latest_txn_id} with structure version: {latest_structure_version}")
 
+    scheduler = scheduler_from_args([table_name], check_interval, min_interval, max_interval, jitter)
+
     while True:
-        time.sleep(check_interval)
+        scheduler.wait()
+        if checkpoints:
+            checkpoints.maybe_flush()
         
-        # Query to get new transactions
-        cur.execute(f"""
-            SELECT sequencerTxn, minTimestamp, maxTimestamp, rowCount, structureVersion 
-            FROM wal_transactions('{table_name}') 
-            WHERE sequencerTxn > {latest_txn_id}
-        """)
-        new_transactions = cur.fetchall()
+        # Fetch the new transactions into a columnar window
+        with POLL_SECONDS.time():
+            window = fetch_transaction_windows(cur, {table_name: latest_txn_id}, TRANSACTION_COLUMNS)[table_name]
+        TXN_BACKLOG.set(window.last_txn - latest_txn_id if window else 0, table=table_name)
         
-        if not new_transactions:
+        # Adapt the poll interval to the transaction arrival rate
+        scheduler.observe(table_name, window)
+        
+        if not window:
             continue
 
         # Check for structure version changes
-        for txn in new_transactions:
-            if txn[4] != latest_structure_version:
-                print(f"Structure version changed from {latest_structure_version} to {txn[4]} on transaction {txn[0]}")
-                latest_structure_version = txn[4]
+        for txn, structure_version in window.structure_changes(latest_structure_version):
+            print(f"Structure version changed from {latest_structure_version} to {structure_version} on transaction {txn}")
+            latest_structure_version = structure_version
 
-        # Aggregate the number of rows in new transactions, ignoring None values
-        total_new_rows = sum(txn[3] for txn in new_transactions if txn[3] is not None)
+        # Row count and timestamp range of the new transactions in one pass, ignoring missing values
+        summary = window.summary()
+        total_new_rows = summary['rows'] or 0
         
         if total_new_rows < row_threshold:
             continue
 
-        # Find the min and max timestamps from new transactions, ignoring None values
-        min_timestamp = min((txn[1] for txn in new_transactions if txn[1] is not None), default=None)
-        max_timestamp = max((txn[2] for txn in new_transactions if txn[2] is not None), default=None)
+        min_timestamp = summary['min_timestamp']
+        max_timestamp = summary['max_timestamp']
 
         if min_timestamp is None or max_timestamp is None:
             continue
 
-        # Construct the aggregation query
-        column_list = columns.split(',')
-        aggregations = ', '.join([
-            f"first({col}) AS {col}_first, last({col}) AS {col}_last, min({col}) AS {col}_min, max({col}) AS {col}_max, avg({col}) AS {col}_avg"
-            for col in column_list
-        ])
-        query = f"""
-        SELECT {aggregations}
-        FROM {table_name}
-        WHERE {timestamp_column} BETWEEN '{min_timestamp}' AND '{max_timestamp}'
-        """
-
-        # Execute the aggregation query
-        cur.execute(query)
-        results = cur.fetchone()
-        
-        # Output the results
-        print(f"Aggregated results from {min_timestamp} to {max_timestamp}:")
-        print(f"Included Transactions: {new_transactions[0][0]} to {new_transactions[-1][0]}")
-        print(f"Total Rows: {total_new_rows}")
-
-        # Print column headers
-        headers = [f"{col}_first" for col in column_list] + \
-                  [f"{col}_last" for col in column_list] + \
-                  [f"{col}_min" for col in column_list] + \
-                  [f"{col}_max" for col in column_list] + \
-                  [f"{col}_avg" for col in column_list]
-        print(", ".join(headers))
+        if row_stream:
+            try:
+                # Look the columns up again only when the structure version changed
+                plan = plan_cache.plan(cur, latest_structure_version)
+            except psycopg2.Error as exc:
+                conn.rollback()
+                plan_cache.invalidate()
+                QUERY_FAILURES.inc(query='columns')
+                print(f"Looking up the columns failed, retrying on the next poll: {str(exc).strip()}")
+                continue
+            row_stream.select([col for col in column_list if col in plan.column_types])
+            emitted = 0
+            duplicates = deduplicator.duplicates
+            with QUERY_SECONDS.time(query='rows'):
+                for row in deduplicator.filter(row_stream.rows(min_timestamp, max_timestamp)):
+                    values = dict(zip(row_stream.columns, row))
+                    if on_row:
+                        on_row(table_name, values)
+                    elif change_sink:
+                        change_sink.emit({
+                            'type': 'row',
+                            'table': table_name,
+                            'txn_end': window.last_txn,
+                            'row': values
+                        })
+                    else:
+                        print(", ".join(map(str, row)))
+                    emitted += 1
+            if not change_sink:
+                print(f"Streamed {emitted} rows from transactions {window.first_txn} to {window.last_txn} "
+                      f"({deduplicator.duplicates - duplicates} already emitted rows skipped)")
+        else:
+            # Append the rows of transactions past everything merged so far, and recompute the
+            # buckets touched by out-of-order transactions, so no row is ever counted twice
+            recomputed, append, late = aggregate_state.ranges(
+                (txn_min_timestamp, txn_max_timestamp)
+                for txn_min_timestamp, txn_max_timestamp in window.rows(('minTimestamp', 'maxTimestamp'))
+                if txn_min_timestamp is not None and txn_max_timestamp is not None
+            )
+            if late:
+                print(f"Skipping the rows of {late} out-of-order transactions before {aggregate_state.folded_until}, "
+                      f"their buckets are already folded into the running totals")
+            ranges = recomputed + ([append] if append else [])
+            buckets = {}
+            try:
+                # Look the columns up again only when the structure version changed
+                plan = plan_cache.plan(cur, latest_structure_version)
+                # Nothing is left to read when every new transaction lies in folded buckets
+                if ranges:
+                    with QUERY_SECONDS.time(query='aggregate'):
+                        cur.execute(*plan.query(ranges))
+                        buckets = plan.buckets_from_rows(cur.fetchall())
+            except psycopg2.Error as exc:
+                # The table metadata can lag behind the WAL after an ALTER TABLE. Rebuild the
+                # plan and retry the same transactions on the next poll instead of crashing.
+                conn.rollback()
+                plan_cache.invalidate()
+                QUERY_FAILURES.inc(query='aggregate')
+                print(f"Aggregation query failed, retrying with a fresh plan: {str(exc).strip()}")
+                continue
+            delta = aggregate_state.apply(recomputed, buckets)
+            recomputed_buckets = sum(aggregate_state.index(end) - aggregate_state.index(start) for start, end in recomputed)
         
-        # Print the results
-        print(", ".join(map(str, results)))
+            # Output the results
+            if change_sink:
+                change_sink.emit({
+                    'type': 'aggregate',
+                    'table': table_name,
+                    'txn_start': window.first_txn,
+                    'txn_end': window.last_txn,
+                    'row_count': total_new_rows,
+                    'structure_version': latest_structure_version,
+                    'min_timestamp': min_timestamp,
+                    'max_timestamp': max_timestamp,
+                    'detection_lag': scheduler.detection_lag(table_name),
+                    'recomputed_buckets': recomputed_buckets,
+                    'aggregates': {col: delta[col].summary() for col in column_list},
+                    'running': {col: aggregate_state.aggregates[col].summary() for col in column_list}
+                })
+            else:
+                print(f"Aggregated results from {min_timestamp} to {max_timestamp}:")
+                print(f"Included Transactions: {window.first_txn} to {window.last_txn}")
+                print(f"Total Rows: {total_new_rows}")
+                print(f"Recomputed Buckets: {recomputed_buckets}")
+                if scheduler.detection_lag(table_name) is not None:
+                    print(f"Detection Lag: {scheduler.detection_lag(table_name):.3f}s")
+
+                # Print column headers
+                headers = summary_headers(column_list)
+                print(", ".join(headers))
+            
+                # Print the results for the new rows (and whole recomputed buckets) and the running totals
+                print(", ".join(map(str, summary_values(delta, column_list))))
+                print("Running Totals:")
+                print(", ".join(map(str, summary_values(aggregate_state.aggregates, column_list))))
         
         # Update the latest transaction ID
-        latest_txn_id = new_transactions[-1][0]
+        latest_txn_id = window.last_txn
+        TRANSACTIONS_PROCESSED.inc(len(window), table=table_name)
+        ROWS_PROCESSED.inc(total_new_rows, table=table_name)
+        TXN_BACKLOG.set(0, table=table_name)
+        LAST_PROCESSED_TXN.set(latest_txn_id, table=table_name)
 
-        # Update tracking table with the latest transaction
-        if tracking_table and tracking_id:
-            timestamp_now = time.strftime('%Y-%m-%dT%H:%M:%S')
-            cur.execute(f"""
-                INSERT INTO {tracking_table} (timestamp, trackingId, tableName, sequencerTxn)
-                VALUES ('{timestamp_now}', '{tracking_id}', '{table_name}', {latest_txn_id})
-            """)
-            conn.commit()
+        # Checkpoint the latest transaction, together with the aggregate state it includes
+        if checkpoints:
+            checkpoints.record(table_name, latest_txn_id, len(window), latest_structure_version, aggState=aggregate_state.encode() if checkpoint_state else None)
+            checkpoints.maybe_flush()
 
     cur.close()
     conn.close()
@@ -134,6 +240,9 @@ if __name__ == "__main__":
     parser.add_argument('--table_name', required=True, help='The name of the table to monitor.')
     parser.add_argument('--row_threshold', type=int, default=1000, help='The number of rows to trigger aggregation.')
     parser.add_argument('--check_interval', type=int, default=30, help='The interval (in seconds) to check for new transactions.')
+    parser.add_argument('--min_interval', type=float, help='Enable adaptive polling with this minimum interval (in seconds) under bursts.')
+    parser.add_argument('--max_interval', type=float, help='The maximum interval (in seconds) an idle table backs off to (default: check_interval).')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random jitter applied to each poll interval, as a fraction of the interval.')
     parser.add_argument('--columns', required=True, help='Comma-separated list of columns to aggregate.')
     parser.add_argument('--timestamp_column', default='timestamp', help='The name of the timestamp column.')
     parser.add_argument('--dbname', default='qdb', help='The name of the database.')
@@ -143,8 +252,28 @@ if __name__ == "__main__":
     parser.add_argument('--password', default='quest', help='The database password.')
     parser.add_argument('--tracking_table', help='The name of the tracking table.')
     parser.add_argument('--tracking_id', help='The tracking ID for this run.')
+    parser.add_argument('--sink', help='Emit structured change records instead of text: jsonl:<path>, arrow:<path>, unix:<socket path> or fifo:<path> (a path of - means stdout).')
+    parser.add_argument('--sink_batch_size', type=int, default=1000, help='Maximum number of change records written per batch.')
+    parser.add_argument('--sink_flush_interval', type=float, default=1.0, help='Maximum time (in seconds) a change record waits in the sink buffer.')
+    parser.add_argument('--sink_queue_size', type=int, default=10000, help='Number of buffered change records after which the tracker blocks until the sink catches up.')
+    parser.add_argument('--checkpoint_state', action='store_true', help='Checkpoint the running aggregate state to the tracking table and restore it on restart.')
+    parser.add_argument('--checkpoint_interval', type=float, default=0, help='Write progress to the tracking table at most every this many seconds (default: after every trigger).')
+    parser.add_argument('--checkpoint_txns', type=int, default=0, help='Write progress to the tracking table once this many transactions have been processed since the last write.')
+    parser.add_argument('--snapshot_path', help='Keep a local snapshot of the checkpoints in this file and resume from it on restart.')
+    parser.add_argument('--metrics_port', type=int, help='Serve Prometheus metrics on http://127.0.0.1:<port>/metrics.')
+    parser.add_argument('--profile_path', help='Toggle a cProfile session with SIGUSR1 and write it to this path; SIGUSR2 dumps all thread stacks.')
+    parser.add_argument('--mode', choices=['aggregate', 'rows'], default='aggregate', help='Report aggregates of the new rows, or stream the new rows themselves.')
+    parser.add_argument('--itersize', type=int, default=2000, help='Number of rows fetched from the server at a time in rows mode.')
+    parser.add_argument('--dedup_max_rows', type=int, default=1000000, help='Maximum number of emitted rows remembered in rows mode; the oldest are forgotten first.')
+    parser.add_argument('--bucket_seconds', type=float, default=3600, help='Size (in seconds) of the time buckets the running aggregate state is kept in; out-of-order transactions recompute the buckets they touch.')
+    parser.add_argument('--open_buckets', type=int, default=DEFAULT_OPEN_BUCKETS, help='Number of most recent time buckets kept for out-of-order transactions to recompute; older buckets are folded into the running totals.')
+    parser.add_argument('--dedup_window', type=float, default=3600, help='How far (in seconds) behind the newest row already emitted rows are remembered to skip them in overlapping windows.')
 
     args = parser.parse_args()
+    if args.mode == 'rows' and args.checkpoint_state:
+        parser.error('--checkpoint_state only applies to aggregate mode')
+    if args.snapshot_path and not (args.tracking_table and args.tracking_id):
+        parser.error('--snapshot_path requires --tracking_table and --tracking_id')
 
-    main(args.table_name, args.columns, args.dbname, args.user, args.host, args.port, args.password, args.row_threshold, args.check_interval, args.timestamp_column, args.tracking_table, args.tracking_id)
+    main(args.table_name, args.columns, args.dbname, args.user, args.host, args.port, args.password, args.row_threshold, args.check_interval, args.timestamp_column, args.tracking_table, args.tracking_id, min_interval=args.min_interval, max_interval=args.max_interval, jitter=args.jitter, checkpoint_state=args.checkpoint_state, sink=args.sink, sink_batch_size=args.sink_batch_size, sink_flush_interval=args.sink_flush_interval, sink_queue_size=args.sink_queue_size, mode=args.mode, itersize=args.itersize, dedup_window=args.dedup_window, dedup_max_rows=args.dedup_max_rows, metrics_port=args.metrics_port, profile_path=args.profile_path, checkpoint_interval=args.checkpoint_interval, checkpoint_txns=args.checkpoint_txns, snapshot_path=args.snapshot_path, bucket_seconds=args.bucket_seconds, open_buckets=args.open_buckets)
 
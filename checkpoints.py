@@ -0,0 +1,122 @@
+import atexit
+import signal
+import sys
+import time
+
+import psycopg2
+
+from poll_scheduler import utc_now
+from metrics import TRACKING_WRITE_SECONDS, TRACKING_WRITE_FAILURES
+
+
+class CheckpointManager:
+    # Write-behind progress for the tracking table. record() only keeps the
+    # latest progress of each table in memory; flush() writes all of them as a
+    # single multi-row insert and one commit, so many triggers become one WAL
+    # transaction on the tracking table instead of one per table per trigger.
+    # Progress is only recorded after the work it covers has succeeded, so a
+    # crash can only lose checkpoints, which makes a restart redo some work but
+    # never skip any. After every flush the checkpoints are also saved to the
+    # optional local snapshot. before_flush is called before anything is
+    # written, so output that is still buffered, such as change records, is
+    # delivered before the progress that covers it.
+    def __init__(self, conn, tracking_table, tracking_id, flush_interval=0, flush_txns=0, snapshot=None, before_flush=None):
+        self.conn = conn
+        self.tracking_table = tracking_table
+        self.tracking_id = tracking_id
+        self.flush_interval = flush_interval
+        self.flush_txns = flush_txns
+        self.snapshot = snapshot
+        self.before_flush = before_flush
+        self.pending = {}
+        self.structure_versions = {}
+        self.pending_txns = 0
+        self.last_flush = time.monotonic()
+
+    def record(self, table, sequencer_txn, txn_count=0, structure_version=None, **columns):
+        # columns are extra tracking table columns such as templateHash. A None
+        # value does not replace a value that is still pending, so a template
+        # stored by an earlier, coalesced checkpoint is not lost. The structure
+        # version is only kept in the snapshot.
+        entry = self.pending.get(table)
+        if entry is None:
+            entry = self.pending[table] = {'sequencerTxn': sequencer_txn}
+        entry['sequencerTxn'] = max(entry['sequencerTxn'], sequencer_txn)
+        for name, value in columns.items():
+            if value is not None or name not in entry:
+                entry[name] = value
+        self.pending_txns += txn_count
+        if structure_version is not None:
+            self.structure_versions[table] = structure_version
+
+    def discard(self, table):
+        # Drop the pending progress of a table this process no longer owns
+        self.pending.pop(table, None)
+        self.structure_versions.pop(table, None)
+
+    def due(self):
+        if not self.pending:
+            return False
+        if not self.flush_interval and not self.flush_txns:
+            return True
+        if self.flush_interval and time.monotonic() - self.last_flush >= self.flush_interval:
+            return True
+        return bool(self.flush_txns) and self.pending_txns >= self.flush_txns
+
+    def maybe_flush(self):
+        # The polling loop keeps running while the tracking table cannot be
+        # written: the checkpoints stay pending and the next due flush retries
+        # them. Errors of before_flush are not database errors and propagate.
+        if not self.due():
+            return
+        try:
+            self.flush()
+        except psycopg2.Error as exc:
+            TRACKING_WRITE_FAILURES.inc()
+            # Back off for one flush interval before retrying
+            self.last_flush = time.monotonic()
+            print(f"Writing checkpoints to {self.tracking_table} failed, keeping {len(self.pending)} pending for a retry: {str(exc).strip()}")
+
+    def flush(self):
+        # Write everything pending now. On failure the checkpoints stay pending
+        # for the next flush and the error is raised.
+        if not self.pending:
+            return
+        if self.before_flush:
+            self.before_flush()
+        columns = sorted({name for entry in self.pending.values() for name in entry})
+        now = utc_now()
+        rows = [
+            [now, self.tracking_id, table] + [entry.get(name) for name in columns]
+            for table, entry in sorted(self.pending.items())
+        ]
+        cur = self.conn.cursor()
+        try:
+            with TRACKING_WRITE_SECONDS.time():
+                cur.execute(
+                    f"INSERT INTO {self.tracking_table} (timestamp, trackingId, tableName, {', '.join(columns)}) VALUES "
+                    + ", ".join(["(" + ", ".join(["%s"] * (len(columns) + 3)) + ")"] * len(rows)),
+                    [value for row in rows for value in row]
+                )
+                self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cur.close()
+        if self.snapshot:
+            # Templates can be large and are not needed to resume
+            self.snapshot.save({
+                table: dict({name: value for name, value in entry.items() if name != 'template64'}, structureVersion=self.structure_versions.get(table))
+                for table, entry in self.pending.items()
+            })
+        self.pending = {}
+        self.pending_txns = 0
+        self.last_flush = time.monotonic()
+
+    def flush_on_exit(self):
+        # Flush pending checkpoints on a clean exit, including SIGTERM, which
+        # otherwise ends the process without running exit handlers
+        atexit.register(self.flush)
+        if signal.getsignal(signal.SIGTERM) is signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
@@ -0,0 +1,102 @@
+import datetime
+import math
+import re
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+SAMPLE_BY_PATTERN = re.compile(r'SAMPLE\s+BY\s+(\d+)([a-zA-Z])\b', re.IGNORECASE)
+
+# Fixed-size SAMPLE BY units. Months and years have no fixed size.
+SAMPLE_BY_UNITS = {
+    'U': 0.000001,
+    'T': 0.001,
+    's': 1,
+    'm': 60,
+    'h': 3600,
+    'd': 86400,
+    'w': 604800,
+}
+
+
+def sample_by_seconds(sql_text):
+    # The SAMPLE BY granularity of a SQL template in seconds, or None if it has no SAMPLE BY
+    match = SAMPLE_BY_PATTERN.search(sql_text)
+    if not match:
+        return None
+    amount, unit = int(match.group(1)), match.group(2)
+    if unit not in SAMPLE_BY_UNITS:
+        raise ValueError(f"SAMPLE BY {amount}{unit} has no fixed bucket size, use --bucket_seconds instead")
+    return amount * SAMPLE_BY_UNITS[unit]
+
+
+class DirtyBuckets:
+    # Set of dirty time buckets kept as sorted, non-overlapping [start, end)
+    # ranges of bucket indexes. Ranges are aligned to bucket_seconds since the
+    # epoch, which matches how SAMPLE BY aligns fixed-size buckets in UTC, so
+    # each materialization recomputes whole buckets only. An end of None means
+    # the range is open-ended.
+    def __init__(self, bucket_seconds):
+        if bucket_seconds <= 0:
+            raise ValueError(f"Invalid bucket size: {bucket_seconds}")
+        self.bucket = datetime.timedelta(seconds=bucket_seconds)
+        self.ranges = []
+        self.stats = {
+            'marks': 0,
+            'rows_marked': 0,
+            'rows_coalesced': 0,
+            'buckets_spanned': 0,
+            'buckets_materialized': 0,
+            'materializations': 0
+        }
+
+    def __bool__(self):
+        return bool(self.ranges)
+
+    def index(self, timestamp):
+        return math.floor((timestamp - EPOCH) / self.bucket)
+
+    def mark(self, start, end=None, rows=0):
+        low = self.index(start)
+        high = self.index(end) + 1 if end is not None else math.inf
+        self.stats['marks'] += 1
+        self.stats['rows_marked'] += rows
+        # Rows landing in buckets that are already dirty cost no extra materialization
+        if any(range_low < high and low < range_high for range_low, range_high in self.ranges):
+            self.stats['rows_coalesced'] += rows
+        self._add(low, high)
+
+    def restore(self, ranges):
+        # Mark ranges returned by drain() dirty again, such as those of a failed materialization
+        for start, end in ranges:
+            self._add(self.index(start), self.index(end) if end is not None else math.inf)
+
+    def _add(self, low, high):
+        merged = []
+        for range_low, range_high in self.ranges:
+            if range_high < low or high < range_low:
+                merged.append((range_low, range_high))
+            else:
+                low, high = min(low, range_low), max(high, range_high)
+        merged.append((low, high))
+        self.ranges = sorted(merged)
+
+    def drain(self):
+        # Return the merged dirty ranges as (start, end) timestamps and clear them
+        ranges = [
+            (EPOCH + low * self.bucket, None if high == math.inf else EPOCH + high * self.bucket)
+            for low, high in self.ranges
+        ]
+        if self.ranges and self.ranges[-1][1] != math.inf:
+            # A single [min, max] range would have recomputed every bucket in between
+            self.stats['buckets_spanned'] += self.ranges[-1][1] - self.ranges[0][0]
+            self.stats['buckets_materialized'] += sum(high - low for low, high in self.ranges)
+        if self.ranges:
+            self.stats['materializations'] += 1
+        self.ranges = []
+        return ranges
+
+    def summary(self):
+        saved = self.stats['buckets_spanned'] - self.stats['buckets_materialized']
+        return (f"{self.stats['marks']} dirty ranges merged into {self.stats['materializations']} materializations, "
+                f"{self.stats['buckets_materialized']} buckets materialized, {saved} buckets saved, "
+                f"{self.stats['rows_coalesced']} of {self.stats['rows_marked']} rows coalesced into already dirty buckets")
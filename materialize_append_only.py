@@ -2,9 +2,43 @@ import psycopg2
 import time
 import sys
 import argparse
-import base64
+import datetime
+import multiprocessing
+import signal
+import socket
+import os
+from poll_scheduler import scheduler_from_args
+from wal_poller import fetch_transaction_windows
+from table_executor import TableExecutor, OrderedResults
+from sql_template import SqlTemplate, lookback_filter, lookback_range_filter, bucket_range_filter
+from dirty_buckets import DirtyBuckets, sample_by_seconds
+from sharding import LeaseManager
+from checkpoints import CheckpointManager
+from bootstrap import Snapshot, resume_tables
+from backfill import Backfill
+from wal_throttle import throttle_from_args
+from metrics import start_metrics_server, install_profile_signals, POLL_SECONDS, QUERY_SECONDS, QUERY_FAILURES, TRANSACTIONS_PROCESSED, ROWS_PROCESSED, TXN_BACKLOG, LAST_PROCESSED_TXN
 
-def main(table_names, transaction_threshold, sql_template_path, check_interval, timestamp_columns, lookback_seconds, dbname='qdb', user='admin', host='127.0.0.1', port=8812, password='quest', tracking_table=None, tracking_id=None):
+# wal_transactions() columns of the transaction windows
+TRANSACTION_COLUMNS = ['sequencerTxn', 'timestamp', 'rowCount']
+
+def materialize(conn, sql_query, params, query_name='materialize'):
+    cur = conn.cursor()
+    
+    # Execute the query
+    try:
+        with QUERY_SECONDS.time(query=query_name):
+            cur.execute(sql_query, params)
+            conn.commit()
+    except Exception:
+        QUERY_FAILURES.inc(query=query_name)
+        raise
+    print("Executed query:")
+    print(cur.query.decode())
+    cur.close()
+
+def main(table_names, transaction_threshold, sql_template_path, check_interval, timestamp_columns, lookback_seconds, dbname='qdb', user='admin', host='127.0.0.1', port=8812, password='quest', tracking_table=None, tracking_id=None, min_interval=None, max_interval=None, jitter=0.0, workers=1, max_in_flight=1, shard_worker_id=None, lease_seconds=30, bucket_seconds=None, metrics_port=None, profile_path=None, checkpoint_interval=0, checkpoint_txns=0, snapshot_path=None, backfill_txns=0, backfill_seconds=None, target_table=None, max_apply_lag=None, max_defer_seconds=None):
+    started = time.monotonic()
     conn = psycopg2.connect(
         dbname=dbname,
         user=user,
@@ -14,14 +48,32 @@ def main(table_names, transaction_threshold, sql_template_path, check_interval,
     )
     cur = conn.cursor()
     
+    # Expose metrics over HTTP and profiling hooks on signals if requested
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    if profile_path:
+        install_profile_signals(profile_path)
+    
     table_info = {}
     
-    # Read the SQL template and encode it in base64
-    with open(sql_template_path, 'r') as file:
-        sql_template = file.read()
-    template64 = base64.b64encode(sql_template.encode('utf-8')).decode('utf-8')
+    # Compile the SQL template once; it is only re-read when the file changes
+    sql_template = SqlTemplate(sql_template_path)
+    query_name = os.path.basename(sql_template_path)
+    stored_template_hash = None
+    
+    # Optionally coalesce the lookback windows of all tables triggering in the same cycle into
+    # one materialization, aligned to the SAMPLE BY of the template
+    dirty_buckets = None
+    if bucket_seconds is not None:
+        bucket_seconds = bucket_seconds or sample_by_seconds(sql_template.text)
+        if not bucket_seconds:
+            raise ValueError(f"No SAMPLE BY found in {sql_template_path}, use a positive --bucket_seconds")
+        dirty_buckets = DirtyBuckets(bucket_seconds)
     
-    # Initialize tracking state from tracking table if provided
+    # Initialize tracking state from tracking table if provided. Progress is written to it in
+    # batches by the checkpoint manager.
+    checkpoints = None
+    snapshot = None
     if tracking_table and tracking_id:
         cur.execute(f"""
             CREATE TABLE IF NOT EXISTS {tracking_table} (
@@ -29,97 +81,252 @@ def main(table_names, transaction_threshold, sql_template_path, check_interval,
                 trackingId SYMBOL,
                 tableName SYMBOL,
                 sequencerTxn LONG,
+                templateHash SYMBOL,
                 template64 VARCHAR
             ) timestamp (timestamp) PARTITION BY DAY WAL DEDUP UPSERT KEYS (timestamp, trackingId, tableName);
         """)
+        # Tracking tables created by older versions have no template hash column
+        cur.execute(f"ALTER TABLE {tracking_table} ADD COLUMN IF NOT EXISTS templateHash SYMBOL")
         conn.commit()
+        # A local snapshot of the checkpoints allows resuming without querying the server
+        snapshot = Snapshot(snapshot_path, tracking_id) if snapshot_path else None
+        checkpoints = CheckpointManager(conn, tracking_table, tracking_id, checkpoint_interval, checkpoint_txns, snapshot)
+        checkpoints.flush_on_exit()
+    
+    # In sharded mode tables are only processed while this worker holds their lease
+    lease_manager = None
+    active_tables = table_names
+    if shard_worker_id:
+        if not (tracking_table and tracking_id):
+            raise ValueError("Sharded mode requires --tracking_table and --tracking_id")
+        if snapshot:
+            raise ValueError("Sharded workers resume from the tracking table, --snapshot_path is not supported")
+        if backfill_txns:
+            raise ValueError("Sharded workers acquire tables while running, --backfill_txns is not supported")
+        lease_manager = LeaseManager(conn, tracking_table, tracking_id, shard_worker_id, lease_seconds)
+        lease_manager.create_columns()
+        active_tables = []
+    
+    # Resume every table in bulk, from the snapshot or the tracking table, otherwise from its latest transaction
+    resumed = resume_tables(cur, active_tables, tracking_table, tracking_id, snapshot, with_structure=False, started=started)
+    for table in active_tables:
+        table_info[table] = {
+            'latest_txn_id': resumed[table]['sequencerTxn'],
+            'transaction_count': 0
+        }
+        print(f"Starting from transaction ID: {table_info[table]['latest_txn_id']} for table {table}")
+
+    scheduler = scheduler_from_args(active_tables, check_interval, min_interval, max_interval, jitter)
+    
+    # Optionally defer materializations while the target table is behind on applying its WAL
+    throttle = throttle_from_args(sql_template, target_table, max_apply_lag, max_defer_seconds)
+    
+    # With more than one worker the tables are materialized in parallel on pooled connections
+    executor = None
+    pending = OrderedResults()
+    if workers > 1:
+        connect_kwargs = {'dbname': dbname, 'user': user, 'host': host, 'port': port, 'password': password}
+        executor = TableExecutor(connect_kwargs, workers, max_in_flight)
+
+    # Catch up large backlogs in bounded chunks, in parallel on the workers, before polling incrementally.
+    # Transactions are chunked by their commit timestamps, widened by the lookback on both sides.
+    if backfill_txns:
+        backfill = Backfill(conn, executor, materialize, query_name, backfill_txns, backfill_seconds, workers)
+        for table in active_tables:
+            def chunk_query(min_timestamp, max_timestamp):
+                sql_template.reload_if_changed()
+                if dirty_buckets is not None:
+                    buckets = DirtyBuckets(bucket_seconds)
+                    buckets.mark(min_timestamp - datetime.timedelta(seconds=lookback_seconds), max_timestamp + datetime.timedelta(seconds=lookback_seconds))
+                    return sql_template.bind(timestamp_txn_filter=bucket_range_filter([(col, buckets.drain()) for col in timestamp_columns]))
+                return sql_template.bind(timestamp_txn_filter=lookback_range_filter(timestamp_columns, lookback_seconds, min_timestamp, max_timestamp))
+
+            def chunk_done(chunk, table=table):
+                nonlocal stored_template_hash
+                table_info[table]['latest_txn_id'] = chunk['last_txn']
+                if checkpoints:
+                    template64 = sql_template.encoded() if sql_template.hash != stored_template_hash else None
+                    stored_template_hash = sql_template.hash
+                    checkpoints.record(table, chunk['last_txn'], chunk['txns'], templateHash=sql_template.hash, template64=template64)
+                    checkpoints.maybe_flush()
+
+            backfill.run(cur, table, table_info[table]['latest_txn_id'], "sequencerTxn, timestamp, timestamp, rowCount", chunk_query, chunk_done)
+
+    next_lease_refresh = time.monotonic()
+
+    # The loop only ends through an exception, including the SystemExit raised on SIGTERM. Shard
+    # workers end without running exit handlers, so checkpoints are flushed and leases released here.
+    try:
+        while True:
+            # Renew leases and pick up or drop tables as workers join and leave
+            if lease_manager and time.monotonic() >= next_lease_refresh:
+                owned_tables = lease_manager.refresh(table_names)
+                acquired = sorted(owned_tables - set(table_info))
+                resumed = resume_tables(cur, acquired, tracking_table, tracking_id, with_structure=False) if acquired else {}
+                for table in acquired:
+                    print(f"Worker {shard_worker_id} acquired table {table}, starting from transaction ID: {resumed[table]['sequencerTxn']}")
+                    table_info[table] = {
+                        'latest_txn_id': resumed[table]['sequencerTxn'],
+                        'transaction_count': 0
+                    }
+                    scheduler.add_table(table)
+                # Make the progress of released tables durable before their new owner resumes from it
+                released = set(table_info) - owned_tables
+                if checkpoints and released:
+                    try:
+                        checkpoints.flush()
+                    except psycopg2.Error as exc:
+                        print(f"Writing the progress of released tables failed, their new owner redoes it: {str(exc).strip()}")
+                for table in released:
+                    print(f"Worker {shard_worker_id} released table {table}")
+                    # A later flush must not overwrite the progress of the new owner
+                    if checkpoints:
+                        checkpoints.discard(table)
+                    del table_info[table]
+                    scheduler.remove_table(table)
+                    TXN_BACKLOG.remove(table=table)
+                    LAST_PROCESSED_TXN.remove(table=table)
+                next_lease_refresh = time.monotonic() + lease_seconds / 3
         
-        for table in table_names:
-            cur.execute(f"""
-                SELECT sequencerTxn 
-                FROM {tracking_table} 
-                WHERE trackingId = '{tracking_id}' AND tableName = '{table}' 
-                ORDER BY timestamp DESC LIMIT 1;
-            """)
-            result = cur.fetchone()
-            latest_txn_id = result[0] if result else None
-            table_info[table] = {
-                'latest_txn_id': latest_txn_id,
-                'transaction_count': 0
-            }
-            print(f"Starting from transaction ID: {latest_txn_id} for table {table}")
-    else:
-        # Initial query to get the latest transaction ID for each table
-        for table in table_names:
-            cur.execute(f"SELECT sequencerTxn FROM wal_transactions('{table}') ORDER BY sequencerTxn DESC LIMIT 1")
-            latest_txn_id = cur.fetchone()[0]
-            table_info[table] = {
-                'latest_txn_id': latest_txn_id,
-                'transaction_count': 0
-            }
-            print(f"Starting from transaction ID: {latest_txn_id} for table {table}")
-
-    # Ensure all tables have their starting transaction ID initialized
-    for table in table_names:
-        if table_info[table]['latest_txn_id'] is None:
-            cur.execute(f"SELECT sequencerTxn FROM wal_transactions('{table}') ORDER BY sequencerTxn DESC LIMIT 1")
-            latest_txn_id = cur.fetchone()[0]
-            table_info[table]['latest_txn_id'] = latest_txn_id
-            print(f"Initialized starting transaction ID: {latest_txn_id} for table {table}")
-
-    while True:
-        time.sleep(check_interval)
+            due_tables = scheduler.wait(timeout=next_lease_refresh - time.monotonic() if lease_manager else None)
+            
+            # Keep the apply lag gauge of the target table current, also while nothing triggers
+            if throttle:
+                throttle.check(cur)
         
-        for table, timestamp_col in zip(table_names, timestamp_columns):
-            latest_txn_id = table_info[table]['latest_txn_id']
+            # Checkpoint background materializations that succeeded and roll back the progress of
+            # those that failed so their range is retried. Results are applied in submission order
+            # per table, so no checkpoint skips past an earlier job that is still running or failed
+            if executor:
+                executor.completed()
+                for (previous_txn_ids, latest_txn_ids, txn_counts, template_hash, template64), error in pending.ready():
+                    if error:
+                        print(f"Materialization failed for tables {', '.join(previous_txn_ids)}: {error}")
+                        stored_template_hash = None
+                        for table, previous_txn_id in previous_txn_ids.items():
+                            if table in table_info:
+                                table_info[table]['latest_txn_id'] = min(table_info[table]['latest_txn_id'], previous_txn_id)
+                    elif checkpoints:
+                        for table, latest_txn_id in latest_txn_ids.items():
+                            # Tables released while the job was running now belong to another worker
+                            if table in table_info:
+                                checkpoints.record(table, latest_txn_id, txn_counts[table], templateHash=template_hash, template64=template64)
+            if checkpoints:
+                checkpoints.maybe_flush()
+        
+            # Fetch the new transactions of all tables that are due for a poll into columnar windows in a single round trip
+            with POLL_SECONDS.time():
+                windows = fetch_transaction_windows(
+                    cur,
+                    {table: table_info[table]['latest_txn_id'] for table in due_tables},
+                    TRANSACTION_COLUMNS
+                )
+        
+            previous_txn_ids = {}
+            txn_counts = {}
+        
+            for table, timestamp_col in zip(table_names, timestamp_columns):
+                if table not in due_tables:
+                    continue
+                window = windows[table]
+                TXN_BACKLOG.set(window.last_txn - table_info[table]['latest_txn_id'] if window else 0, table=table)
             
-            cur.execute(f"""
-                SELECT sequencerTxn, timestamp 
-                FROM wal_transactions('{table}') 
-                WHERE sequencerTxn > {latest_txn_id}
-            """)
-            new_transactions = cur.fetchall()
+                # Adapt the poll interval to the transaction arrival rate
+                scheduler.observe(table, window)
             
-            if not new_transactions:
-                continue
-
-            # Update the number of new transactions
-            table_info[table]['transaction_count'] += len(new_transactions)
+                if not window:
+                    continue
             
-            if table_info[table]['transaction_count'] < transaction_threshold:
-                continue
+                # Leave the new transactions for the next poll while this table is still being materialized
+                job_key = sql_template_path if dirty_buckets is not None else table
+                if executor and executor.busy(job_key):
+                    continue
 
-            # Find the earliest transaction timestamp
-            earliest_txn_timestamp = min(txn[1] for txn in new_transactions)
-
-            # Replace {timestamp_txn_filter} with the appropriate filters for each table
-            timestamp_filters = " AND ".join(
-                f"{col} >= dateadd('s', -{lookback_seconds}, '{earliest_txn_timestamp}')"
-                for col in timestamp_columns
-            )
+                # The window holds every transaction since the last materialization, so transactions
+                # left below the threshold by earlier polls are not counted again
+                table_info[table]['transaction_count'] = len(window)
             
-            sql_query = sql_template.replace("{timestamp_txn_filter}", timestamp_filters)
+                if table_info[table]['transaction_count'] < transaction_threshold:
+                    continue
             
-            # Execute the query
-            cur.execute(sql_query)
-            conn.commit()
-            print("Executed query:")
-            print(sql_query)
+                # Keep the new transactions pending while the target table is behind on applying its WAL; they are merged into the next materialization
+                if throttle and throttle.defer(cur, job_key):
+                    continue
+
+                # Find the earliest transaction timestamp and the row count in one pass
+                summary = window.summary()
+                earliest_txn_timestamp = summary['first_commit']
         
-            # Update the latest transaction IDs and reset the transaction count
-            table_info[table]['latest_txn_id'] = new_transactions[-1][0]
-            table_info[table]['transaction_count'] = 0
+                # Update the latest transaction IDs and reset the transaction count
+                previous_txn_ids[table] = table_info[table]['latest_txn_id']
+                table_info[table]['latest_txn_id'] = window.last_txn
+                txn_counts[table] = len(window)
+                table_info[table]['transaction_count'] = 0
+                TRANSACTIONS_PROCESSED.inc(len(window), table=table)
+                ROWS_PROCESSED.inc(summary['rows'] or 0, table=table)
+                TXN_BACKLOG.set(0, table=table)
+                LAST_PROCESSED_TXN.set(table_info[table]['latest_txn_id'], table=table)
             
-            # Update the tracking table
-            if tracking_table and tracking_id:
-                cur.execute(f"""
-                    INSERT INTO {tracking_table} (timestamp, trackingId, tableName, sequencerTxn, template64) 
-                    VALUES (NOW(), '{tracking_id}', '{table}', {table_info[table]['latest_txn_id']}, '{template64}');
-                """)
-                conn.commit()
+                if dirty_buckets is not None:
+                    # Materialized below, together with the other tables triggering in this cycle
+                    dirty_buckets.mark(earliest_txn_timestamp - datetime.timedelta(seconds=lookback_seconds))
+                    continue
 
-    cur.close()
-    conn.close()
+                # Pick up changes to the SQL template file and bind {timestamp_txn_filter} for each table
+                sql_template.reload_if_changed()
+                timestamp_filters = lookback_filter(timestamp_columns, lookback_seconds, earliest_txn_timestamp)
+                sql_query, params = sql_template.bind(timestamp_txn_filter=timestamp_filters)
+                # The full template is only stored in the tracking table when it changed
+                template64 = sql_template.encoded() if sql_template.hash != stored_template_hash else None
+                stored_template_hash = sql_template.hash
+            
+                latest_txn_ids = {table: table_info[table]['latest_txn_id']}
+                if executor:
+                    future = executor.submit(table, materialize, sql_query, params, query_name)
+                    pending.add(table, future, ({table: previous_txn_ids[table]}, latest_txn_ids, txn_counts, sql_template.hash, template64))
+                else:
+                    materialize(conn, sql_query, params, query_name)
+                    if checkpoints:
+                        checkpoints.record(table, latest_txn_ids[table], txn_counts[table], templateHash=sql_template.hash, template64=template64)
+                        checkpoints.maybe_flush()
+        
+            # Materialize the merged, bucket-aligned window of all tables that triggered in this cycle at once
+            if dirty_buckets is not None and previous_txn_ids:
+                sql_template.reload_if_changed()
+                ranges = dirty_buckets.drain()
+                timestamp_filters = bucket_range_filter([(col, ranges) for col in timestamp_columns])
+                sql_query, params = sql_template.bind(timestamp_txn_filter=timestamp_filters)
+                template64 = sql_template.encoded() if sql_template.hash != stored_template_hash else None
+                stored_template_hash = sql_template.hash
+            
+                latest_txn_ids = {table: table_info[table]['latest_txn_id'] for table in previous_txn_ids}
+                if executor:
+                    future = executor.submit(sql_template_path, materialize, sql_query, params, query_name)
+                    pending.add(sql_template_path, future, (previous_txn_ids, latest_txn_ids, txn_counts, sql_template.hash, template64))
+                else:
+                    materialize(conn, sql_query, params, query_name)
+                    if checkpoints:
+                        for table, latest_txn_id in latest_txn_ids.items():
+                            checkpoints.record(table, latest_txn_id, txn_counts[table], templateHash=sql_template.hash, template64=template64)
+                        checkpoints.maybe_flush()
+                print(f"Bucket stats: {dirty_buckets.summary()}")
+    finally:
+        try:
+            if executor:
+                executor.shutdown()
+            # Discard the transaction of a query that failed, unless the connection itself is gone
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+            if checkpoints:
+                checkpoints.flush()
+        finally:
+            # Hand the tables to the other workers right away instead of after the lease expires
+            if lease_manager:
+                lease_manager.release()
+            cur.close()
+            conn.close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Monitor and aggregate changes in QuestDB tables.')
@@ -127,10 +334,29 @@ if __name__ == "__main__":
     parser.add_argument('--transaction_threshold', type=int, required=True, help='Number of transactions to trigger the materialize query.')
     parser.add_argument('--sql_template_path', required=True, help='Path to the file containing the SQL template.')
     parser.add_argument('--check_interval', type=int, default=30, help='The interval (in seconds) to check for new transactions.')
+    parser.add_argument('--min_interval', type=float, help='Enable adaptive polling with this minimum interval (in seconds) under bursts.')
+    parser.add_argument('--max_interval', type=float, help='The maximum interval (in seconds) an idle table backs off to (default: check_interval).')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random jitter applied to each poll interval, as a fraction of the interval.')
     parser.add_argument('--timestamp_columns', required=True, help='Comma-separated list of timestamp columns corresponding to each table (format: table_name.column_name).')
     parser.add_argument('--lookback_seconds', type=int, default=5, help='Number of seconds to look back from the earliest transaction timestamp in the batch.')
     parser.add_argument('--tracking_table', help='Name of the tracking table to keep track of processed transactions.')
     parser.add_argument('--tracking_id', help='Tracking ID for this run.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker threads (and pooled connections) materializing tables in parallel.')
+    parser.add_argument('--max_in_flight', type=int, default=1, help='Maximum number of materializations per table running at the same time.')
+    parser.add_argument('--bucket_seconds', type=float, help='Coalesce the windows of tables triggering in the same cycle into whole time buckets of this size in seconds; 0 uses the SAMPLE BY of the template.')
+    parser.add_argument('--checkpoint_interval', type=float, default=0, help='Write progress to the tracking table at most every this many seconds (default: after every materialization).')
+    parser.add_argument('--checkpoint_txns', type=int, default=0, help='Write progress to the tracking table once this many transactions have been materialized since the last write.')
+    parser.add_argument('--snapshot_path', help='Keep a local snapshot of the checkpoints in this file and resume from it on restart (not in sharded mode).')
+    parser.add_argument('--metrics_port', type=int, help='Serve Prometheus metrics on http://127.0.0.1:<port>/metrics; shard workers use consecutive ports.')
+    parser.add_argument('--profile_path', help='Toggle a cProfile session with SIGUSR1 and write it to this path; SIGUSR2 dumps all thread stacks.')
+    parser.add_argument('--backfill_txns', type=int, default=0, help='At startup, catch up backlogs of at least this many transactions in chunks of up to this many transactions, materialized in parallel by the workers (not in sharded mode).')
+    parser.add_argument('--backfill_seconds', type=float, help='Maximum time span (in seconds) of the transactions materialized by one backfill query.')
+    parser.add_argument('--max_apply_lag', type=int, help='Defer materializations while the target table has more than this many WAL transactions not applied yet.')
+    parser.add_argument('--max_defer_seconds', type=float, default=60, help='Materialize anyway once a trigger has been deferred for this many seconds; 0 defers without a limit.')
+    parser.add_argument('--target_table', help='The table the template writes, whose WAL apply lag is checked (default: the INSERT INTO table of the template).')
+    parser.add_argument('--shards', type=int, default=1, help='Number of worker processes splitting the tables between them through leases in the tracking table.')
+    parser.add_argument('--shard_worker_id', help='Run as a single sharded worker with this ID, for example to spread workers across hosts.')
+    parser.add_argument('--lease_seconds', type=int, default=30, help='How long a sharded worker keeps a table after its last lease renewal.')
     parser.add_argument('--dbname', default='qdb', help='The name of the database.')
     parser.add_argument('--user', default='admin', help='The database user.')
     parser.add_argument('--host', default='127.0.0.1', help='The database host.')
@@ -138,9 +364,46 @@ if __name__ == "__main__":
     parser.add_argument('--password', default='quest', help='The database password.')
 
     args = parser.parse_args()
+    if args.snapshot_path and not (args.tracking_table and args.tracking_id):
+        parser.error('--snapshot_path requires --tracking_table and --tracking_id')
+    if args.backfill_txns and (args.shards > 1 or args.shard_worker_id):
+        parser.error('--backfill_txns is not supported in sharded mode')
 
     table_names = args.table_names.split(',')
     timestamp_columns = args.timestamp_columns.split(',')
 
-    main(table_names, args.transaction_threshold, args.sql_template_path, args.check_interval, timestamp_columns, args.lookback_seconds, args.dbname, args.user, args.host, args.port, args.password, args.tracking_table, args.tracking_id)
+    kwargs = {
+        'dbname': args.dbname, 'user': args.user, 'host': args.host, 'port': args.port, 'password': args.password,
+        'tracking_table': args.tracking_table, 'tracking_id': args.tracking_id,
+        'min_interval': args.min_interval, 'max_interval': args.max_interval, 'jitter': args.jitter,
+        'workers': args.workers, 'max_in_flight': args.max_in_flight,
+        'shard_worker_id': args.shard_worker_id, 'lease_seconds': args.lease_seconds,
+        'bucket_seconds': args.bucket_seconds,
+        'metrics_port': args.metrics_port, 'profile_path': args.profile_path,
+        'checkpoint_interval': args.checkpoint_interval, 'checkpoint_txns': args.checkpoint_txns,
+        'snapshot_path': args.snapshot_path,
+        'backfill_txns': args.backfill_txns, 'backfill_seconds': args.backfill_seconds,
+        'target_table': args.target_table, 'max_apply_lag': args.max_apply_lag, 'max_defer_seconds': args.max_defer_seconds
+    }
+    main_args = (table_names, args.transaction_threshold, args.sql_template_path, args.check_interval, timestamp_columns, args.lookback_seconds)
 
+    if args.shards > 1:
+        # Spawn one sharded worker per shard; worker IDs are stable so a restarted worker gets its tables back
+        prefix = args.shard_worker_id or socket.gethostname()
+        processes = []
+        for shard in range(args.shards):
+            shard_kwargs = dict(kwargs, shard_worker_id=f"{prefix}-{shard}")
+            if args.metrics_port:
+                shard_kwargs['metrics_port'] = args.metrics_port + shard
+            if args.profile_path:
+                shard_kwargs['profile_path'] = f"{args.profile_path}.{shard}"
+            process = multiprocessing.Process(target=main, args=main_args, kwargs=shard_kwargs)
+            process.start()
+            processes.append(process)
+        # Forward SIGTERM so every worker flushes its checkpoints and releases its leases. The handler is
+        # installed after the workers started, which keep their own.
+        signal.signal(signal.SIGTERM, lambda signum, frame: [process.terminate() for process in processes if process.is_alive()])
+        for process in processes:
+            process.join()
+    else:
+        main(*main_args, **kwargs)
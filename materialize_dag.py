@@ -0,0 +1,308 @@
+import psycopg2
+import time
+import argparse
+import concurrent.futures
+import graphlib
+import json
+import os
+from poll_scheduler import scheduler_from_args
+from wal_poller import fetch_transaction_windows, fetch_wal_progress
+from table_executor import TableExecutor
+from sql_template import SqlTemplate, timestamp_range_filter
+from checkpoints import CheckpointManager
+from bootstrap import resume_tables, STARTUP_SECONDS
+from materialize_view import materialize
+from wal_throttle import ApplyLagThrottle, check_all
+from metrics import histogram, start_metrics_server, install_profile_signals, POLL_SECONDS, TRANSACTIONS_PROCESSED, ROWS_PROCESSED, TXN_BACKLOG, LAST_PROCESSED_TXN
+
+# wal_transactions() columns of the transaction windows
+TRANSACTION_COLUMNS = ['sequencerTxn', 'minTimestamp', 'maxTimestamp', 'rowCount']
+
+PROPAGATION_SECONDS = histogram('questdb_tracker_dag_propagation_seconds', 'Time from the poll that detected new transactions to the commit of each view they propagated to.', ['view'])
+
+def load_dag(path):
+    # Read the views of a DAG file. Returns name -> view and the graph of each
+    # view's upstream views, the views writing into one of its source tables.
+    # Template paths are relative to the DAG file.
+    with open(path, 'r') as file:
+        config = json.load(file)
+    views = {}
+    for entry in config.get('views', []):
+        missing = [key for key in ('name', 'sql_template_path', 'table_names', 'timestamp_columns', 'target_table') if key not in entry]
+        if missing:
+            raise ValueError(f"View {entry.get('name', '<unnamed>')} in {path} is missing {', '.join(missing)}")
+        name = entry['name']
+        if name in views:
+            raise ValueError(f"Duplicate view {name} in {path}")
+        thresholds = entry.get('thresholds', [1] * len(entry['table_names']))
+        if not entry['table_names'] or not len(entry['table_names']) == len(entry['timestamp_columns']) == len(thresholds):
+            raise ValueError(f"View {name} in {path} needs one timestamp column and threshold per table")
+        views[name] = {
+            'name': name,
+            'sql_template_path': os.path.join(os.path.dirname(os.path.abspath(path)), entry['sql_template_path']),
+            'table_names': list(entry['table_names']),
+            'timestamp_columns': list(entry['timestamp_columns']),
+            'thresholds': list(thresholds),
+            'target_table': entry['target_table']
+        }
+    if not views:
+        raise ValueError(f"No views found in {path}")
+
+    graph = {
+        name: {upstream for upstream, other in views.items() if other['target_table'] in view['table_names']}
+        for name, view in views.items()
+    }
+    try:
+        graphlib.TopologicalSorter(graph).prepare()
+    except graphlib.CycleError as exc:
+        raise ValueError(f"The views in {path} form a cycle: {' -> '.join(exc.args[1])}")
+    return views, graph
+
+def main(dag_path, check_interval, dbname='qdb', user='admin', host='127.0.0.1', port=8812, password='quest', tracking_table=None, tracking_id=None, min_interval=None, max_interval=None, jitter=0.0, workers=1, follow_interval=0.1, metrics_port=None, profile_path=None, checkpoint_interval=0, checkpoint_txns=0, max_apply_lag=None, max_defer_seconds=None):
+    started = time.monotonic()
+    views, graph = load_dag(dag_path)
+
+    # Tables written by a view are followed as soon as the view commits; only the others are polled
+    readers = {}
+    for view in views.values():
+        for table in view['table_names']:
+            readers.setdefault(table, []).append(view)
+    targets = {view['target_table'] for view in views.values()}
+    polled_tables = [table for table in readers if table not in targets]
+    followed_tables = [table for table in readers if table in targets]
+
+    conn = psycopg2.connect(
+        dbname=dbname,
+        user=user,
+        host=host,
+        port=port,
+        password=password
+    )
+    cur = conn.cursor()
+
+    # Expose metrics over HTTP and profiling hooks on signals if requested
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    if profile_path:
+        install_profile_signals(profile_path)
+
+    if tracking_table and tracking_id:
+        # Create tracking table if it does not exist
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {tracking_table} (
+                timestamp TIMESTAMP,
+                trackingId SYMBOL,
+                tableName SYMBOL,
+                sequencerTxn LONG,
+                templateHash SYMBOL,
+                template64 VARCHAR
+            ) timestamp (timestamp) PARTITION BY DAY WAL DEDUP UPSERT KEYS(timestamp, trackingId, tableName);
+        """)
+        cur.execute(f"ALTER TABLE {tracking_table} ADD COLUMN IF NOT EXISTS templateHash SYMBOL")
+        conn.commit()
+
+    # Every view keeps its own progress per source table, under the tracking ID <tracking_id>.<view>
+    for name, view in views.items():
+        view_tracking_id = f"{tracking_id}.{name}" if tracking_id else None
+        resumed = resume_tables(cur, view['table_names'], tracking_table, view_tracking_id, with_structure=False)
+        view['latest_txn_ids'] = {table: resumed[table]['sequencerTxn'] for table in view['table_names']}
+        view['sql_template'] = SqlTemplate(view['sql_template_path'])
+        view['stored_template_hash'] = None
+        view['checkpoints'] = None
+        # Optionally defer the view while its target table is behind on applying its WAL
+        view['throttle'] = ApplyLagThrottle(view['target_table'], max_apply_lag, max_defer_seconds) if max_apply_lag is not None else None
+        if tracking_table and tracking_id:
+            view['checkpoints'] = CheckpointManager(conn, tracking_table, view_tracking_id, checkpoint_interval, checkpoint_txns)
+            view['checkpoints'].flush_on_exit()
+        upstream = ', '.join(sorted(graph[name])) or 'none'
+        print(f"View {name} writes {view['target_table']} from {', '.join(f'{table} (transaction {txn})' for table, txn in view['latest_txn_ids'].items())}, upstream views: {upstream}")
+    elapsed = time.monotonic() - started
+    STARTUP_SECONDS.set(elapsed)
+    print(f"Startup took {elapsed:.3f}s, resumed {len(views)} views")
+
+    scheduler = scheduler_from_args(polled_tables, check_interval, min_interval, max_interval, jitter)
+
+    # With more than one worker, independent views run at the same time on pooled connections
+    executor = None
+    if workers > 1:
+        connect_kwargs = {'dbname': dbname, 'user': user, 'host': host, 'port': port, 'password': password}
+        executor = TableExecutor(connect_kwargs, workers)
+
+    # Followed tables read on the next poll: all of them at startup, to catch up on what upstream
+    # views wrote before a restart, and later those with transactions still pending for a view,
+    # because its writer had not applied them yet, or the view was below its threshold, deferred
+    # or failed. Followed tables are not polled on their own, so nothing else would read them again.
+    refresh = set(followed_tables)
+    # Followed tables whose writer has not applied the transactions a view committed yet. They are
+    # read again after follow_interval instead of waiting for the apply and blocking the other views.
+    unapplied = set()
+
+    def poll(tables):
+        # One window per table, from the oldest progress of the views reading it
+        with POLL_SECONDS.time():
+            windows = fetch_transaction_windows(
+                cur,
+                {table: min(view['latest_txn_ids'][table] for view in readers[table]) for table in tables},
+                TRANSACTION_COLUMNS
+            )
+        for table, window in windows.items():
+            TXN_BACKLOG.set(window.last_txn - min(view['latest_txn_ids'][table] for view in readers[table]) if window else 0, table=table)
+        return windows
+
+    def applied(windows, tables):
+        # Queries on a table only see its rows once the writer applied them, so
+        # followed tables are read up to their writerTxn
+        expected = {table: windows[table].last_txn for table in tables if windows[table]}
+        progress = fetch_wal_progress(cur, list(expected)) if expected else {}
+        for table, last_txn in expected.items():
+            # Tables that are not WAL tables apply their rows right away
+            writer_txn = progress.get(table, (last_txn, last_txn))[0]
+            if writer_txn < last_txn:
+                unapplied.add(table)
+                windows[table] = windows[table].between(None, writer_txn)
+
+    def prepare(name, windows):
+        # The materialization of a view if any of its source tables met its
+        # threshold, otherwise None. New transactions below the threshold stay
+        # pending, they are part of the window of the next trigger.
+        view = views[name]
+        pending = {}
+        triggered = False
+        for table, threshold in zip(view['table_names'], view['thresholds']):
+            if table not in windows:
+                continue
+            window = windows[table].between(view['latest_txn_ids'][table])
+            if not window:
+                continue
+            pending[table] = window
+            triggered = triggered or (window.summary()['rows'] or 0) >= threshold
+        if not triggered or (view['throttle'] and view['throttle'].defer(cur, name)):
+            refresh.update(table for table in pending if table in targets)
+            return None
+
+        # Pick up changes to the SQL template file
+        sql_template = view['sql_template']
+        sql_template.reload_if_changed()
+        ranges = []
+        for table, col in zip(view['table_names'], view['timestamp_columns']):
+            if table in pending:
+                summary = pending[table].summary()
+                if summary['min_timestamp'] is not None and summary['max_timestamp'] is not None:
+                    ranges.append((col, summary['min_timestamp'], summary['max_timestamp']))
+        sql_query, params = sql_template.bind(timestamp_txn_filter=timestamp_range_filter(ranges))
+        # The full template is only stored in the tracking table when it changed
+        template64 = sql_template.encoded() if sql_template.hash != view['stored_template_hash'] else None
+        view['stored_template_hash'] = sql_template.hash
+        return {'windows': pending, 'sql_query': sql_query, 'params': params, 'template_hash': sql_template.hash, 'template64': template64}
+
+    def finish(name, job, error, windows, detected):
+        view = views[name]
+        if error is not None:
+            # The progress is not advanced, so the same transactions trigger the view again
+            print(f"Materialization of view {name} failed: {error}")
+            view['stored_template_hash'] = None
+            refresh.update(table for table in job['windows'] if table in targets)
+            return
+        for table, window in job['windows'].items():
+            view['latest_txn_ids'][table] = window.last_txn
+            TRANSACTIONS_PROCESSED.inc(len(window), table=table)
+            ROWS_PROCESSED.inc(window.summary()['rows'] or 0, table=table)
+            LAST_PROCESSED_TXN.set(min(reader['latest_txn_ids'][table] for reader in readers[table]), table=table)
+            if view['checkpoints']:
+                view['checkpoints'].record(table, window.last_txn, len(window), templateHash=job['template_hash'], template64=job['template64'])
+        if view['checkpoints']:
+            view['checkpoints'].maybe_flush()
+        PROPAGATION_SECONDS.observe(time.monotonic() - detected, view=name)
+
+        # Follow the transactions the view just committed into the views reading its target
+        target = view['target_table']
+        if target in readers:
+            windows.update(poll([target]))
+            applied(windows, [target])
+
+    while True:
+        due_tables = scheduler.wait(timeout=follow_interval if unapplied else None)
+
+        # Keep the apply lag gauges of the target tables current, also while nothing triggers
+        check_all(cur, [view['throttle'] for view in views.values()])
+
+        for view in views.values():
+            if view['checkpoints']:
+                view['checkpoints'].maybe_flush()
+
+        # Fetch the new transactions of the due tables, and of followed tables left over from earlier polls
+        detected = time.monotonic()
+        followed = sorted(refresh | unapplied)
+        refresh.clear()
+        unapplied.clear()
+        windows = poll(list(due_tables) + followed)
+        for table in due_tables:
+            # Adapt the poll interval to the transaction arrival rate
+            scheduler.observe(table, windows[table])
+        applied(windows, followed)
+
+        # Run the triggered views in topological order: a view starts once all of its upstream
+        # views are done with this poll, and views on independent branches run at the same time
+        sorter = graphlib.TopologicalSorter(graph)
+        sorter.prepare()
+        running = {}
+        while sorter.is_active():
+            for name in sorter.get_ready():
+                job = prepare(name, windows)
+                if job is None:
+                    sorter.done(name)
+                elif executor:
+                    future = executor.submit(name, materialize, job['sql_query'], job['params'], name)
+                    running[future] = (name, job)
+                else:
+                    error = None
+                    try:
+                        materialize(conn, job['sql_query'], job['params'], name)
+                    except psycopg2.Error as exc:
+                        conn.rollback()
+                        error = exc
+                    finish(name, job, error, windows, detected)
+                    sorter.done(name)
+            if running:
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                # Jobs are tracked here, not through the executor's completed list
+                executor.completed()
+                for future in done:
+                    name, job = running.pop(future)
+                    finish(name, job, future.exception(), windows, detected)
+                    sorter.done(name)
+
+    if executor:
+        executor.shutdown()
+    for view in views.values():
+        if view['checkpoints']:
+            view['checkpoints'].flush()
+    cur.close()
+    conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Materialize a DAG of chained views, each one triggered as soon as its upstream views commit.')
+    parser.add_argument('--dag_path', required=True, help='Path to the JSON file describing the views, their source tables and target tables.')
+    parser.add_argument('--check_interval', type=int, default=30, help='The interval (in seconds) to check the source tables that no view writes for new transactions.')
+    parser.add_argument('--min_interval', type=float, help='Enable adaptive polling with this minimum interval (in seconds) under bursts.')
+    parser.add_argument('--max_interval', type=float, help='The maximum interval (in seconds) an idle table backs off to (default: check_interval).')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random jitter applied to each poll interval, as a fraction of the interval.')
+    parser.add_argument('--dbname', default='qdb', help='The name of the database.')
+    parser.add_argument('--user', default='admin', help='The database user.')
+    parser.add_argument('--host', default='127.0.0.1', help='The database host.')
+    parser.add_argument('--port', type=int, default=8812, help='The database port.')
+    parser.add_argument('--password', default='quest', help='The database password.')
+    parser.add_argument('--tracking_table', help='The name of the tracking table.')
+    parser.add_argument('--tracking_id', help='The tracking ID for this run; every view is tracked as <tracking_id>.<view name>.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker threads (and pooled connections) running independent views at the same time.')
+    parser.add_argument('--follow_interval', type=float, default=0.1, help='How often (in seconds) a view\'s target table is read again while its writer has not applied the transactions the view committed.')
+    parser.add_argument('--max_apply_lag', type=int, help='Defer a view while its target table has more than this many WAL transactions not applied yet.')
+    parser.add_argument('--max_defer_seconds', type=float, default=60, help='Run a view anyway once it has been deferred for this many seconds; 0 defers without a limit.')
+    parser.add_argument('--checkpoint_interval', type=float, default=0, help='Write progress to the tracking table at most every this many seconds (default: after every materialization).')
+    parser.add_argument('--checkpoint_txns', type=int, default=0, help='Write progress to the tracking table once this many transactions have been materialized since the last write.')
+    parser.add_argument('--metrics_port', type=int, help='Serve Prometheus metrics on http://127.0.0.1:<port>/metrics.')
+    parser.add_argument('--profile_path', help='Toggle a cProfile session with SIGUSR1 and write it to this path; SIGUSR2 dumps all thread stacks.')
+
+    args = parser.parse_args()
+
+    main(args.dag_path, args.check_interval, args.dbname, args.user, args.host, args.port, args.password, args.tracking_table, args.tracking_id, min_interval=args.min_interval, max_interval=args.max_interval, jitter=args.jitter, workers=args.workers, follow_interval=args.follow_interval, metrics_port=args.metrics_port, profile_path=args.profile_path, checkpoint_interval=args.checkpoint_interval, checkpoint_txns=args.checkpoint_txns, max_apply_lag=args.max_apply_lag, max_defer_seconds=args.max_defer_seconds)
@@ -2,9 +2,38 @@ import psycopg2
 import time
 import sys
 import argparse
-import base64
+import os
+from poll_scheduler import scheduler_from_args
+from wal_poller import fetch_transaction_windows
+from table_executor import TableExecutor, OrderedResults
+from sql_template import SqlTemplate, timestamp_range_filter, bucket_range_filter
+from dirty_buckets import DirtyBuckets, sample_by_seconds
+from checkpoints import CheckpointManager
+from bootstrap import Snapshot, resume_tables
+from backfill import Backfill
+from wal_throttle import throttle_from_args
+from metrics import start_metrics_server, install_profile_signals, POLL_SECONDS, QUERY_SECONDS, QUERY_FAILURES, TRANSACTIONS_PROCESSED, ROWS_PROCESSED, TXN_BACKLOG, LAST_PROCESSED_TXN
 
-def main(table_names, thresholds, sql_template_path, check_interval, timestamp_columns, dbname='qdb', user='admin', host='127.0.0.1', port=8812, password='quest', tracking_table=None, tracking_id=None):
+# wal_transactions() columns of the transaction windows
+TRANSACTION_COLUMNS = ['sequencerTxn', 'minTimestamp', 'maxTimestamp', 'rowCount', 'structureVersion', 'timestamp']
+
+def materialize(conn, sql_query, params, query_name='materialize'):
+    cur = conn.cursor()
+    
+    # Execute the query
+    try:
+        with QUERY_SECONDS.time(query=query_name):
+            cur.execute(sql_query, params)
+            conn.commit()
+    except Exception:
+        QUERY_FAILURES.inc(query=query_name)
+        raise
+    print("Executed query:")
+    print(cur.query.decode())
+    cur.close()
+
+def main(table_names, thresholds, sql_template_path, check_interval, timestamp_columns, dbname='qdb', user='admin', host='127.0.0.1', port=8812, password='quest', tracking_table=None, tracking_id=None, min_interval=None, max_interval=None, jitter=0.0, workers=1, max_in_flight=1, bucket_seconds=None, metrics_port=None, profile_path=None, checkpoint_interval=0, checkpoint_txns=0, snapshot_path=None, backfill_txns=0, backfill_seconds=None, target_table=None, max_apply_lag=None, max_defer_seconds=None):
+    started = time.monotonic()
     conn = psycopg2.connect(
         dbname=dbname,
         user=user,
@@ -14,8 +43,18 @@ def main(table_names, thresholds, sql_template_path, check_interval, timestamp_c
     )
     cur = conn.cursor()
     
+    # Expose metrics over HTTP and profiling hooks on signals if requested
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    if profile_path:
+        install_profile_signals(profile_path)
+    
     table_info = {}
     
+    # Progress is written to the tracking table in batches by the checkpoint manager
+    checkpoints = None
+    snapshot = None
+    
     if tracking_table and tracking_id:
         # Create tracking table if it does not exist
         cur.execute(f"""
@@ -24,53 +63,106 @@ def main(table_names, thresholds, sql_template_path, check_interval, timestamp_c
                 trackingId SYMBOL,
                 tableName SYMBOL,
                 sequencerTxn LONG,
+                templateHash SYMBOL,
                 template64 VARCHAR
             ) timestamp (timestamp) PARTITION BY DAY WAL DEDUP UPSERT KEYS(timestamp, trackingId, tableName);
         """)
+        # Tracking tables created by older versions have no template hash column
+        cur.execute(f"ALTER TABLE {tracking_table} ADD COLUMN IF NOT EXISTS templateHash SYMBOL")
         conn.commit()
-        
-        # Get the latest transaction ID from tracking table
-        cur.execute(f"""
-            SELECT tableName, sequencerTxn
-            FROM {tracking_table}
-            WHERE trackingId = '{tracking_id}'
-            LATEST ON timestamp
-            PARTITION BY tableName;
-        """)
-        latest_transactions = cur.fetchall()
-        
-        for table in table_names:
-            # Initialize with the latest transaction from tracking table if available
-            latest_txn_id = next((txn[1] for txn in latest_transactions if txn[0] == table), None)
-            if latest_txn_id:
-                cur.execute(f"SELECT structureVersion FROM wal_transactions('{table}') WHERE sequencerTxn = {latest_txn_id} LIMIT 1")
-                latest_structure_version = cur.fetchone()[0]
-            else:
-                cur.execute(f"SELECT sequencerTxn, structureVersion FROM wal_transactions('{table}') ORDER BY sequencerTxn DESC LIMIT 1")
-                latest_txn_id, latest_structure_version = cur.fetchone()
-            table_info[table] = {
-                'latest_txn_id': latest_txn_id,
-                'latest_structure_version': latest_structure_version,
-                'total_new_rows': 0,
-                'min_timestamp': None,
-                'max_timestamp': None
-            }
-            print(f"Starting from transaction ID: {latest_txn_id} with structure version: {latest_structure_version} for table {table}")
-    else:
-        for table in table_names:
-            cur.execute(f"SELECT sequencerTxn, structureVersion FROM wal_transactions('{table}') ORDER BY sequencerTxn DESC LIMIT 1")
-            latest_txn_id, latest_structure_version = cur.fetchone()
-            table_info[table] = {
-                'latest_txn_id': latest_txn_id,
-                'latest_structure_version': latest_structure_version,
-                'total_new_rows': 0,
-                'min_timestamp': None,
-                'max_timestamp': None
-            }
-            print(f"Starting from transaction ID: {latest_txn_id} with structure version: {latest_structure_version} for table {table}")
+        # A local snapshot of the checkpoints allows resuming without querying the server
+        snapshot = Snapshot(snapshot_path, tracking_id) if snapshot_path else None
+        checkpoints = CheckpointManager(conn, tracking_table, tracking_id, checkpoint_interval, checkpoint_txns, snapshot)
+        checkpoints.flush_on_exit()
+    
+    # Resume every table in bulk, from the snapshot or the tracking table, otherwise from its latest transaction
+    resumed = resume_tables(cur, table_names, tracking_table, tracking_id, snapshot, started=started)
+    for table in table_names:
+        table_info[table] = {
+            'latest_txn_id': resumed[table]['sequencerTxn'],
+            'latest_structure_version': resumed[table]['structureVersion'],
+            'total_new_rows': 0,
+            'min_timestamp': None,
+            'max_timestamp': None
+        }
+        print(f"Starting from transaction ID: {table_info[table]['latest_txn_id']} with structure version: {table_info[table]['latest_structure_version']} for table {table}")
+
+    # Compile the SQL template once; it is only re-read when the file changes
+    sql_template = SqlTemplate(sql_template_path)
+    query_name = os.path.basename(sql_template_path)
+    stored_template_hash = None
+    
+    # Optionally track dirty time buckets per table, aligned to the SAMPLE BY of the template
+    dirty_buckets = None
+    if bucket_seconds is not None:
+        bucket_seconds = bucket_seconds or sample_by_seconds(sql_template.text)
+        if not bucket_seconds:
+            raise ValueError(f"No SAMPLE BY found in {sql_template_path}, use a positive --bucket_seconds")
+        dirty_buckets = {table: DirtyBuckets(bucket_seconds) for table in table_names}
+    
+    scheduler = scheduler_from_args(table_names, check_interval, min_interval, max_interval, jitter)
+    
+    # Optionally defer materializations while the target table is behind on applying its WAL
+    throttle = throttle_from_args(sql_template, target_table, max_apply_lag, max_defer_seconds)
+    
+    # With more than one worker the template runs in the background on pooled connections
+    executor = None
+    pending = OrderedResults()
+    if workers > 1:
+        connect_kwargs = {'dbname': dbname, 'user': user, 'host': host, 'port': port, 'password': password}
+        executor = TableExecutor(connect_kwargs, workers, max_in_flight)
+
+    # Catch up large backlogs in bounded chunks, in parallel on the workers, before polling incrementally
+    if backfill_txns:
+        backfill = Backfill(conn, executor, materialize, query_name, backfill_txns, backfill_seconds, workers)
+        for table, col in zip(table_names, timestamp_columns):
+            def chunk_query(min_timestamp, max_timestamp, col=col):
+                sql_template.reload_if_changed()
+                if dirty_buckets:
+                    buckets = DirtyBuckets(bucket_seconds)
+                    buckets.mark(min_timestamp, max_timestamp)
+                    return sql_template.bind(timestamp_txn_filter=bucket_range_filter([(col, buckets.drain())]))
+                return sql_template.bind(timestamp_txn_filter=timestamp_range_filter([(col, min_timestamp, max_timestamp)]))
+
+            def chunk_done(chunk, table=table):
+                nonlocal stored_template_hash
+                table_info[table]['latest_txn_id'] = chunk['last_txn']
+                if chunk['structure_version'] is not None:
+                    table_info[table]['latest_structure_version'] = chunk['structure_version']
+                if checkpoints:
+                    template64 = sql_template.encoded() if sql_template.hash != stored_template_hash else None
+                    stored_template_hash = sql_template.hash
+                    checkpoints.record(table, chunk['last_txn'], chunk['txns'], table_info[table]['latest_structure_version'], templateHash=sql_template.hash, template64=template64)
+                    checkpoints.maybe_flush()
+
+            backfill.run(cur, table, table_info[table]['latest_txn_id'], "sequencerTxn, minTimestamp, maxTimestamp, rowCount, structureVersion", chunk_query, chunk_done)
 
     while True:
-        time.sleep(check_interval)
+        due_tables = scheduler.wait()
+        
+        # Keep the apply lag gauge of the target table current, also while nothing triggers
+        if throttle:
+            throttle.check(cur)
+        
+        # Checkpoint background materializations that succeeded and roll back the progress of
+        # those that failed so their range is retried. Results are applied in submission order,
+        # so no checkpoint skips past an earlier job that is still running or failed
+        if executor:
+            executor.completed()
+            for (previous_txn_ids, latest_txn_ids, txn_counts, template_hash, template64, drained), error in pending.ready():
+                if error:
+                    print(f"Materialization failed: {error}")
+                    stored_template_hash = None
+                    for table, previous_txn_id in previous_txn_ids.items():
+                        table_info[table]['latest_txn_id'] = min(table_info[table]['latest_txn_id'], previous_txn_id)
+                    # Buckets marked by earlier polls are not covered by the rollback, so they are marked again
+                    for table, ranges in drained.items():
+                        dirty_buckets[table].restore(ranges)
+                elif checkpoints:
+                    for table, latest_txn_id in latest_txn_ids.items():
+                        checkpoints.record(table, latest_txn_id, txn_counts.get(table, 0), table_info[table]['latest_structure_version'], templateHash=template_hash, template64=template64)
+        if checkpoints:
+            checkpoints.maybe_flush()
         
         # Reset new rows count and timestamps for each table
         for table in table_names:
@@ -78,71 +170,122 @@ def main(table_names, thresholds, sql_template_path, check_interval, timestamp_c
             table_info[table]['min_timestamp'] = None
             table_info[table]['max_timestamp'] = None
         
-        # Query to get new transactions for each table
+        # Fetch the new transactions of all tables that are due for a poll into columnar windows in a single round trip
+        with POLL_SECONDS.time():
+            windows = fetch_transaction_windows(
+                cur,
+                {table: table_info[table]['latest_txn_id'] for table in due_tables},
+                TRANSACTION_COLUMNS
+            )
+        for table in due_tables:
+            TXN_BACKLOG.set(windows[table].last_txn - table_info[table]['latest_txn_id'] if windows[table] else 0, table=table)
+        
         for table, threshold in zip(table_names, thresholds):
-            cur.execute(f"""
-                SELECT sequencerTxn, minTimestamp, maxTimestamp, rowCount, structureVersion 
-                FROM wal_transactions('{table}') 
-                WHERE sequencerTxn > {table_info[table]['latest_txn_id']}
-            """)
-            new_transactions = cur.fetchall()
+            if table not in due_tables:
+                continue
+            window = windows[table]
+            
+            # Adapt the poll interval to the transaction arrival rate
+            scheduler.observe(table, window)
             
-            if not new_transactions:
+            if not window:
                 continue
 
             # Check for structure version changes
-            for txn in new_transactions:
-                if txn[4] != table_info[table]['latest_structure_version']:
-                    print(f"Structure version changed from {table_info[table]['latest_structure_version']} to {txn[4]} on transaction {txn[0]} for table {table}")
-                    table_info[table]['latest_structure_version'] = txn[4]
+            for txn, structure_version in window.structure_changes(table_info[table]['latest_structure_version']):
+                print(f"Structure version changed from {table_info[table]['latest_structure_version']} to {structure_version} on transaction {txn} for table {table}")
+                table_info[table]['latest_structure_version'] = structure_version
 
-            # Aggregate the number of rows in new transactions, ignoring None values
-            table_info[table]['total_new_rows'] = sum(txn[3] for txn in new_transactions if txn[3] is not None)
+            # Row count and timestamp range of the new transactions in one pass, ignoring missing values
+            summary = window.summary()
+            table_info[table]['total_new_rows'] = summary['rows'] or 0
             
             if table_info[table]['total_new_rows'] < threshold:
                 continue
 
-            # Find the min and max timestamps from new transactions, ignoring None values
-            table_info[table]['min_timestamp'] = min((txn[1] for txn in new_transactions if txn[1] is not None), default=None)
-            table_info[table]['max_timestamp'] = max((txn[2] for txn in new_transactions if txn[2] is not None), default=None)
+            table_info[table]['min_timestamp'] = summary['min_timestamp']
+            table_info[table]['max_timestamp'] = summary['max_timestamp']
 
         # Check if any table met the threshold
-        if any(table_info[table]['total_new_rows'] >= threshold for table, threshold in zip(table_names, thresholds)):
-            # Load the SQL template
-            with open(sql_template_path, 'r') as file:
-                sql_template = file.read()
+        triggered = any(table_info[table]['total_new_rows'] >= threshold for table, threshold in zip(table_names, thresholds))
+        
+        # Keep the fetched transactions pending while the previous materialization is still running
+        if triggered and executor and executor.busy(sql_template_path):
+            continue
+        
+        # Keep the new transactions pending while the target table is behind on applying its WAL; they are merged into the next materialization
+        if triggered and throttle and throttle.defer(cur, sql_template_path):
+            continue
+        
+        # Advance only the tables that met their threshold; the transactions of the others stay pending and count
+        # towards the threshold of the next poll. Bucket mode marks every new transaction below, so all due tables advance.
+        advanced = [
+            table for table, threshold in zip(table_names, thresholds)
+            if table in due_tables and (dirty_buckets or table_info[table]['total_new_rows'] >= threshold)
+        ]
+        
+        # Update the latest transaction IDs from the transactions already fetched
+        previous_txn_ids = {table: table_info[table]['latest_txn_id'] for table in advanced}
+        for table in advanced:
+            if windows[table]:
+                table_info[table]['latest_txn_id'] = windows[table].last_txn
+            TRANSACTIONS_PROCESSED.inc(len(windows[table]), table=table)
+            ROWS_PROCESSED.inc(windows[table].summary()['rows'] or 0 if windows[table] else 0, table=table)
+            TXN_BACKLOG.set(0, table=table)
+            LAST_PROCESSED_TXN.set(table_info[table]['latest_txn_id'], table=table)
+        
+        # Mark the buckets touched by every new transaction, including those of tables below their threshold
+        if dirty_buckets:
+            for table in due_tables:
+                for min_timestamp, max_timestamp, row_count in windows[table].rows(('minTimestamp', 'maxTimestamp', 'rowCount')):
+                    if min_timestamp is not None and max_timestamp is not None:
+                        dirty_buckets[table].mark(min_timestamp, max_timestamp, row_count or 0)
+        
+        if triggered:
+            # Pick up changes to the SQL template file
+            sql_template.reload_if_changed()
             
-            # Replace {timestamp_txn_filter} with the appropriate filters for each table
-            timestamp_filters = " AND ".join(
-                f"{col} >= '{table_info[table]['min_timestamp']}' AND {col} <= '{table_info[table]['max_timestamp']}'"
-                for table, col in zip(table_names, timestamp_columns)
-                if table_info[table]['min_timestamp'] is not None and table_info[table]['max_timestamp'] is not None
-            )
+            # Bind {timestamp_txn_filter} to the appropriate filters for each table
+            drained = {}
+            if dirty_buckets:
+                drained = {table: dirty_buckets[table].drain() for table in table_names if dirty_buckets[table]}
+                timestamp_filters = bucket_range_filter([
+                    (col, drained[table])
+                    for table, col in zip(table_names, timestamp_columns)
+                    if table in drained
+                ])
+            else:
+                timestamp_filters = timestamp_range_filter([
+                    (col, table_info[table]['min_timestamp'], table_info[table]['max_timestamp'])
+                    for table, col in zip(table_names, timestamp_columns)
+                    if table_info[table]['min_timestamp'] is not None and table_info[table]['max_timestamp'] is not None
+                ])
             
-            sql_query = sql_template.replace("{timestamp_txn_filter}", timestamp_filters)
+            sql_query, params = sql_template.bind(timestamp_txn_filter=timestamp_filters)
+            latest_txn_ids = {table: table_info[table]['latest_txn_id'] for table in table_names}
+            txn_counts = {table: len(windows[table]) for table in advanced}
+            # The full template is only stored in the tracking table when it changed
+            template64 = sql_template.encoded() if sql_template.hash != stored_template_hash else None
+            stored_template_hash = sql_template.hash
             
-            # Execute the query
-            cur.execute(sql_query)
-            conn.commit()
-            print("Executed query:")
-            print(sql_query)
-
-            # Update tracking table with the latest transactions
-            if tracking_table and tracking_id:
-                timestamp_now = time.strftime('%Y-%m-%dT%H:%M:%S')
-                template64 = base64.b64encode(sql_template.encode()).decode()
+            if executor:
+                future = executor.submit(sql_template_path, materialize, sql_query, params, query_name)
+                pending.add(sql_template_path, future, (previous_txn_ids, latest_txn_ids, txn_counts, sql_template.hash, template64, drained))
+            else:
+                materialize(conn, sql_query, params, query_name)
+                if checkpoints:
+                    for table, latest_txn_id in latest_txn_ids.items():
+                        checkpoints.record(table, latest_txn_id, txn_counts.get(table, 0), table_info[table]['latest_structure_version'], templateHash=sql_template.hash, template64=template64)
+                    checkpoints.maybe_flush()
+            
+            if dirty_buckets:
                 for table in table_names:
-                    cur.execute(f"""
-                        INSERT INTO {tracking_table} (timestamp, trackingId, tableName, sequencerTxn, template64)
-                        VALUES ('{timestamp_now}', '{tracking_id}', '{table}', {table_info[table]['latest_txn_id']}, '{template64}')
-                    """)
-                conn.commit()
-        
-        # Update the latest transaction IDs
-        for table in table_names:
-            cur.execute(f"SELECT MAX(sequencerTxn) FROM wal_transactions('{table}')")
-            table_info[table]['latest_txn_id'] = cur.fetchone()[0]
+                    print(f"Bucket stats for table {table}: {dirty_buckets[table].summary()}")
 
+    if executor:
+        executor.shutdown()
+    if checkpoints:
+        checkpoints.flush()
     cur.close()
     conn.close()
 
@@ -152,6 +295,9 @@ if __name__ == "__main__":
     parser.add_argument('--thresholds', required=True, help='Comma-separated list of row thresholds corresponding to each table.')
     parser.add_argument('--sql_template_path', required=True, help='Path to the file containing the SQL template.')
     parser.add_argument('--check_interval', type=int, default=30, help='The interval (in seconds) to check for new transactions.')
+    parser.add_argument('--min_interval', type=float, help='Enable adaptive polling with this minimum interval (in seconds) under bursts.')
+    parser.add_argument('--max_interval', type=float, help='The maximum interval (in seconds) an idle table backs off to (default: check_interval).')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random jitter applied to each poll interval, as a fraction of the interval.')
     parser.add_argument('--timestamp_columns', required=True, help='Comma-separated list of timestamp columns corresponding to each table (format: table_name.column_name).')
     parser.add_argument('--dbname', default='qdb', help='The name of the database.')
     parser.add_argument('--user', default='admin', help='The database user.')
@@ -160,12 +306,27 @@ if __name__ == "__main__":
     parser.add_argument('--password', default='quest', help='The database password.')
     parser.add_argument('--tracking_table', help='The name of the tracking table.')
     parser.add_argument('--tracking_id', help='The tracking ID for this run.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker threads (and pooled connections) running the materialization in the background.')
+    parser.add_argument('--bucket_seconds', type=float, help='Materialize whole dirty time buckets of this size in seconds; 0 uses the SAMPLE BY of the template.')
+    parser.add_argument('--checkpoint_interval', type=float, default=0, help='Write progress to the tracking table at most every this many seconds (default: after every materialization).')
+    parser.add_argument('--checkpoint_txns', type=int, default=0, help='Write progress to the tracking table once this many transactions have been materialized since the last write.')
+    parser.add_argument('--snapshot_path', help='Keep a local snapshot of the checkpoints in this file and resume from it on restart.')
+    parser.add_argument('--metrics_port', type=int, help='Serve Prometheus metrics on http://127.0.0.1:<port>/metrics.')
+    parser.add_argument('--profile_path', help='Toggle a cProfile session with SIGUSR1 and write it to this path; SIGUSR2 dumps all thread stacks.')
+    parser.add_argument('--max_in_flight', type=int, default=1, help='Maximum number of materializations of the template running at the same time.')
+    parser.add_argument('--backfill_txns', type=int, default=0, help='At startup, catch up backlogs of at least this many transactions in chunks of up to this many transactions, materialized in parallel by the workers.')
+    parser.add_argument('--backfill_seconds', type=float, help='Maximum time span (in seconds) of the rows materialized by one backfill query.')
+    parser.add_argument('--max_apply_lag', type=int, help='Defer materializations while the target table has more than this many WAL transactions not applied yet.')
+    parser.add_argument('--max_defer_seconds', type=float, default=60, help='Materialize anyway once a trigger has been deferred for this many seconds; 0 defers without a limit.')
+    parser.add_argument('--target_table', help='The table the template writes, whose WAL apply lag is checked (default: the INSERT INTO table of the template).')
 
     args = parser.parse_args()
+    if args.snapshot_path and not (args.tracking_table and args.tracking_id):
+        parser.error('--snapshot_path requires --tracking_table and --tracking_id')
 
     table_names = args.table_names.split(',')
     thresholds = list(map(int, args.thresholds.split(',')))
     timestamp_columns = args.timestamp_columns.split(',')
 
-    main(table_names, thresholds, args.sql_template_path, args.check_interval, timestamp_columns, args.dbname, args.user, args.host, args.port, args.password, args.tracking_table, args.tracking_id)
+    main(table_names, thresholds, args.sql_template_path, args.check_interval, timestamp_columns, args.dbname, args.user, args.host, args.port, args.password, args.tracking_table, args.tracking_id, min_interval=args.min_interval, max_interval=args.max_interval, jitter=args.jitter, workers=args.workers, max_in_flight=args.max_in_flight, bucket_seconds=args.bucket_seconds, metrics_port=args.metrics_port, profile_path=args.profile_path, checkpoint_interval=args.checkpoint_interval, checkpoint_txns=args.checkpoint_txns, snapshot_path=args.snapshot_path, backfill_txns=args.backfill_txns, backfill_seconds=args.backfill_seconds, target_table=args.target_table, max_apply_lag=args.max_apply_lag, max_defer_seconds=args.max_defer_seconds)
 
@@ -0,0 +1,220 @@
+import cProfile
+import faulthandler
+import http.server
+import math
+import signal
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from sub-millisecond polls to minute-long materializations
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metric:
+    # A metric family in the Prometheus text format. Every combination of label
+    # values is a separate series. Metrics are updated from the main loop and
+    # from materialization worker threads, so all updates take the lock.
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"Metric {self.name} takes labels {', '.join(self.labels) or 'none'}, got {', '.join(labels) or 'none'}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def label_text(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, value in sorted(self.series.items()):
+                lines.extend(self.render_series(key, value))
+        return lines
+
+    def render_series(self, key, value):
+        return [f"{self.name}{self.label_text(key)} {format_value(value)}"]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.series[key] = value
+
+    def remove(self, **labels):
+        # Drop the series of a table this process no longer handles
+        key = self.key(labels)
+        with self.lock:
+            self.series.pop(key, None)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][index] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render_series(self, key, series):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, series['counts']):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{self.label_text(key, [('le', format_value(bound))])} {cumulative}")
+        lines.append(f"{self.name}_bucket{self.label_text(key, [('le', '+Inf')])} {series['count']}")
+        lines.append(f"{self.name}_sum{self.label_text(key)} {format_value(series['sum'])}")
+        lines.append(f"{self.name}_count{self.label_text(key)} {series['count']}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            existing = self.metrics.setdefault(metric.name, metric)
+        if type(existing) is not type(metric) or existing.labels != metric.labels:
+            raise ValueError(f"Metric {metric.name} is already registered with a different type or labels")
+        return existing
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, description, labels=()):
+    return REGISTRY.register(Counter(name, description, labels))
+
+
+def gauge(name, description, labels=()):
+    return REGISTRY.register(Gauge(name, description, labels))
+
+
+def histogram(name, description, labels=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, description, labels, buckets))
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+# Metrics shared by all scripts
+POLL_SECONDS = histogram('questdb_tracker_poll_seconds', 'Time spent polling wal_transactions for new transactions.')
+QUERY_SECONDS = histogram('questdb_tracker_query_seconds', 'Time spent running aggregation and materialization queries.', ['query'])
+QUERY_FAILURES = counter('questdb_tracker_query_failures_total', 'Aggregation and materialization queries that failed.', ['query'])
+TRACKING_WRITE_SECONDS = histogram('questdb_tracker_tracking_write_seconds', 'Time spent writing progress rows to the tracking table.')
+TRACKING_WRITE_FAILURES = counter('questdb_tracker_tracking_write_failures_total', 'Writes of progress rows to the tracking table that failed and were left for a retry.')
+TRANSACTIONS_PROCESSED = counter('questdb_tracker_transactions_processed_total', 'WAL transactions consumed by the tracker.', ['table'])
+ROWS_PROCESSED = counter('questdb_tracker_rows_processed_total', 'Rows in the WAL transactions consumed by the tracker.', ['table'])
+TXN_BACKLOG = gauge('questdb_tracker_txn_backlog', 'Transactions between the newest one seen in wal_transactions and the last one processed.', ['table'])
+LAST_PROCESSED_TXN = gauge('questdb_tracker_last_processed_txn', 'Sequencer transaction up to which the table has been processed.', ['table'])
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would otherwise flood the output
+        pass
+
+
+def start_metrics_server(port, host='127.0.0.1'):
+    # Serves /metrics from a daemon thread
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    print(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+def install_profile_signals(profile_path):
+    # SIGUSR1 starts a cProfile session on the main thread (the poll loop) and
+    # the next SIGUSR1 stops it and writes the stats to profile_path, to be read
+    # with pstats or snakeviz. SIGUSR2 dumps the stack of every thread to stderr.
+    if not hasattr(signal, 'SIGUSR1'):
+        print("Profiling signals are not available on this platform")
+        return
+    state = {'profiler': None}
+
+    def toggle(signum, frame):
+        if state['profiler'] is None:
+            state['profiler'] = cProfile.Profile()
+            state['profiler'].enable()
+            print(f"Profiling started, send SIGUSR1 again to write {profile_path}")
+        else:
+            state['profiler'].disable()
+            state['profiler'].dump_stats(profile_path)
+            state['profiler'] = None
+            print(f"Profile written to {profile_path}")
+
+    signal.signal(signal.SIGUSR1, toggle)
+    faulthandler.register(signal.SIGUSR2, file=sys.stderr, all_threads=True)
@@ -0,0 +1,116 @@
+from aggregate_state import ColumnAggregate
+from sql_template import bucket_range_filter
+
+NUMERIC_TYPES = {'BYTE', 'SHORT', 'INT', 'LONG', 'FLOAT', 'DOUBLE'}
+ORDERED_TYPES = {'TIMESTAMP', 'DATE', 'CHAR'}
+# Types no aggregate function accepts
+UNSUPPORTED_TYPES = {'BINARY'}
+
+# Every aggregate a column can have, in the order they are selected
+AGGREGATES = ('count', 'sum', 'min', 'max', 'first', 'last')
+
+
+def column_aggregates(column_type):
+    # sum (and therefore avg) only make sense for numbers, min and max for
+    # anything ordered; count, first and last work for every other type
+    base_type = column_type.upper().split('(')[0]
+    if base_type in NUMERIC_TYPES or base_type == 'DECIMAL':
+        return AGGREGATES
+    if base_type in ORDERED_TYPES:
+        return ('count', 'min', 'max', 'first', 'last')
+    if base_type in UNSUPPORTED_TYPES or base_type.endswith('[]'):
+        return ()
+    return ('count', 'first', 'last')
+
+
+class AggregationPlan:
+    # The validated columns of one structure version of a table, their types
+    # and the prebuilt aggregation statement, grouped by time bucket of
+    # bucket_seconds, with a {filter} spot for the ranges of recomputed buckets
+    # and appended rows
+    def __init__(self, table_name, timestamp_column, requested_columns, column_types, structure_version, bucket_seconds):
+        self.structure_version = structure_version
+        self.timestamp_column = timestamp_column
+        self.requested_columns = requested_columns
+        self.column_types = column_types
+        if timestamp_column not in column_types:
+            raise ValueError(f"Timestamp column {timestamp_column} does not exist in table {table_name}")
+
+        self.aggregates = {}
+        self.skipped = []
+        for col in requested_columns:
+            if col not in column_types:
+                self.skipped.append(f"{col} (no such column)")
+                continue
+            aggregates = column_aggregates(column_types[col])
+            if not aggregates:
+                self.skipped.append(f"{col} ({column_types[col]} cannot be aggregated)")
+                continue
+            self.aggregates[col] = aggregates
+        self.columns = list(self.aggregates)
+
+        # Bucket indexes are computed on the server from epoch microseconds
+        selections = [f"cast({timestamp_column} AS LONG) / {int(bucket_seconds * 1000000)} AS bucket_index"]
+        selections += [f"{name}({col}) AS {col}_{name}" for col, aggregates in self.aggregates.items() for name in aggregates]
+        selections += [f"min({timestamp_column}) AS first_ts", f"max({timestamp_column}) AS last_ts"]
+        self.sql = f"""
+        SELECT {', '.join(selections)}
+        FROM {table_name}
+        WHERE {{filter}}
+        GROUP BY bucket_index
+        """
+
+    def query(self, ranges):
+        # The statement and its parameters for the (start, end) ranges to read
+        filter_sql, params = bucket_range_filter([(self.timestamp_column, ranges)])
+        return self.sql.replace('{filter}', filter_sql), params
+
+    def buckets_from_rows(self, rows):
+        # The partial state of every bucket with rows, by bucket index
+        return {row[0]: self.delta_from_row(row[1:]) for row in rows}
+
+    def delta_from_row(self, row):
+        # Columns without an aggregate keep None for it, so avg() of a
+        # non-numeric column is None rather than a failed query. Skipped
+        # columns get an empty aggregate.
+        first_ts, last_ts = row[-2], row[-1]
+        delta = {col: ColumnAggregate() for col in self.requested_columns}
+        position = 0
+        for col, aggregates in self.aggregates.items():
+            values = dict(zip(aggregates, row[position:position + len(aggregates)]))
+            position += len(aggregates)
+            delta[col] = ColumnAggregate(
+                values['count'] or 0, values.get('sum'), values.get('min'), values.get('max'),
+                values['first'], first_ts, values['last'], last_ts
+            )
+        return delta
+
+
+class PlanCache:
+    # Aggregation plans of a table keyed by structure version. The columns are
+    # only looked up again through table_columns() when the version changes or
+    # a query built from the current plan failed.
+    def __init__(self, table_name, columns, timestamp_column, bucket_seconds):
+        self.table_name = table_name
+        self.columns = columns
+        self.timestamp_column = timestamp_column
+        self.bucket_seconds = bucket_seconds
+        self.plans = {}
+        self.skipped = []
+
+    def plan(self, cur, structure_version):
+        plan = self.plans.get(structure_version)
+        if plan is None:
+            cur.execute(f"SELECT \"column\", type FROM table_columns('{self.table_name}')")
+            column_types = {name: column_type for name, column_type in cur.fetchall()}
+            plan = AggregationPlan(self.table_name, self.timestamp_column, self.columns, column_types, structure_version, self.bucket_seconds)
+            # Plans of older versions are never used again
+            self.plans = {structure_version: plan}
+            # Only report skipped columns when they differ from the previous version
+            if plan.skipped and plan.skipped != self.skipped:
+                print(f"Structure version {structure_version} of table {self.table_name}: skipping {', '.join(plan.skipped)}")
+            self.skipped = plan.skipped
+        return plan
+
+    def invalidate(self):
+        self.plans = {}
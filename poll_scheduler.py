@@ -0,0 +1,110 @@
+import datetime
+import random
+import time
+
+from txn_window import to_datetime
+
+
+def utc_now():
+    # QuestDB returns naive UTC timestamps over PGWire, so compare against naive UTC
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+class AdaptiveScheduler:
+    # Keeps one poll interval per table. Tables that keep receiving transactions
+    # are polled at (roughly) their arrival rate, down to min_interval; idle tables
+    # back off exponentially up to max_interval. When min_interval equals
+    # max_interval this behaves like the original fixed time.sleep(check_interval).
+    def __init__(self, tables, min_interval, max_interval, jitter=0.0, backoff=2.0, smoothing=0.5):
+        if min_interval <= 0 or max_interval < min_interval:
+            raise ValueError(f"Invalid poll interval range: {min_interval} to {max_interval}")
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.backoff = backoff
+        self.smoothing = smoothing
+        now = time.monotonic()
+        self.state = {}
+        for table in tables:
+            self.state[table] = {
+                'interval': max_interval,
+                'next_due': now + max_interval,
+                'last_poll': now,
+                'rate': 0.0,
+                'last_seen_txn': None,
+                'detection_lag': None
+            }
+
+    def add_table(self, table):
+        # Tables added while running (for example after taking over a lease) are polled right away
+        if table not in self.state:
+            now = time.monotonic()
+            self.state[table] = {
+                'interval': self.min_interval,
+                'next_due': now,
+                'last_poll': now,
+                'rate': 0.0,
+                'last_seen_txn': None,
+                'detection_lag': None
+            }
+
+    def remove_table(self, table):
+        self.state.pop(table, None)
+
+    def due_tables(self, now=None):
+        now = time.monotonic() if now is None else now
+        return [table for table, info in self.state.items() if info['next_due'] <= now]
+
+    def wait(self, timeout=None):
+        # Sleep until at least one table is due (or timeout seconds passed) and return the due tables
+        if self.state:
+            delay = min(info['next_due'] for info in self.state.values()) - time.monotonic()
+        else:
+            delay = self.max_interval
+        if timeout is not None:
+            delay = min(delay, timeout)
+        if delay > 0:
+            time.sleep(delay)
+        return self.due_tables()
+
+    def observe(self, table, window):
+        # window is the TxnWindow of the poll, including the commit timestamp
+        # column. Transactions already seen on a previous poll (for example
+        # because a row threshold was not met yet) are ignored.
+        info = self.state[table]
+        now = time.monotonic()
+        start = window.after(info['last_seen_txn'])
+        fresh = len(window) - start
+
+        elapsed = max(now - info['last_poll'], 1e-6)
+        info['rate'] = self.smoothing * (fresh / elapsed) + (1 - self.smoothing) * info['rate']
+        info['last_poll'] = now
+
+        if fresh:
+            info['last_seen_txn'] = window.last_txn
+            first_commit = to_datetime(window.minimum('timestamp', start))
+            if first_commit is not None:
+                info['detection_lag'] = (utc_now() - first_commit).total_seconds()
+            # Poll again after the expected gap between transactions
+            interval = 1.0 / info['rate'] if info['rate'] > 0 else self.min_interval
+        else:
+            interval = info['interval'] * self.backoff
+
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        info['interval'] = interval
+        if self.jitter:
+            interval *= 1 + random.uniform(-self.jitter, self.jitter)
+        info['next_due'] = now + interval
+        return fresh
+
+    def detection_lag(self, table):
+        # Seconds between the commit of the oldest newly detected transaction and
+        # the poll that detected it, or None if nothing has been detected yet
+        return self.state[table]['detection_lag']
+
+
+def scheduler_from_args(tables, check_interval, min_interval=None, max_interval=None, jitter=0.0):
+    # Without --min_interval the scripts keep their fixed check_interval polling
+    max_interval = check_interval if max_interval is None else max_interval
+    min_interval = max_interval if min_interval is None else min_interval
+    return AdaptiveScheduler(tables, min_interval, max_interval, jitter=jitter)
@@ -0,0 +1,138 @@
+import datetime
+import hashlib
+import heapq
+import itertools
+
+import psycopg2
+
+_cursor_ids = itertools.count()
+
+
+class RowStream:
+    # Streams the rows of a timestamp range while holding at most itersize rows
+    # in memory. Rows come from a named (server-side) cursor that is fetched
+    # itersize rows at a time. Servers that reject DECLARE CURSOR are read in
+    # pages of itersize rows instead, continuing from the last timestamp seen.
+    def __init__(self, conn, table_name, columns, timestamp_column, itersize=2000):
+        self.conn = conn
+        self.table_name = table_name
+        self.timestamp_column = timestamp_column
+        self.select(columns)
+        self.itersize = itersize
+        self.server_cursors = True
+
+    def select(self, columns):
+        # The timestamp always comes first, it orders the rows and ages out dedup state
+        self.columns = [self.timestamp_column] + [col for col in columns if col != self.timestamp_column]
+
+    def rows(self, min_timestamp, max_timestamp):
+        if self.server_cursors:
+            yielded = 0
+            try:
+                for row in self._server_cursor_rows(min_timestamp, max_timestamp):
+                    yielded += 1
+                    yield row
+                return
+            except psycopg2.Error as exc:
+                if yielded:
+                    raise
+                self.conn.rollback()
+                self.server_cursors = False
+                print(f"Server-side cursors are not available ({str(exc).strip()}), reading rows in pages of {self.itersize}")
+        yield from self._paged_rows(min_timestamp, max_timestamp)
+
+    def _server_cursor_rows(self, min_timestamp, max_timestamp):
+        cur = self.conn.cursor(name=f"rows_{self.table_name}_{next(_cursor_ids)}")
+        cur.itersize = self.itersize
+        try:
+            cur.execute(f"""
+                SELECT {', '.join(self.columns)}
+                FROM {self.table_name}
+                WHERE {self.timestamp_column} >= %s AND {self.timestamp_column} <= %s
+            """, (min_timestamp, max_timestamp))
+            yield from cur
+        finally:
+            cur.close()
+            self.conn.commit()
+
+    def _paged_rows(self, min_timestamp, max_timestamp):
+        # Each page restarts at the last timestamp read and skips the rows that
+        # share it, so duplicate timestamps at a page boundary are neither lost
+        # nor read twice
+        cur = self.conn.cursor()
+        lower = min_timestamp
+        skip = 0
+        try:
+            while True:
+                cur.execute(f"""
+                    SELECT {', '.join(self.columns)}
+                    FROM {self.table_name}
+                    WHERE {self.timestamp_column} >= %s AND {self.timestamp_column} <= %s
+                    ORDER BY {self.timestamp_column}
+                    LIMIT %s, %s
+                """, (lower, max_timestamp, skip, skip + self.itersize))
+                page = cur.fetchall()
+                for row in page:
+                    if row[0] == lower:
+                        skip += 1
+                    else:
+                        lower, skip = row[0], 1
+                    yield row
+                if len(page) < self.itersize:
+                    return
+        finally:
+            cur.close()
+
+
+class RowDeduplicator:
+    # Drops rows that an earlier, overlapping window already emitted. Out-of-order
+    # commits make the timestamp range of new transactions overlap rows that
+    # were streamed before, and there is no transaction id on a row to tell
+    # them apart. Rows are therefore matched by a digest of their values. The
+    # digests are counted, so a window emits a row only as many more times as
+    # it holds it than any earlier window did, and genuinely identical rows
+    # are not lost. Only rows up to the newest timestamp emitted before a
+    # window can be duplicates, so only those are counted per window.
+    # Digests are kept in a heap by timestamp, so the ones older than
+    # window_seconds behind the newest timestamp seen are dropped oldest first
+    # without scanning the rest, and at most max_digests are kept. Overlaps
+    # reaching further back than that are emitted again.
+    def __init__(self, window_seconds=3600, max_digests=1000000):
+        self.window = datetime.timedelta(seconds=window_seconds)
+        self.max_digests = max_digests
+        # digest -> times emitted
+        self.seen = {}
+        # (timestamp, digest) of every digest in seen
+        self.expiry = []
+        self.newest = None
+        self.duplicates = 0
+
+    def filter(self, rows):
+        # rows must carry their timestamp first, as produced by RowStream
+        overlap_end = self.newest
+        # digest -> times seen in this window, for rows in the overlap only
+        counts = {}
+        for row in rows:
+            timestamp = row[0]
+            digest = hashlib.blake2b(repr(row).encode('utf-8'), digest_size=16).digest()
+            emitted = self.seen.get(digest, 0)
+            if overlap_end is not None and (timestamp is None or timestamp <= overlap_end):
+                counts[digest] = counts.get(digest, 0) + 1
+                if counts[digest] <= emitted:
+                    self.duplicates += 1
+                    continue
+            if not emitted and timestamp is not None:
+                heapq.heappush(self.expiry, (timestamp, digest))
+            self.seen[digest] = emitted + 1
+            if timestamp is not None and (self.newest is None or timestamp > self.newest):
+                self.newest = timestamp
+            yield row
+        self.expire()
+
+    def expire(self):
+        if self.newest is None:
+            return
+        horizon = self.newest - self.window
+        while self.expiry and (self.expiry[0][0] < horizon or len(self.expiry) > self.max_digests):
+            _, digest = heapq.heappop(self.expiry)
+            del self.seen[digest]
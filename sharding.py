@@ -0,0 +1,110 @@
+import bisect
+import datetime
+import hashlib
+
+from poll_scheduler import utc_now
+
+WORKER_PREFIX = 'worker:'
+
+
+def stable_hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing:
+    # Consistent hashing of table names onto workers. Adding or removing a worker
+    # only moves the tables that hash next to it.
+    def __init__(self, workers, replicas=64):
+        self.ring = sorted((stable_hash(f"{worker}#{i}"), worker) for worker in workers for i in range(replicas))
+        self.hashes = [point for point, _ in self.ring]
+
+    def owner(self, key):
+        if not self.ring:
+            return None
+        index = bisect.bisect(self.hashes, stable_hash(key)) % len(self.ring)
+        return self.ring[index][1]
+
+
+class LeaseManager:
+    # Table ownership through lease rows stored next to the progress rows in the
+    # tracking table, under trackingId '<tracking_id>.lease'. Every worker writes
+    # a heartbeat row ('worker:<id>'), hashes the tables onto the live workers
+    # and keeps a lease on the tables that map to itself. A table is only taken
+    # over once the previous owner's lease has expired, so the tables of a worker
+    # that dies fail over after at most lease_seconds.
+    def __init__(self, conn, tracking_table, tracking_id, worker_id, lease_seconds=30):
+        self.conn = conn
+        self.tracking_table = tracking_table
+        self.lease_id = f"{tracking_id}.lease"
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.owned = set()
+
+    def create_columns(self):
+        cur = self.conn.cursor()
+        cur.execute(f"ALTER TABLE {self.tracking_table} ADD COLUMN IF NOT EXISTS leaseOwner SYMBOL")
+        cur.execute(f"ALTER TABLE {self.tracking_table} ADD COLUMN IF NOT EXISTS leaseExpiry TIMESTAMP")
+        self.conn.commit()
+        cur.close()
+
+    def read_leases(self, cur):
+        cur.execute(f"""
+            SELECT tableName, leaseOwner, leaseExpiry
+            FROM {self.tracking_table}
+            WHERE trackingId = '{self.lease_id}'
+            LATEST ON timestamp
+            PARTITION BY tableName;
+        """)
+        return {row[0]: (row[1], row[2]) for row in cur.fetchall()}
+
+    def refresh(self, tables):
+        # Renew the heartbeat and leases, claim unowned tables that hash to this
+        # worker and return the set of tables this worker owns. A claim only
+        # counts once it can be read back, as WAL tables apply writes
+        # asynchronously and a concurrent claim may win.
+        cur = self.conn.cursor()
+        now = utc_now()
+        leases = self.read_leases(cur)
+
+        live_workers = {self.worker_id}
+        for name, (owner, expiry) in leases.items():
+            if name.startswith(WORKER_PREFIX) and expiry is not None and expiry > now:
+                live_workers.add(owner)
+        ring = HashRing(sorted(live_workers))
+
+        self.owned = set()
+        claims = []
+        for table in tables:
+            owner, expiry = leases.get(table, (None, None))
+            lease_expired = expiry is None or expiry <= now
+            if owner == self.worker_id and not lease_expired:
+                self.owned.add(table)
+            if ring.owner(table) != self.worker_id:
+                # Stop renewing tables that now belong to another worker so it can take over
+                self.owned.discard(table)
+                continue
+            if owner == self.worker_id or lease_expired:
+                claims.append(table)
+
+        self.write_leases(cur, claims, now, now + datetime.timedelta(seconds=self.lease_seconds))
+        cur.close()
+        return self.owned
+
+    def write_leases(self, cur, tables, now, expiry):
+        # Heartbeat and table leases go out as a single multi-row insert
+        rows = [f"{WORKER_PREFIX}{self.worker_id}"] + list(tables)
+        cur.execute(
+            f"INSERT INTO {self.tracking_table} (timestamp, trackingId, tableName, leaseOwner, leaseExpiry) VALUES "
+            + ", ".join(["(%s, %s, %s, %s, %s)"] * len(rows)),
+            [value for name in rows for value in (now, self.lease_id, name, self.worker_id, expiry)]
+        )
+        self.conn.commit()
+
+    def release(self, tables=None):
+        # Expire this worker's leases (and heartbeat) right away on a clean shutdown
+        tables = self.owned if tables is None else tables
+        now = utc_now()
+        cur = self.conn.cursor()
+        self.write_leases(cur, sorted(tables), now, now)
+        cur.close()
+        self.owned = set()
@@ -0,0 +1,116 @@
+import base64
+import hashlib
+import os
+import re
+
+# The table an INSERT INTO ... SELECT template writes, with QuestDB's optional ATOMIC or BATCH n
+INSERT_TARGET_PATTERN = re.compile(r'\bINSERT\s+(?:ATOMIC\s+|BATCH\s+\d+\s+)?INTO\s+"?(\w+)"?', re.I)
+
+# Placeholders a template may use. Each one is bound to a SQL fragment that
+# refers to its values through %s parameters.
+PLACEHOLDERS = {
+    'timestamp_txn_filter': 'filter',
+}
+
+# Only the known placeholders are substituted, so other braces such as regex
+# quantifiers ('[0-9]{3}') stay literal
+PLACEHOLDER_PATTERN = re.compile(r'\{(' + '|'.join(map(re.escape, PLACEHOLDERS)) + r')\}')
+
+
+class SqlTemplate:
+    # A SQL template file compiled once into literal parts and placeholders. The
+    # file is only read again when its mtime changes.
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.text = None
+        self.parts = []
+        self.hash = None
+        self.reload_if_changed()
+
+    def reload_if_changed(self):
+        mtime = os.stat(self.path).st_mtime
+        if mtime == self.mtime:
+            return False
+        with open(self.path, 'r') as file:
+            text = file.read()
+        self.parts = compile_template(text)
+        self.text = text
+        self.mtime = mtime
+        self.hash = hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+        return True
+
+    def encoded(self):
+        return base64.b64encode(self.text.encode('utf-8')).decode('utf-8')
+
+    def bind(self, **fragments):
+        # fragments maps each placeholder to a (sql, params) pair. Returns the
+        # query and its parameters, ready for cursor.execute(query, params).
+        sql = []
+        params = []
+        for kind, value in self.parts:
+            if kind == 'literal':
+                sql.append(value)
+                continue
+            if value not in fragments:
+                raise ValueError(f"No value bound for placeholder {{{value}}} in {self.path}")
+            fragment, fragment_params = fragments[value]
+            sql.append(fragment)
+            params.extend(fragment_params)
+        return ''.join(sql), params
+
+
+def compile_template(text):
+    parts = []
+    position = 0
+    for match in PLACEHOLDER_PATTERN.finditer(text):
+        name = match.group(1)
+        # Literal % signs must be escaped because the query is executed with parameters
+        parts.append(('literal', text[position:match.start()].replace('%', '%%')))
+        parts.append(('placeholder', name))
+        position = match.end()
+    parts.append(('literal', text[position:].replace('%', '%%')))
+    return parts
+
+
+def insert_target(text):
+    match = INSERT_TARGET_PATTERN.search(text)
+    return match.group(1) if match else None
+
+
+def timestamp_range_filter(ranges):
+    # ranges is a list of (column, min_timestamp, max_timestamp)
+    sql = " AND ".join(f"{col} >= %s AND {col} <= %s" for col, _, _ in ranges)
+    params = [value for _, min_timestamp, max_timestamp in ranges for value in (min_timestamp, max_timestamp)]
+    return sql, params
+
+
+def lookback_filter(columns, lookback_seconds, earliest_timestamp):
+    sql = " AND ".join(f"{col} >= dateadd('s', %s, %s)" for col in columns)
+    params = [value for _ in columns for value in (-lookback_seconds, earliest_timestamp)]
+    return sql, params
+
+
+def lookback_range_filter(columns, lookback_seconds, earliest_timestamp, latest_timestamp):
+    # Like lookback_filter, but bounded above by the latest timestamp plus the lookback
+    sql = " AND ".join(f"{col} >= dateadd('s', %s, %s) AND {col} <= dateadd('s', %s, %s)" for col in columns)
+    params = [value for _ in columns for value in (-lookback_seconds, earliest_timestamp, lookback_seconds, latest_timestamp)]
+    return sql, params
+
+
+def bucket_range_filter(column_ranges):
+    # column_ranges is a list of (column, ranges) where ranges are the merged
+    # (start, end) dirty bucket ranges of that column; end may be None
+    sql = []
+    params = []
+    for col, ranges in column_ranges:
+        conditions = []
+        for start, end in ranges:
+            if end is None:
+                conditions.append(f"{col} >= %s")
+                params.append(start)
+            else:
+                conditions.append(f"{col} >= %s AND {col} < %s")
+                params.extend((start, end))
+        sql.append(f"({' OR '.join(conditions)})")
+    return " AND ".join(sql), params
@@ -0,0 +1,96 @@
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from psycopg2.pool import ThreadedConnectionPool
+
+
+class TableExecutor:
+    # Runs materialization jobs on a bounded set of worker threads. Each job
+    # borrows its own connection from a shared pool, so a slow query only ties up
+    # one worker while the main loop keeps polling. max_workers is the global
+    # concurrency cap and per_table_limit caps the jobs in flight per key.
+    def __init__(self, connect_kwargs, max_workers, per_table_limit=1):
+        self.pool = ThreadedConnectionPool(1, max_workers, **connect_kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='materialize')
+        self.per_table_limit = per_table_limit
+        self.in_flight = {}
+        self.finished = []
+        self.lock = threading.Lock()
+
+    def busy(self, key):
+        with self.lock:
+            return self.in_flight.get(key, 0) >= self.per_table_limit
+
+    def submit(self, key, fn, *args):
+        # fn is called as fn(conn, *args) on a worker thread and the connection is
+        # committed afterwards. Returns None when key is already at its limit.
+        with self.lock:
+            if self.in_flight.get(key, 0) >= self.per_table_limit:
+                return None
+            self.in_flight[key] = self.in_flight.get(key, 0) + 1
+        future = self.executor.submit(self._run, fn, args)
+        future.add_done_callback(lambda done: self._release(key, done))
+        return future
+
+    def _run(self, fn, args):
+        conn = self.pool.getconn()
+        try:
+            result = fn(conn, *args)
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn)
+
+    def _release(self, key, future):
+        with self.lock:
+            self.in_flight[key] -= 1
+            # Keys can be one-off, such as backfill chunks
+            if not self.in_flight[key]:
+                del self.in_flight[key]
+            self.finished.append((key, future))
+
+    def completed(self):
+        # Jobs finished since the last call, as (key, future) pairs. The main loop
+        # applies their results so table state is only touched from one thread.
+        with self.lock:
+            finished, self.finished = self.finished, []
+        return finished
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        self.pool.closeall()
+
+
+class OrderedResults:
+    # Bookkeeping of submitted jobs per key in submission order. With several
+    # jobs of a key in flight they can finish out of order, but the progress of
+    # a job may only be checkpointed once every earlier job of its key
+    # succeeded, like the ordered commit of backfill chunks. Jobs submitted
+    # before a failure of their key was seen are reported as failed as well, so
+    # their progress is rolled back and redone rather than checkpointed past
+    # the failed range.
+    def __init__(self):
+        self.jobs = {}
+
+    def add(self, key, future, payload):
+        self.jobs.setdefault(key, collections.deque()).append([future, payload, None])
+
+    def ready(self):
+        # (payload, exception) of the finished jobs that are next in order, oldest first per key
+        ready = []
+        for key in list(self.jobs):
+            jobs = self.jobs[key]
+            while jobs and jobs[0][0].done():
+                future, payload, error = jobs.popleft()
+                error = error or future.exception()
+                ready.append((payload, error))
+                if error:
+                    for job in jobs:
+                        job[2] = job[2] or error
+            if not jobs:
+                del self.jobs[key]
+        return ready
@@ -0,0 +1,146 @@
+import datetime
+import unittest
+
+from aggregate_state import AggregateState, ColumnAggregate
+from plan_cache import AggregationPlan
+
+T0 = datetime.datetime(2024, 7, 29, 11, 0, 0)
+
+
+def ts(seconds):
+    return T0 + datetime.timedelta(seconds=seconds)
+
+
+class ColumnAggregateMergeTest(unittest.TestCase):
+    def test_merge_combines_statistics(self):
+        merged = ColumnAggregate(2, 10, 4, 6, 4, ts(0), 6, ts(10))
+        merged.merge(ColumnAggregate(3, 30, 1, 20, 20, ts(20), 1, ts(30)))
+        self.assertEqual(merged.count, 5)
+        self.assertEqual(merged.total, 40)
+        self.assertEqual(merged.minimum, 1)
+        self.assertEqual(merged.maximum, 20)
+        self.assertEqual((merged.first, merged.first_ts), (4, ts(0)))
+        self.assertEqual((merged.last, merged.last_ts), (1, ts(30)))
+        self.assertEqual(merged.avg(), 8)
+
+    def test_merge_out_of_order_keeps_first_and_last_by_timestamp(self):
+        merged = ColumnAggregate(1, 5, 5, 5, 5, ts(10), 5, ts(10))
+        merged.merge(ColumnAggregate(1, 7, 7, 7, 7, ts(0), 7, ts(0)))
+        self.assertEqual((merged.first, merged.first_ts), (7, ts(0)))
+        self.assertEqual((merged.last, merged.last_ts), (5, ts(10)))
+
+    def test_merge_empty_is_a_no_op(self):
+        merged = ColumnAggregate(1, 5, 5, 5, 5, ts(0), 5, ts(0))
+        merged.merge(ColumnAggregate())
+        self.assertEqual(merged.summary(), {'count': 1, 'first': 5, 'last': 5, 'min': 5, 'max': 5, 'avg': 5})
+
+    def test_merge_without_sum_has_no_avg(self):
+        merged = ColumnAggregate(1, None, 'a', 'a', 'a', ts(0), 'a', ts(0))
+        merged.merge(ColumnAggregate(1, None, 'b', 'b', 'b', ts(1), 'b', ts(1)))
+        self.assertEqual(merged.count, 2)
+        self.assertIsNone(merged.avg())
+
+
+class AggregateStateTest(unittest.TestCase):
+    def bucket(self, count, total, first_ts, last_ts):
+        return {'v': ColumnAggregate(count, total, 1, 1, 1, first_ts, 1, last_ts)}
+
+    def test_in_order_transactions_append_their_range(self):
+        state = AggregateState(['v'], 3600)
+        bucket = state.index(ts(0))
+        recomputed, append, late = state.ranges([(ts(0), ts(60))])
+        self.assertEqual((recomputed, late), ([], 0))
+        self.assertEqual(append, (ts(0), ts(60) + datetime.timedelta(microseconds=1)))
+        state.apply(recomputed, {bucket: self.bucket(100, 100, ts(0), ts(60))})
+
+        # The next transaction starts after everything merged: only its own rows are read
+        recomputed, append, late = state.ranges([(ts(61), ts(120))])
+        self.assertEqual(recomputed, [])
+        self.assertEqual(append[0], ts(61))
+        delta = state.apply(recomputed, {bucket: self.bucket(10, 10, ts(61), ts(120))})
+        self.assertEqual(delta['v'].count, 10)
+        self.assertEqual(state.aggregates['v'].count, 110)
+        self.assertEqual(state.merged_until, ts(120))
+
+    def test_out_of_order_transaction_replaces_instead_of_adding(self):
+        # A transaction touching an hour that was already aggregated: the
+        # recomputed bucket holds the old rows and the new ones
+        state = AggregateState(['v'], 3600)
+        bucket = state.index(ts(0))
+        state.apply([], {bucket: self.bucket(100, 100, ts(0), ts(60))})
+        recomputed, append, late = state.ranges([(ts(30), ts(40))])
+        self.assertEqual(recomputed, [(ts(0), ts(3600))])
+        self.assertIsNone(append)
+        delta = state.apply(recomputed, {bucket: self.bucket(110, 110, ts(0), ts(60))})
+        self.assertEqual(delta['v'].count, 110)
+        self.assertEqual(state.aggregates['v'].count, 110)
+        self.assertEqual(state.aggregates['v'].total, 110)
+
+        # The same bucket recomputed again without new rows changes nothing
+        state.apply(recomputed, {bucket: self.bucket(110, 110, ts(0), ts(60))})
+        self.assertEqual(state.aggregates['v'].count, 110)
+
+    def test_mixed_window_recomputes_and_appends(self):
+        state = AggregateState(['v'], 3600)
+        first, second = state.index(ts(0)), state.index(ts(3600))
+        state.apply([], {first: self.bucket(10, 20, ts(0), ts(10))})
+        recomputed, append, late = state.ranges([(ts(5), ts(6)), (ts(3600), ts(3601))])
+        self.assertEqual(recomputed, [(ts(0), ts(3600))])
+        self.assertEqual(append[0], ts(3600))
+        state.apply(recomputed, {first: self.bucket(11, 21, ts(0), ts(10)), second: self.bucket(5, 5, ts(3600), ts(3601))})
+        self.assertEqual(state.aggregates['v'].count, 16)
+        self.assertEqual(state.aggregates['v'].total, 26)
+        self.assertEqual(state.aggregates['v'].last_ts, ts(3601))
+
+    def test_recomputed_range_without_rows_drops_its_buckets(self):
+        state = AggregateState(['v'], 3600)
+        state.apply([], {state.index(ts(0)): self.bucket(3, 3, ts(0), ts(1))})
+        state.apply([(ts(0), ts(3600))], {})
+        self.assertEqual(state.aggregates['v'].count, 0)
+
+    def test_old_buckets_are_folded_into_the_base(self):
+        state = AggregateState(['v'], 3600, open_buckets=2)
+        for hour in range(5):
+            state.apply([], {state.index(ts(hour * 3600)): self.bucket(1, 1, ts(hour * 3600), ts(hour * 3600))})
+        self.assertEqual(sorted(state.buckets), [state.index(ts(3 * 3600)), state.index(ts(4 * 3600))])
+        self.assertEqual(state.base['v'].count, 3)
+        self.assertEqual(state.aggregates['v'].count, 5)
+        self.assertEqual(state.folded_until, ts(3 * 3600))
+
+        # Out-of-order rows in folded buckets are skipped, the open part is recomputed
+        recomputed, append, late = state.ranges([(ts(0), ts(1)), (ts(2 * 3600), ts(3 * 3600 + 1))])
+        self.assertEqual(late, 2)
+        self.assertEqual(recomputed, [(ts(3 * 3600), ts(4 * 3600))])
+        self.assertIsNone(append)
+
+    def test_encode_decode_round_trip(self):
+        state = AggregateState(['v'], 3600, open_buckets=1)
+        state.apply([], {state.index(ts(0)): self.bucket(3, 6, ts(0), ts(1)), state.index(ts(3600)): self.bucket(1, 1, ts(3600), ts(3600))})
+        restored = AggregateState.decode(['v'], 3600, state.encode(), open_buckets=1)
+        self.assertEqual(restored.buckets.keys(), state.buckets.keys())
+        self.assertEqual(restored.base['v'].summary(), state.base['v'].summary())
+        self.assertEqual(restored.aggregates['v'].summary(), state.aggregates['v'].summary())
+        self.assertEqual((restored.horizon, restored.merged_until), (state.horizon, ts(3600)))
+        # Buckets of another size cannot be reused
+        self.assertIsNone(AggregateState.decode(['v'], 60, state.encode()))
+
+
+class AggregationPlanTest(unittest.TestCase):
+    def test_query_groups_by_bucket_over_ranges(self):
+        plan = AggregationPlan('trades', 'timestamp', ['price', 'side'], {'timestamp': 'TIMESTAMP', 'price': 'DOUBLE', 'side': 'SYMBOL'}, 1, 3600)
+        sql, params = plan.query([(ts(0), ts(3600)), (ts(7200), ts(10800))])
+        self.assertIn('cast(timestamp AS LONG) / 3600000000 AS bucket_index', sql)
+        self.assertIn('GROUP BY bucket_index', sql)
+        self.assertIn('(timestamp >= %s AND timestamp < %s OR timestamp >= %s AND timestamp < %s)', sql)
+        self.assertEqual(params, [ts(0), ts(3600), ts(7200), ts(10800)])
+
+        # bucket_index, price count/sum/min/max/first/last, side count/first/last, first_ts, last_ts
+        buckets = plan.buckets_from_rows([(5, 2, 3.0, 1.0, 2.0, 1.0, 2.0, 2, 'b', 's', ts(0), ts(1))])
+        self.assertEqual(list(buckets), [5])
+        self.assertEqual(buckets[5]['price'].avg(), 1.5)
+        self.assertEqual(buckets[5]['side'].count, 2)
+        self.assertIsNone(buckets[5]['side'].avg())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+
+import psycopg2
+
+from checkpoints import CheckpointManager
+
+
+class FlakyConnection:
+    # Records the executed inserts; the first `failures` writes fail as if the tracking table were gone
+    def __init__(self, failures):
+        self.failures = failures
+        self.inserts = []
+        self.rollbacks = 0
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params=None):
+        if self.failures:
+            self.failures -= 1
+            raise psycopg2.OperationalError('table does not exist [table=tracker]')
+        self.inserts.append(params)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        pass
+
+
+class CheckpointManagerTest(unittest.TestCase):
+    def test_failed_flush_stays_pending_and_is_retried(self):
+        conn = FlakyConnection(failures=1)
+        checkpoints = CheckpointManager(conn, 'tracker', 'run')
+        checkpoints.record('trades', 10, 2)
+        checkpoints.maybe_flush()
+        self.assertEqual(conn.rollbacks, 1)
+        self.assertIn('trades', checkpoints.pending)
+
+        checkpoints.record('trades', 12, 1)
+        checkpoints.maybe_flush()
+        self.assertEqual(len(conn.inserts), 1)
+        self.assertIn(12, conn.inserts[0])
+        self.assertEqual(checkpoints.pending, {})
+
+    def test_flush_raises(self):
+        checkpoints = CheckpointManager(FlakyConnection(failures=1), 'tracker', 'run')
+        checkpoints.record('trades', 10, 2)
+        with self.assertRaises(psycopg2.Error):
+            checkpoints.flush()
+        self.assertIn('trades', checkpoints.pending)
+
+    def test_discarded_table_is_not_written(self):
+        conn = FlakyConnection(failures=1)
+        checkpoints = CheckpointManager(conn, 'tracker', 'run')
+        checkpoints.record('trades', 10, 1)
+        checkpoints.record('quotes', 20, 1)
+        checkpoints.maybe_flush()
+        # trades was handed to another worker while its checkpoint was pending
+        checkpoints.discard('trades')
+        checkpoints.flush()
+        self.assertEqual(len(conn.inserts), 1)
+        self.assertIn('quotes', conn.inserts[0])
+        self.assertNotIn('trades', conn.inserts[0])
+
+    def test_before_flush_errors_propagate(self):
+        def failing_sink():
+            raise BrokenPipeError()
+
+        checkpoints = CheckpointManager(FlakyConnection(failures=0), 'tracker', 'run', before_flush=failing_sink)
+        checkpoints.record('trades', 10, 2)
+        with self.assertRaises(BrokenPipeError):
+            checkpoints.maybe_flush()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import datetime
+import unittest
+
+from dirty_buckets import DirtyBuckets, sample_by_seconds
+
+T0 = datetime.datetime(2024, 7, 29, 11, 0, 0)
+
+
+def ts(minutes):
+    return T0 + datetime.timedelta(minutes=minutes)
+
+
+class DirtyBucketsTest(unittest.TestCase):
+    def test_drain_returns_aligned_ranges_and_clears(self):
+        buckets = DirtyBuckets(600)
+        buckets.mark(ts(3), ts(14))
+        self.assertEqual(buckets.drain(), [(ts(0), ts(20))])
+        self.assertFalse(buckets)
+        self.assertEqual(buckets.drain(), [])
+
+    def test_overlapping_and_adjacent_marks_merge(self):
+        buckets = DirtyBuckets(600)
+        buckets.mark(ts(0), ts(5), rows=10)
+        buckets.mark(ts(4), ts(9), rows=5)
+        buckets.mark(ts(10), ts(12), rows=1)
+        buckets.mark(ts(60), ts(61), rows=2)
+        self.assertEqual(buckets.drain(), [(ts(0), ts(20)), (ts(60), ts(70))])
+        self.assertEqual(buckets.stats['rows_coalesced'], 5)
+        self.assertEqual(buckets.stats['buckets_materialized'], 3)
+        self.assertEqual(buckets.stats['buckets_spanned'], 7)
+
+    def test_open_ended_mark(self):
+        buckets = DirtyBuckets(600)
+        buckets.mark(ts(30), ts(35))
+        buckets.mark(ts(25))
+        self.assertEqual(buckets.drain(), [(ts(20), None)])
+
+    def test_restore_marks_drained_ranges_again(self):
+        buckets = DirtyBuckets(600)
+        buckets.mark(ts(0), ts(5))
+        buckets.mark(ts(60), ts(65))
+        drained = buckets.drain()
+        buckets.mark(ts(12), ts(13))
+        buckets.restore(drained)
+        self.assertEqual(buckets.drain(), [(ts(0), ts(20)), (ts(60), ts(70))])
+
+        buckets.mark(ts(0))
+        buckets.restore(buckets.drain())
+        self.assertEqual(buckets.drain(), [(ts(0), None)])
+
+    def test_sample_by_seconds(self):
+        self.assertEqual(sample_by_seconds("SELECT ts, avg(v) FROM t SAMPLE BY 10m"), 600)
+        self.assertIsNone(sample_by_seconds("SELECT * FROM t"))
+        with self.assertRaises(ValueError):
+            sample_by_seconds("SELECT ts, avg(v) FROM t SAMPLE BY 1M")
+
+
+if __name__ == '__main__':
+    unittest.main()
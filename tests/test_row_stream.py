@@ -0,0 +1,43 @@
+import datetime
+import unittest
+
+from row_stream import RowDeduplicator
+
+T0 = datetime.datetime(2024, 7, 29, 11, 0, 0)
+
+
+def row(seconds, value):
+    return (T0 + datetime.timedelta(seconds=seconds), value)
+
+
+class RowDeduplicatorTest(unittest.TestCase):
+    def test_overlapping_window_skips_emitted_rows(self):
+        deduplicator = RowDeduplicator(3600)
+        self.assertEqual(list(deduplicator.filter([row(0, 'a'), row(10, 'b')])), [row(0, 'a'), row(10, 'b')])
+        # An out-of-order transaction adds a row between rows already emitted
+        emitted = list(deduplicator.filter([row(0, 'a'), row(5, 'late'), row(10, 'b'), row(20, 'c')]))
+        self.assertEqual(emitted, [row(5, 'late'), row(20, 'c')])
+        self.assertEqual(deduplicator.duplicates, 2)
+
+    def test_identical_rows_are_counted(self):
+        deduplicator = RowDeduplicator(3600)
+        self.assertEqual(len(list(deduplicator.filter([row(0, 'a'), row(0, 'a'), row(10, 'b')]))), 3)
+        # A third identical row arrived; only that one is new
+        self.assertEqual(list(deduplicator.filter([row(0, 'a'), row(0, 'a'), row(0, 'a'), row(10, 'b')])), [row(0, 'a')])
+
+    def test_digests_expire_behind_the_window(self):
+        deduplicator = RowDeduplicator(60)
+        list(deduplicator.filter([row(0, 'a'), row(100, 'b')]))
+        self.assertEqual(len(deduplicator.seen), 1)
+        # Overlaps reaching behind the window are emitted again
+        self.assertEqual(list(deduplicator.filter([row(0, 'a'), row(100, 'b')])), [row(0, 'a')])
+
+    def test_digests_are_capped_oldest_first(self):
+        deduplicator = RowDeduplicator(3600, max_digests=2)
+        list(deduplicator.filter([row(0, 'a'), row(1, 'b'), row(2, 'c')]))
+        self.assertEqual(len(deduplicator.seen), 2)
+        self.assertEqual(list(deduplicator.filter([row(0, 'a'), row(1, 'b'), row(2, 'c')])), [row(0, 'a')])
+
+
+if __name__ == '__main__':
+    unittest.main()
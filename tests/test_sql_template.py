@@ -0,0 +1,26 @@
+import unittest
+
+from sql_template import compile_template
+
+
+class CompileTemplateTest(unittest.TestCase):
+    def test_placeholder_is_split_out(self):
+        parts = compile_template("SELECT * FROM trades WHERE {timestamp_txn_filter} SAMPLE BY 1h")
+        self.assertEqual(parts, [
+            ('literal', "SELECT * FROM trades WHERE "),
+            ('placeholder', 'timestamp_txn_filter'),
+            ('literal', " SAMPLE BY 1h")
+        ])
+
+    def test_other_braces_stay_literal(self):
+        parts = compile_template("SELECT * FROM trades WHERE symbol ~ '[0-9]{3}' AND {unknown} AND {timestamp_txn_filter}")
+        self.assertEqual(parts[0], ('literal', "SELECT * FROM trades WHERE symbol ~ '[0-9]{3}' AND {unknown} AND "))
+        self.assertEqual(parts[1], ('placeholder', 'timestamp_txn_filter'))
+
+    def test_percent_signs_are_escaped(self):
+        parts = compile_template("SELECT * FROM trades WHERE symbol LIKE 'BTC%' AND {timestamp_txn_filter}")
+        self.assertEqual(parts[0], ('literal', "SELECT * FROM trades WHERE symbol LIKE 'BTC%%' AND "))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+from concurrent.futures import Future
+
+from table_executor import OrderedResults
+
+
+def finished(error=None):
+    future = Future()
+    if error:
+        future.set_exception(error)
+    else:
+        future.set_result(None)
+    return future
+
+
+class OrderedResultsTest(unittest.TestCase):
+    def test_results_wait_for_earlier_jobs_of_their_key(self):
+        results = OrderedResults()
+        first, second = Future(), finished()
+        results.add('trades', first, 1)
+        results.add('trades', second, 2)
+        results.add('smart_meters', finished(), 3)
+        self.assertEqual(results.ready(), [(3, None)])
+        first.set_result(None)
+        self.assertEqual(results.ready(), [(1, None), (2, None)])
+        self.assertEqual(results.ready(), [])
+
+    def test_jobs_after_a_failure_are_reported_as_failed(self):
+        results = OrderedResults()
+        error = RuntimeError('boom')
+        failed, later = Future(), finished()
+        results.add('trades', failed, 1)
+        results.add('trades', later, 2)
+        failed.set_exception(error)
+        self.assertEqual(results.ready(), [(1, error), (2, error)])
+
+        # Jobs submitted after the failure was seen are independent of it
+        results.add('trades', finished(), 3)
+        self.assertEqual(results.ready(), [(3, None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
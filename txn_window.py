@@ -0,0 +1,181 @@
+import array
+import bisect
+import datetime
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# QuestDB's LONG null, stored for missing values since the columns are int64
+NULL = -2 ** 63
+
+# wal_transactions() columns that are fetched as epoch microseconds
+TIMESTAMP_COLUMNS = {'timestamp', 'minTimestamp', 'maxTimestamp'}
+
+# Rows fetched from the cursor at a time
+FETCH_SIZE = 10000
+
+
+def select_list(columns):
+    # Timestamps are cast to LONG on the server, so no datetime is built per transaction
+    return ', '.join(f"cast({col} AS LONG) AS {col}" if col in TIMESTAMP_COLUMNS else col for col in columns)
+
+
+def to_datetime(micros):
+    if micros is None or micros == NULL:
+        return None
+    return EPOCH + datetime.timedelta(microseconds=micros)
+
+
+class TxnWindow:
+    # The new WAL transactions of a table as int64 columns (array('q')), one per
+    # selected wal_transactions() column, ordered by sequencerTxn. Batches of
+    # rows are transposed into the columns as they are fetched, so a burst of
+    # hundreds of thousands of transactions costs 8 bytes per value instead of a
+    # tuple and boxed values per transaction. summary() computes all statistics
+    # in one vectorized pass, with numpy if it is installed and with the C loops
+    # of the builtins otherwise. Missing values are stored as NULL.
+    def __init__(self, columns):
+        self.names = list(columns)
+        if self.names[0] != 'sequencerTxn':
+            raise ValueError("The first column of a transaction window must be sequencerTxn")
+        self.columns = {name: array.array('q') for name in self.names}
+        self.txns = self.columns['sequencerTxn']
+        self._summary = None
+
+    def __len__(self):
+        return len(self.txns)
+
+    def __bool__(self):
+        return len(self.txns) > 0
+
+    @property
+    def first_txn(self):
+        return self.txns[0] if self.txns else None
+
+    @property
+    def last_txn(self):
+        return self.txns[-1] if self.txns else None
+
+    def extend(self, rows, skip=0):
+        # rows are tuples in column order, after skip leading columns (such as a table name tag)
+        if not rows:
+            return
+        values_by_column = zip(*rows)
+        for _ in range(skip):
+            next(values_by_column)
+        for name, values in zip(self.names, values_by_column):
+            if None in values:
+                values = [NULL if value is None else value for value in values]
+            # Extending from another array is a memory copy, extending from a tuple is not
+            self.columns[name].extend(array.array('q', values))
+        self._summary = None
+
+    def sort(self):
+        # UNION ALL branches come back in sequencerTxn order in practice; only reorder when they did not
+        txns = self.txns
+        if numpy is not None:
+            ordered = bool((numpy.diff(numpy.frombuffer(txns, dtype=numpy.int64)) > 0).all()) if len(txns) > 1 else True
+        else:
+            ordered = all(txns[i] < txns[i + 1] for i in range(len(txns) - 1))
+        if ordered:
+            return
+        order = sorted(range(len(txns)), key=txns.__getitem__)
+        for name in self.names:
+            column = self.columns[name]
+            self.columns[name] = array.array('q', (column[i] for i in order))
+        self.txns = self.columns['sequencerTxn']
+        self._summary = None
+
+    def summary(self):
+        # txns, first_txn, last_txn, rows (sum of rowCount), min_timestamp and
+        # max_timestamp (of minTimestamp and maxTimestamp, as datetimes) and
+        # first_commit (of timestamp). Statistics of columns that were not
+        # selected are None.
+        if self._summary is None:
+            self._summary = {
+                'txns': len(self.txns),
+                'first_txn': self.first_txn,
+                'last_txn': self.last_txn,
+                'rows': self.total('rowCount'),
+                'min_timestamp': to_datetime(self.minimum('minTimestamp')),
+                'max_timestamp': to_datetime(self.maximum('maxTimestamp')),
+                'first_commit': to_datetime(self.minimum('timestamp'))
+            }
+        return self._summary
+
+    def _values(self, name, start=0):
+        # The column from start on, as a numpy view or an array, and its number of NULLs
+        column = self.columns.get(name)
+        if column is None or start >= len(column):
+            return None, 0
+        if numpy is not None:
+            values = numpy.frombuffer(column, dtype=numpy.int64)[start:]
+            return values, int(numpy.count_nonzero(values == NULL))
+        values = column[start:] if start else column
+        return values, values.count(NULL)
+
+    def total(self, name):
+        values, nulls = self._values(name)
+        if values is None:
+            return None
+        if numpy is not None:
+            return int(values[values != NULL].sum()) if nulls else int(values.sum())
+        return sum(values) - NULL * nulls
+
+    def minimum(self, name, start=0):
+        values, nulls = self._values(name, start)
+        if values is None or nulls == len(values):
+            return None
+        if numpy is not None:
+            return int(values[values != NULL].min()) if nulls else int(values.min())
+        # NULL is the smallest int64, so it only needs skipping for the minimum
+        return min(filter(NULL.__ne__, values)) if nulls else min(values)
+
+    def maximum(self, name, start=0):
+        values, nulls = self._values(name, start)
+        if values is None or nulls == len(values):
+            return None
+        return int(values.max()) if numpy is not None else max(values)
+
+    def structure_changes(self, structure_version):
+        # (sequencerTxn, structureVersion) of every transaction that changed the
+        # structure version, starting from the given one
+        versions = self.columns.get('structureVersion')
+        if not versions:
+            return []
+        if versions[0] == structure_version and min(versions) == max(versions):
+            return []
+        changes = []
+        for txn, version in zip(self.txns, versions):
+            if version != structure_version and version != NULL:
+                changes.append((txn, version))
+                structure_version = version
+        return changes
+
+    def after(self, txn):
+        # Index of the first transaction after txn
+        return bisect.bisect_right(self.txns, txn) if txn is not None else 0
+
+    def between(self, after_txn=None, upto_txn=None):
+        # The transactions after after_txn, up to and including upto_txn, as a window of their own
+        start = self.after(after_txn)
+        stop = bisect.bisect_right(self.txns, upto_txn) if upto_txn is not None else len(self.txns)
+        if start == 0 and stop == len(self.txns):
+            return self
+        window = TxnWindow(self.names)
+        for name in self.names:
+            window.columns[name] = self.columns[name][start:stop]
+        window.txns = window.columns['sequencerTxn']
+        return window
+
+    def rows(self, names):
+        # The given columns per transaction, with timestamps as datetimes and
+        # missing values as None, for the few callers that need every transaction
+        columns = [self.columns[name] for name in names]
+        converters = [to_datetime if name in TIMESTAMP_COLUMNS else (lambda value: None if value == NULL else value) for name in names]
+        for values in zip(*columns):
+            yield tuple(convert(value) for convert, value in zip(converters, values))
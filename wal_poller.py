@@ -0,0 +1,69 @@
+import itertools
+import operator
+
+from txn_window import TxnWindow, select_list, FETCH_SIZE
+
+TRANSACTION_BATCH_SIZE = 100
+
+
+def build_transactions_query(latest_txn_ids, columns, max_txns=None):
+    # One UNION ALL branch per table, tagged with the table name so rows can be
+    # routed back to their table. sequencerTxn is dense, so max_txns bounds each
+    # branch with a range predicate instead of a LIMIT subquery.
+    return " UNION ALL ".join(
+        f"SELECT '{table}' AS tableName, {columns} FROM wal_transactions('{table}') WHERE sequencerTxn > {latest_txn_id}"
+        + (f" AND sequencerTxn <= {latest_txn_id + max_txns}" if max_txns else "")
+        for table, latest_txn_id in latest_txn_ids.items()
+    )
+
+
+def fetch_new_transactions(cur, latest_txn_ids, columns, batch_size=TRANSACTION_BATCH_SIZE, max_txns=None):
+    # Fetch the new transactions of every table in latest_txn_ids (table -> last
+    # processed sequencerTxn) using one round trip per batch_size tables, at most
+    # max_txns per table if given. The first selected column must be
+    # sequencerTxn. Returns table -> rows ordered by sequencerTxn, without the
+    # tableName tag.
+    new_transactions = {table: [] for table in latest_txn_ids}
+    tables = list(latest_txn_ids)
+    for start in range(0, len(tables), batch_size):
+        batch = {table: latest_txn_ids[table] for table in tables[start:start + batch_size]}
+        cur.execute(build_transactions_query(batch, columns, max_txns))
+        for row in cur.fetchall():
+            new_transactions[row[0]].append(row[1:])
+    for rows in new_transactions.values():
+        rows.sort(key=lambda txn: txn[0])
+    return new_transactions
+
+
+def fetch_transaction_windows(cur, latest_txn_ids, columns, batch_size=TRANSACTION_BATCH_SIZE, fetch_size=FETCH_SIZE, max_txns=None):
+    # Like fetch_new_transactions, but columns is a list of wal_transactions()
+    # column names and every table gets a TxnWindow, filled fetch_size rows at
+    # a time instead of from one fetchall()
+    windows = {table: TxnWindow(columns) for table in latest_txn_ids}
+    tables = list(latest_txn_ids)
+    for start in range(0, len(tables), batch_size):
+        batch = {table: latest_txn_ids[table] for table in tables[start:start + batch_size]}
+        cur.execute(build_transactions_query(batch, select_list(columns), max_txns))
+        while True:
+            rows = cur.fetchmany(fetch_size)
+            if not rows:
+                break
+            if len(batch) == 1:
+                windows[tables[start]].extend(rows, skip=1)
+                continue
+            # Branches return their rows together, so rows of one table are contiguous
+            for table, group in itertools.groupby(rows, key=operator.itemgetter(0)):
+                windows[table].extend(list(group), skip=1)
+    for window in windows.values():
+        window.sort()
+    return windows
+
+
+def fetch_wal_progress(cur, tables):
+    # writerTxn (applied to the table) and sequencerTxn (committed to the WAL) of
+    # the given tables from a single wal_tables() query. Returns table ->
+    # (writerTxn, sequencerTxn); tables that are not WAL tables are left out.
+    if not tables:
+        return {}
+    cur.execute("SELECT name, writerTxn, sequencerTxn FROM wal_tables() WHERE name IN %s", (tuple(tables),))
+    return {name: (writer_txn or 0, sequencer_txn or 0) for name, writer_txn, sequencer_txn in cur.fetchall()}
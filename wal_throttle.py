@@ -0,0 +1,83 @@
+import time
+
+from metrics import counter, gauge
+from sql_template import insert_target
+from wal_poller import fetch_wal_progress
+
+WAL_APPLY_LAG = gauge('questdb_tracker_wal_apply_lag_txns', 'Transactions committed to the WAL of the table that its writer has not applied yet (sequencerTxn - writerTxn).', ['table'])
+DEFERRED_MATERIALIZATIONS = counter('questdb_tracker_deferred_materializations_total', 'Materializations deferred because the target table was too far behind on applying its WAL.', ['table'])
+
+
+class ApplyLagThrottle:
+    # Holds back materializations into a table whose writer is behind on
+    # applying its WAL, instead of piling more transactions onto it. Before a
+    # triggered materialization runs, defer() reads the lag of the target table
+    # from wal_tables() and returns True while it is above max_lag. The scripts
+    # then keep the new transactions pending, so the deferred triggers merge
+    # into one larger materialization once the writer caught up. A trigger
+    # deferred for max_defer_seconds (if set) runs anyway, which bounds staleness
+    # and limits a table that stays behind to one materialization per period. The
+    # lag is read at most every check_seconds, so many tables triggering in the
+    # same poll cost one query. The scripts also call check() once per poll
+    # cycle, which keeps the lag gauge current while nothing triggers.
+    def __init__(self, table, max_lag, max_defer_seconds=None, check_seconds=0.25):
+        self.table = table
+        self.max_lag = max_lag
+        self.max_defer_seconds = max_defer_seconds
+        self.check_seconds = check_seconds
+        self.lag = 0
+        self.checked_at = None
+        # key -> monotonic time its first deferred trigger was held back
+        self.deferred_since = {}
+
+    def check(self, cur):
+        now = time.monotonic()
+        if self.checked_at is None or now - self.checked_at >= self.check_seconds:
+            self.update(fetch_wal_progress(cur, [self.table]))
+        return self.lag
+
+    def update(self, progress):
+        # progress is the result of fetch_wal_progress() for (at least) this table.
+        # Tables that are not WAL tables apply their rows right away.
+        writer_txn, sequencer_txn = progress.get(self.table, (0, 0))
+        self.lag = max(sequencer_txn - writer_txn, 0)
+        self.checked_at = time.monotonic()
+        WAL_APPLY_LAG.set(self.lag, table=self.table)
+
+    def defer(self, cur, key):
+        # key identifies the deferred work, such as the source table or the template
+        lag = self.check(cur)
+        since = self.deferred_since.get(key)
+        if lag <= self.max_lag:
+            if since is not None:
+                print(f"Table {self.table} caught up to a lag of {lag} transactions, materializing {key} after deferring it for {time.monotonic() - since:.1f}s")
+                del self.deferred_since[key]
+            return False
+        if since is None:
+            print(f"Deferring the materialization of {key}: table {self.table} is {lag} transactions behind on applying its WAL (limit {self.max_lag})")
+            self.deferred_since[key] = time.monotonic()
+        elif self.max_defer_seconds and time.monotonic() - since >= self.max_defer_seconds:
+            print(f"Materializing {key} despite a lag of {lag} transactions on table {self.table}, deferred for {time.monotonic() - since:.1f}s")
+            del self.deferred_since[key]
+            return False
+        DEFERRED_MATERIALIZATIONS.inc(table=self.table)
+        return True
+
+
+def check_all(cur, throttles):
+    # Refresh the lag of several throttles with a single wal_tables() query
+    throttles = [throttle for throttle in throttles if throttle]
+    if throttles:
+        progress = fetch_wal_progress(cur, sorted({throttle.table for throttle in throttles}))
+        for throttle in throttles:
+            throttle.update(progress)
+
+
+def throttle_from_args(sql_template, target_table=None, max_apply_lag=None, max_defer_seconds=None):
+    # Without --max_apply_lag materializations are never deferred
+    if max_apply_lag is None:
+        return None
+    table = target_table or insert_target(sql_template.text)
+    if not table:
+        raise ValueError(f"No INSERT INTO found in {sql_template.path}, use --target_table")
+    return ApplyLagThrottle(table, max_apply_lag, max_defer_seconds)